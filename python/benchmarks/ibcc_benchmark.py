@@ -0,0 +1,198 @@
+'''
+Performance benchmarks for IBCC and its variants on synthetic crowds of different sizes. Each case runs in a fresh
+process so that the peak resident set size is measured for that case alone. Run from the python directory:
+
+    python -m benchmarks.ibcc_benchmark                    # run all cases and compare with benchmarks/baseline.json
+    python -m benchmarks.ibcc_benchmark --scenarios small  # run a subset of the scenarios
+    python -m benchmarks.ibcc_benchmark --save-baseline    # replace the baseline with the results from this machine
+
+Timings depend on the machine, so save a baseline locally before making changes, then rerun to look for regressions.
+'''
+import argparse, json, logging, multiprocessing, os, resource, sys, time, traceback
+import numpy as np
+from ibccsynth import generate_crowd
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Sizes of the synthetic data sets. density is the mean number of labels per object. worker_skill, if given, is added to
+# the diagonal of the Dirichlet prior that generates the workers' confusion matrices (generate_crowd's default is 2).
+# With many classes the default workers are too close to random for the runs to converge within max_iterations.
+SCENARIOS = [
+    {'name': 'small', 'N': 1000, 'K': 50, 'nclasses': 2, 'nscores': 2, 'density': 5},
+    {'name': 'multiclass', 'N': 10000, 'K': 200, 'nclasses': 10, 'nscores': 10, 'density': 8, 'worker_skill': 8},
+    {'name': 'dense', 'N': 5000, 'K': 100, 'nclasses': 3, 'nscores': 4, 'density': 20},
+    {'name': 'medium', 'N': 50000, 'K': 1000, 'nclasses': 3, 'nscores': 3, 'density': 5},
+    {'name': 'large', 'N': 500000, 'K': 10000, 'nclasses': 2, 'nscores': 2, 'density': 5},
+]
+
+# Variants to run and the largest number of labels each one is run with. DynIBCC has one state per label so it is
+# only run on the smaller data sets.
+VARIANTS = {
+    'IBCC': 10000000,
+    'BalancedIBCC': 10000000,
+    'DynIBCC': 20000,
+    'CBCC': 500000,
+    'HCBCC': 500000,
+}
+
+
+def diagonal_prior(nclasses, nscores, skill):
+    alpha0 = np.ones((nclasses, nscores))
+    alpha0[np.arange(nclasses), np.arange(nclasses) % nscores] += skill
+    return alpha0
+
+
+def make_combiner(variant, nclasses, nscores, K):
+    nu0 = np.ones(nclasses) * 10
+    alpha0 = diagonal_prior(nclasses, nscores, 1)
+    if variant == 'IBCC':
+        from ibcc import IBCC
+        return IBCC(nclasses=nclasses, nscores=nscores, alpha0=alpha0, nu0=nu0, K=K)
+    elif variant == 'BalancedIBCC':
+        from ibcc_balanced import BalancedIBCC
+        return BalancedIBCC(nclasses=nclasses, nscores=nscores, alpha0=alpha0, nu0=nu0, K=K)
+    elif variant == 'DynIBCC':
+        from dynibcc import DynIBCC
+        return DynIBCC(nclasses=nclasses, nscores=nscores, alpha0=alpha0, nu0=nu0, K=K)
+    elif variant == 'CBCC':
+        from cbcc import CBCC
+        return CBCC(nclasses=nclasses, nscores=nscores, alpha0=alpha0, nu0=nu0, K=K, nclusters=10)
+    elif variant == 'HCBCC':
+        from cbcc import HCBCC
+        gamma0 = alpha0
+        return HCBCC(nclasses=nclasses, nscores=nscores, phi0=np.ones(nclasses) * 3, gamma0=gamma0, nu0=nu0,
+                     cluster_prec_shape=np.ones(nclasses) * 30, cluster_prec_scale=np.ones(nclasses) * 2, nworkers=K)
+    raise ValueError('Unknown variant %s' % variant)
+
+
+def _run_case(variant, scenario, queue):
+    logging.getLogger().setLevel(logging.WARNING)
+    result = {'variant': variant, 'scenario': scenario['name']}
+    try:
+        alpha0 = None
+        if 'worker_skill' in scenario:
+            alpha0 = diagonal_prior(scenario['nclasses'], scenario['nscores'], scenario['worker_skill'])
+        crowdlabels, truth = generate_crowd(scenario['N'], scenario['K'], scenario['nclasses'], scenario['nscores'],
+                                            scenario['density'], alpha0=alpha0, seed=0)
+        t = truth['t']
+        result['nlabels'] = len(crowdlabels)
+        combiner = make_combiner(variant, scenario['nclasses'], scenario['nscores'], scenario['K'])
+        start = time.perf_counter()
+        pT = combiner.combine_classifications(crowdlabels)
+        wall_time = time.perf_counter() - start
+        result['wall_time'] = wall_time
+        result['iterations'] = int(combiner.nIts)
+        result['labels_per_sec'] = len(crowdlabels) / wall_time
+        result['accuracy'] = float(np.mean(np.argmax(pT[:len(t)], axis=1) == t))
+        result['stop_reason'] = combiner.stop_reason
+    except Exception:
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    # ru_maxrss is in kilobytes on Linux and bytes on Mac OS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    queue.put(result)
+
+
+def run_case(variant, scenario):
+    '''
+    Runs one variant on one scenario in a new process and returns a dictionary of the measurements.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(variant, scenario, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def run_benchmarks(scenarios=None, variants=None):
+    results = []
+    for scenario in SCENARIOS:
+        if scenarios and scenario['name'] not in scenarios:
+            continue
+        for variant in VARIANTS:
+            if variants and variant not in variants:
+                continue
+            expected_labels = scenario['N'] * scenario['density']
+            if expected_labels > VARIANTS[variant]:
+                continue
+            result = run_case(variant, scenario)
+            results.append(result)
+            print(format_result(result))
+    return results
+
+
+def format_result(result):
+    if 'error' in result:
+        return '%-12s %-10s ERROR: %s' % (result['variant'], result['scenario'], result['error'])
+    return '%-12s %-10s %9i labels %8.2fs %4i its %10.0f labels/s %7.1f MB peak RSS' % (
+        result['variant'], result['scenario'], result['nlabels'], result['wall_time'], result['iterations'],
+        result['labels_per_sec'], result['peak_rss'] / 1e6)
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25, min_seconds=0.1):
+    '''
+    Returns a list of messages describing the cases that fail, are slower, use more memory or need more iterations than
+    the baseline. Times and memory are allowed to exceed the baseline by the fraction given by tolerance. Slow-downs of
+    less than min_seconds are ignored, since very short runs are dominated by timing noise. Cases that failed in the
+    baseline are reported too, since there is nothing to compare them with; save a new baseline once they run.
+    '''
+    base = dict(((r['variant'], r['scenario']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        key = (result['variant'], result['scenario'])
+        if key not in base:
+            continue
+        old = base[key]
+        if 'error' in result:
+            regressions.append('%s/%s fails: %s' % (key[0], key[1], result['error']))
+            continue
+        if 'error' in old:
+            regressions.append('%s/%s failed in the baseline: %s' % (key[0], key[1], old['error']))
+            continue
+        if result['wall_time'] > max(old['wall_time'] * (1 + tolerance), old['wall_time'] + min_seconds):
+            regressions.append('%s/%s wall time %.2fs vs. baseline %.2fs' % (key[0], key[1], result['wall_time'],
+                                                                              old['wall_time']))
+        if result['peak_rss'] > old['peak_rss'] * (1 + tolerance):
+            regressions.append('%s/%s peak RSS %.1f MB vs. baseline %.1f MB' % (key[0], key[1],
+                                                            result['peak_rss'] / 1e6, old['peak_rss'] / 1e6))
+        if result['iterations'] > old['iterations']:
+            regressions.append('%s/%s iterations %i vs. baseline %i' % (key[0], key[1], result['iterations'],
+                                                                        old['iterations']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark IBCC and its variants on synthetic crowds.')
+    parser.add_argument('--scenarios', nargs='*', help='names of the scenarios to run (default: all)')
+    parser.add_argument('--variants', nargs='*', help='names of the variants to run (default: all)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='JSON file with the baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional increase in time/memory')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scenarios, args.variants)
+    record = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': sys.platform,
+              'python': sys.version.split()[0], 'numpy': np.__version__, 'scenarios': SCENARIOS, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1)
+    errors = [r for r in results if 'error' in r]
+    if args.save_baseline and errors:
+        print('Not saving a baseline with %i failed cases' % len(errors))
+        sys.exit(1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(record, f, indent=1)
+        print('Saved baseline to %s' % args.baseline)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for msg in regressions:
+            print('REGRESSION: ' + msg)
+        if regressions:
+            sys.exit(1)
+        print('No regressions compared with %s' % args.baseline)
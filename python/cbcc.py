@@ -5,7 +5,7 @@ import sys, logging
 import numpy as np
 from copy import deepcopy
 from scipy.sparse import coo_matrix, csr_matrix
-from scipy.special import psi, gammaln, digamma
+from scipy.special import psi, gammaln, digamma, logsumexp
 from ibccdata import DataHandler
 from scipy.optimize import fmin, fmin_cobyla
 from scipy.stats import gamma, beta as beta_dist, bernoulli
@@ -32,15 +32,24 @@ class CBCC(ibcc.IBCC):
 # b_\alpha --> "
       
 # Model parameters and hyper-parameters -----------------------------------------------------------------------------
+    independent_workers = False # the clusters link workers who share no data points
+    cache_settings = ibcc.IBCC.cache_settings + ('conc_prior', 'nclusters')
+
     def __init__(self, nclasses=2, nscores=2, alpha0=None, nu0=None, conc_prior=1, nclusters=100, 
                  K=1, uselowerbound=False, dh=None):
         super(CBCC, self).__init__(nclasses, nscores, alpha0, nu0, K, uselowerbound, dh)
         
         self.conc_prior = conc_prior # concentration hyperparameter
         self.nclusters = nclusters         
+        self.train_counts = None # expected counts of each worker's labels of the training objects
 
 # Initialisation ---------------------------------------------------------------------------------------------------
 
+    def _preprocess_crowdlabels(self, crowdlabels):
+        super(CBCC, self)._preprocess_crowdlabels(crowdlabels)
+        # Reset the counts for the training set in case the dataset or goldlabels have changed
+        self.train_counts = None
+
     def init_weights(self):
         # The weights are the posterior probabilities of each cluster, i.e. proportion of data covered by each cluster
         self.expec_weights()
@@ -82,9 +91,12 @@ class CBCC(ibcc.IBCC):
                 
         # Make sure self.alpha is the right size as well. Values of self.alpha not important as we recalculate below
         self.alpha0 = self.alpha0[:, :, :self.nclusters] # make this the right size if there are fewer classifiers than expected
-        self.alpha = np.zeros((self.nclasses, self.nscores, self.nclusters), dtype=np.float) + self.alpha0
+        self.alpha = np.zeros((self.nclasses, self.nscores, self.nclusters), dtype=float) + self.alpha0
         self.lnPi = np.zeros((self.nclasses, self.nscores, self.K)) 
-        self._expec_lnPi(posterior=False) # calculate alpha from the initial/prior values only in the first iteration
+        # calculate lnPi from the initial/prior values only in the first iteration
+        self.expec_responsibilities()
+        self.expec_weights()
+        self._expec_lnpi(self.use_ml)
 
 # Posterior Updates to Hyperparameters --------------------------------------------------------------------------------
 
@@ -120,83 +132,66 @@ class CBCC(ibcc.IBCC):
     def _expec_t(self):
         super(CBCC, self)._expec_t()
 
+    def _worker_counts(self, C, ET):
+        '''
+        Expected number of times that each worker gave each score to objects of each target class, i.e. 
+        n[j, l, k] = sum_i ET[i, j] C[l][i, k]. Returns an nclasses x nscores x K array.
+        '''
+        counts = np.empty((self.nclasses, self.nscores, self.K))
+        for l in range(self.nscores):
+            # one pass over the labels of each score gives the K x nclasses counts for all classes at once
+            counts[:, l, :] = np.asarray(C[l].T.dot(ET)).T
+        return counts
+
+    def _count_labels(self):
+        '''
+        Updates the expected counts of each worker's labels of the training objects, which are only computed once, 
+        and of the test objects, which depend on the current E_t. 
+        '''
+        if self.train_counts is None:
+            if self.Ntrain:
+                Ctrain = {l: self.C[l][self.trainidxs, :] for l in range(self.nscores)}
+                self.train_counts = self._worker_counts(Ctrain, self.E_t[self.trainidxs, :])
+            else:
+                self.train_counts = np.zeros((self.nclasses, self.nscores, self.K))
+        ET = self.E_t[self.testidxs, :] if self.testidxs is not None else self.E_t
+        self.test_counts = self._worker_counts(self.Ctest, ET)
+
     def expec_responsibilities(self):
         # for each cluster value, compute the log likelihoods of the data. This will be a sum  
         # over lnPi columns for the observed labels multiplied by E_t and summed over all classes and all data points
-        # to get logp(C^{(k)} | cluster_k = cluster)        
-        loglikelihoods = np.zeros((self.K, self.nclusters))
-        
-        self.cluster_lnPi = np.zeros((self.nclasses, self.nscores, self.nclusters))         
-        sumAlpha = np.sum(self.alpha, 1)
-        psiSumAlpha = psi(sumAlpha)
-        for s in range(self.nscores):
-            self.cluster_lnPi[:, s, :] = digamma(self.alpha[:, s, :]) - psiSumAlpha
-        
-        for cl in range(self.nclusters):
-            for j in range(self.nclasses):
-                data = []
-                for l in range(self.nscores):
-                    if self.table_format_flag:
-                        data_l = self.C[l] * self.cluster_lnPi[j, l, cl]
-                    else:   
-                        data_l = self.C[l].multiply(self.cluster_lnPi[j, l, cl])                        
-                    data = data_l if data==[] else data+data_l
-                loglikelihoods[:, cl:cl+1] += data.T.dot(self.E_t[:, j][:, np.newaxis])
+        # to get logp(C^{(k)} | cluster_k = cluster). The data term is linear in the expected counts of each worker's
+        # scores, so the counts are computed once and multiplied by the cluster lnPi for all clusters at once.
+        self.cluster_lnPi = psi(self.alpha) - psi(np.sum(self.alpha, 1))[:, np.newaxis, :]
+        self._count_labels()
+        worker_counts = self.train_counts + self.test_counts
+        loglikelihoods = worker_counts.reshape((-1, self.K)).T.dot(self.cluster_lnPi.reshape((-1, self.nclusters)))
         
         logweights = self.logw[np.newaxis, :]
         
         weighted_log_prob = loglikelihoods + logweights
-        log_prob_norm = np.log(np.sum(np.exp(weighted_log_prob), axis=1))
+        log_prob_norm = logsumexp(weighted_log_prob, axis=1) # workers with many labels underflow np.exp
         log_resp = weighted_log_prob - log_prob_norm[:, np.newaxis]
 
         self.lnr = log_resp
         self.r = np.exp(self.lnr)
 
     def _train_alpha_counts(self):
-        # Save the counts from the training data so we only recalculate the test data on every iteration
-        if not len(self.alpha_tr):
-            self.alpha_tr = np.zeros(self.alpha.shape)
-            if self.Ntrain:
-                for j in range(self.nclasses):
-                    for l in range(self.nscores):
-                        for cl in range(self.nclusters):
-                            Tj = self.E_t[self.trainidxs, j].reshape((self.Ntrain, 1))
-                            if self.table_format_flag:
-                                self.alpha_tr[j,l,cl] = np.sum(                                
-                                   (self.C[l][self.trainidxs,:] * self.r[:, cl][np.newaxis, :]).T.dot(Tj).reshape(-1) )
-                            else:
-                                self.alpha_tr[j,l,cl] = np.sum( 
-                                   self.C[l][self.trainidxs,:].multiply(self.r[:, cl][np.newaxis, :]).T.dot(Tj).reshape(-1) )
-                            
-            self.alpha_tr += self.alpha0
+        # The cluster alphas are the workers' counts weighted by their responsibilities for each cluster
+        self.alpha_tr = self.alpha0 + self.train_counts.dot(self.r)
             
-    def _post_Alpha(self):  # Posterior Hyperparams
+    def _post_alpha(self):  # Posterior Hyperparams
+        # update the cluster memberships first; expec_responsibilities() also computes this iteration's counts
+        self.expec_responsibilities()
+        self.expec_weights()
         self._train_alpha_counts()
-        
         # Add the counts from the test data
-        for j in range(self.nclasses):
-            for l in range(self.nscores):
-                Tj = self.E_t[self.testidxs, j].reshape((self.Ntest, 1))
-                for cl in range(self.nclusters):
-                    if self.table_format_flag:
-                        counts = (self.Ctest[l] * self.r[:, cl][np.newaxis, :]).T.dot(Tj).reshape(-1)
-                    else:
-                        counts = (self.Ctest[l].multiply(self.r[:, cl][np.newaxis, :])).T.dot(Tj).reshape(-1)
-                        
-                    self.alpha[j, l, cl] = self.alpha_tr[j, l, cl] + np.sum(counts)
+        self.alpha = self.alpha_tr + self.test_counts.dot(self.r)
 
-    def _expec_lnPi(self, posterior=True):
-        self.expec_responsibilities()
-        self.expec_weights()
-        
-        # check if E_t has been initialised. Only update alpha if it has. Otherwise E[lnPi] is given by the prior
-        if np.any(self.E_t) and posterior:
-            self._post_Alpha()
-        sumAlpha = np.sum(self.alpha, 1)
-        psiSumAlpha = psi(sumAlpha)
-        for j in range(self.nclasses):
-            for s in range(self.nscores): 
-                self.lnPi[:, s, :] = (psi(self.alpha[:, s, :]) - psiSumAlpha)[np.newaxis, :].dot(self.r.T)
+    def _expec_lnpi(self, use_ml=False):
+        # each worker's expected log confusion matrix is weighted by their responsibilities for each cluster
+        self.cluster_lnPi = psi(self.alpha) - psi(np.sum(self.alpha, 1))[:, np.newaxis, :]
+        self.lnPi = self.cluster_lnPi.dot(self.r.T)
  
 # Likelihoods of observations and current estimates of parameters --------------------------------------------------
     def _post_lnpi(self):
@@ -244,11 +239,13 @@ class HCBCC(CBCC):
 # \alpha --> conc
 # a_\alpha --> we don't use these here, just a point value for the concentration?
 # b_\alpha --> "
+    # the hyperpriors over the clusters' confusion matrices replace alpha0
+    cache_settings = CBCC.cache_settings + ('phi0', 'gamma0', 'a0', 'b0')
 
     def __init__(self, nclasses=2, nscores=2, phi0=None, gamma0=None, nu0=None, cluster_prec_shape=2, 
                  cluster_prec_scale=1, conc_prior=1, nclusters=100, nworkers=1, uselowerbound=False, dh=None):
-        super(HCBCC, self).__init__(nclasses=nclasses, nscores=nscores, alpha0=np.array([]), nu0=nu0, conc_prior=1, 
-                                    nclusters=100, K=nworkers, uselowerbound=uselowerbound, dh=dh)
+        super(HCBCC, self).__init__(nclasses=nclasses, nscores=nscores, alpha0=np.array([]), nu0=nu0, conc_prior=conc_prior, 
+                                    nclusters=nclusters, K=nworkers, uselowerbound=uselowerbound, dh=dh)
         if dh != None:
             self.phi0 = dh.phi0.astype(float)
             self.gamma0 = dh.gamma0.astype(float)
@@ -283,7 +280,7 @@ class HCBCC(CBCC):
                              self.nclusters, axis=2)
         self.phigamma = np.zeros((self.nclasses, self.nscores, self.nclusters))
         # Initialise beta, the precision across the cluster
-        self.beta = np.zeros((self.nclasses, 1, self.nclusters), dtype=np.float) + (self.a0[:, np.newaxis, np.newaxis] 
+        self.beta = np.zeros((self.nclasses, 1, self.nclusters), dtype=float) + (self.a0[:, np.newaxis, np.newaxis] 
                                                                                 / self.b0[:, np.newaxis, np.newaxis])
         
         # The prior per-cluster parameters are eta and beta, and each individual worker is drawn using those priors.
@@ -294,7 +291,10 @@ class HCBCC(CBCC):
         self.alpha = self.alpha_tr.copy()
         self.lnPi = np.zeros((self.nclasses, self.nscores, self.K)) + \
                         np.log(self.alpha_tr / np.sum(self.alpha_tr, axis=1)[:, np.newaxis, :])
-        self._expec_lnPi(posterior=False) # calculate alpha from the initial/prior values only in the first iteration
+        # calculate lnPi from the initial/prior values only in the first iteration
+        self.expec_responsibilities()
+        self.expec_weights()
+        self._expec_lnpi(self.use_ml)
 
 # Posterior Updates to Hyperparameters --------------------------------------------------------------------------------
     def expec_responsibilities(self):
@@ -314,34 +314,25 @@ class HCBCC(CBCC):
         logweights = self.logw[np.newaxis, :]
         
         weighted_log_prob = loglikelihoods + logweights
-        log_prob_norm = np.log(np.sum(np.exp(weighted_log_prob), axis=1))
+        log_prob_norm = logsumexp(weighted_log_prob, axis=1) # workers with many labels underflow np.exp
         log_resp = weighted_log_prob - log_prob_norm[:, np.newaxis]
 
         self.lnr = log_resp
         self.r = np.exp(self.lnr)
 
     def _train_alpha_counts(self):
-        prior_pseudocounts = np.zeros(self.alpha.shape)
-        for j in range(self.nclasses):
-            prior_pseudocounts[j, :, :] = (self.eta[j, :, :] * self.beta[j, :, :]).dot(self.r.T)
-        ibcc.IBCC._train_alpha_counts(self, prior_pseudocounts)
+        # The prior pseudo-counts of each worker are the cluster priors weighted by their responsibilities
+        self.alpha_tr = (self.eta * self.beta).dot(self.r.T) + self.train_counts
 
-    def _post_Alpha(self):  # Posterior Hyperparams
-        self.alpha_tr = [] # reset this so we update with new eta and beta
-        ibcc.IBCC._post_Alpha(self)
-        
-    def _expec_lnPi(self, posterior=True):
+    def _post_alpha(self):  # Posterior Hyperparams
         self.expec_responsibilities()
         self.expec_weights()
+        self._count_labels()
+        self._train_alpha_counts() # update with new eta and beta
+        self.alpha = self.alpha_tr + self.test_counts
         
-        # check if E_t has been initialised. Only update alpha if it has. Otherwise E[lnPi] is given by the prior
-        if np.any(self.E_t) and posterior:
-            self._post_Alpha()
-        sumAlpha = np.sum(self.alpha, 1)
-        psiSumAlpha = psi(sumAlpha)
-        for j in range(self.nclasses):
-            for s in range(self.nscores): 
-                self.lnPi[:, s, :] = (psi(self.alpha[:, s, :]) - psiSumAlpha)[np.newaxis, :] #.dot(self.r)
+    def _expec_lnpi(self, use_ml=False):
+        self.lnPi = psi(self.alpha) - psi(np.sum(self.alpha, 1))[:, np.newaxis, :]
         
         # need to update the cluster pseudo-count distributions first to get new expected eta and beta
         #translate \eta and \beta to \alpha.
@@ -1,10 +1,11 @@
 '''
 @author: Edwin Simpson
 '''
-import sys, logging
+import sys, logging, multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import ibcc
-from scipy.linalg import block_diag
+from scipy.sparse import csr_matrix
 from scipy.special import gammaln
 
 def state_to_alpha(logodds, var):
@@ -12,17 +13,282 @@ def state_to_alpha(logodds, var):
     alpha2 = alpha1 * (1+np.exp(-logodds))
     return alpha1.reshape(logodds.shape), alpha2.reshape(logodds.shape)
 
-def alpha_to_state(alpha, l):
-    Wmean = np.log(alpha[:, l]) - np.log(np.sum(alpha, axis=1) - alpha[:, l])
-    Wmean = Wmean.flatten('F')    
-    diag_vals = (1 / alpha[:, l]) + (1 / (np.sum(alpha, axis=1) - alpha[:, l]))
-    P = np.diagflat(diag_vals)
+def prior_state(alpha0, l):
+    '''
+    Returns the mean and covariance of the state, i.e. the log odds of score l for each class, that correspond to the
+    hyper-parameters alpha0 (nclasses x nscores x nworkers) of each worker. The means are nworkers x nclasses and the
+    covariances are nworkers x nclasses x nclasses.
+    '''
+    alpha_rest = np.sum(alpha0, axis=1) - alpha0[:, l, :]
+    Wmean = (np.log(alpha0[:, l, :]) - np.log(alpha_rest)).T
+    var = ((1 / alpha0[:, l, :]) + (1 / alpha_rest)).T
+    P = var[:, :, np.newaxis] * np.eye(alpha0.shape[0])[np.newaxis, :, :]
     return Wmean, P
 
+def observe(eta_pr, r_pr, c, total):
+    '''
+    Updates the prior mean eta_pr and variance r_pr of the log odds of score l for a labelled data point, given the
+    weight c of score l and the total weight of the label. Returns the posterior mean and variance, and the variance of
+    the state noise to add before the next step.
+    '''
+    alpha_tilde_pr, alpha_tilde_pr_sum = state_to_alpha(eta_pr, r_pr)
+    #update to get posterior given current time-step
+    alpha_tilde_po = alpha_tilde_pr + c
+    alpha_tilde_po_sum = alpha_tilde_pr_sum + total
+    eta_po = np.log(alpha_tilde_po/alpha_tilde_po_sum)
+    r_po = (1/alpha_tilde_po) + (1/alpha_tilde_po_sum)
+    # estimated prior mean and uncertainty
+    pi_tilde_pr = alpha_tilde_pr/alpha_tilde_pr_sum
+    u_pr = pi_tilde_pr * (1-pi_tilde_pr)
+    # estimated means given data up to time tau
+    pi_tilde_po = alpha_tilde_po/alpha_tilde_po_sum
+    u_po = pi_tilde_po * (1-pi_tilde_po)
+    q = (u_po>u_pr) * (u_po - u_pr)
+    return eta_po, r_po, q
+
+def filter_step(Wmean_pr, P_pr, h, c, total):
+    '''
+    One step of the Kalman filter for a batch of states, e.g. those of several workers at the same step of their chains.
+
+    Parameters
+    ----------
+
+    Wmean_pr : a x nclasses numpy array
+        Prior mean of each state.
+    P_pr : a x nclasses x nclasses numpy array
+        Prior covariance of each state.
+    h : a x nclasses numpy array
+        Expected target value of the data point that was labelled.
+    c : a numpy array
+        Weight of the score whose log odds are the state.
+    total : a numpy array
+        Total weight of the label.
+
+    Returns
+    -------
+
+    Wmean_po, P_po : posterior mean and covariance of each state.
+    Kalman : a x nclasses Kalman gain, needed by the smoother.
+    eta_pr, r_pr : prior mean and variance of the log odds of the labelled data point, needed by the smoother.
+    q : a numpy array
+        Variance of the state noise to add before the next step.
+    '''
+    hP = np.einsum('aj,ajm->am', h, P_pr)
+    eta_pr = np.sum(h * Wmean_pr, axis=1)
+    r_pr = np.sum(hP * h, axis=1)
+    eta_po, r_po, q = observe(eta_pr, r_pr, c, total)
+    # calculate update vector
+    z = eta_po - eta_pr
+
+    Kalman = hP / r_pr[:, np.newaxis]
+    R = 1 - (r_po/r_pr)
+
+    Wmean_po = Wmean_pr + Kalman * z[:, np.newaxis]
+    P_po = P_pr - Kalman[:, :, np.newaxis] * hP[:, np.newaxis, :] * R[:, np.newaxis, np.newaxis]
+    return Wmean_po, P_po, Kalman, eta_pr, r_pr, q
+
+def smooth_step(Wmean_po, P_po, Kalman, eta_pr, r_pr, h, lambda_mean, Lambda_cov):
+    '''
+    One backward step of the smoother for a batch of states, given the values that filter_step() returned for them and
+    the smoother's lambda_mean (a x nclasses) and Lambda_cov (a x nclasses x nclasses) from the following step, which
+    are zero at the last step of each chain. Returns the smoothed mean and covariance of each state, and lambda_mean and
+    Lambda_cov for the previous step.
+    '''
+    P = P_po
+    Wmean = Wmean_po - np.einsum('ajk,ak->aj', P, lambda_mean)
+    P = P - np.matmul(np.matmul(P, Lambda_cov), P.transpose((0, 2, 1)))
+
+    eta_po = np.sum(h * Wmean, axis=1)
+    r_po = np.einsum('aj,ajk,ak->a', h, P, h)
+
+    z = eta_po - eta_pr
+    R = 1 - (r_po/r_pr)
+    B = np.eye(h.shape[1]) - Kalman[:, :, np.newaxis] * h[:, np.newaxis, :]
+    Bt = B.transpose((0, 2, 1))
+
+    lambda_mean = np.einsum('ajk,ak->aj', Bt, lambda_mean) - h * (z/r_pr)[:, np.newaxis]
+    Lambda_cov = np.matmul(np.matmul(Bt, Lambda_cov), B) + \
+        h[:, :, np.newaxis] * h[:, np.newaxis, :] * (R/r_pr)[:, np.newaxis, np.newaxis]
+    return Wmean, P, lambda_mean, Lambda_cov
+
+def lockstep_order(agents, K):
+    '''
+    Arranges the labels so that the Kalman filters of all workers can step through their chains together. Workers are
+    ranked by their number of labels, so the workers that have a label at step s of their chain are always the first
+    ones in the ranking, and no padding is needed for the shorter chains.
+
+    Parameters
+    ----------
+
+    agents : Tau numpy array
+        The worker that gave each label, with the labels in time order.
+    K : int
+        Number of workers.
+
+    Returns
+    -------
+
+    order : Tau numpy array
+        Indexes of the labels in step-major order: the first label of each worker in order of rank, then the second
+        label of each worker that has one, and so on.
+    nactive : numpy array
+        Number of workers with a label at each step.
+    ranked : numpy array
+        The workers with at least one label in order of rank.
+    '''
+    counts = np.bincount(agents, minlength=K)
+    ranked = np.argsort(-counts, kind='stable')
+    rank = np.empty(K, dtype=int)
+    rank[ranked] = np.arange(K)
+    # position of each label in its worker's chain
+    byworker = np.argsort(agents, kind='stable')
+    starts = np.cumsum(counts) - counts
+    step = np.empty(len(agents), dtype=int)
+    step[byworker] = np.arange(len(agents)) - starts[agents[byworker]]
+    order = np.lexsort((rank[agents], step))
+    nactive = np.bincount(step)
+    return order, nactive, ranked[:nactive[0]] if len(nactive) else ranked[:0]
+
+def label_buckets(agents, K, size=1, times=None, interval=None):
+    '''
+    Groups each worker's consecutive labels into buckets that share one state of the worker's confusion matrix.
+
+    Parameters
+    ----------
+
+    agents : numpy array
+        The worker that gave each label, with the labels in time order.
+    K : int
+        Number of workers.
+    size : int
+        Number of labels in each bucket, used if times is None. The last bucket of a worker may have fewer labels.
+    times : numpy array
+        Optional time of each label. A worker's consecutive labels in the same window of length interval, i.e. with the
+        same value of floor(times / interval), are put in the same bucket.
+    interval : float
+        Length of the time windows.
+
+    Returns
+    -------
+
+    buckets : numpy array
+        The bucket of each label. Buckets are numbered in the order of their first labels, so with one label in each
+        bucket, the bucket of each label is its index.
+    bucket_agents : numpy array
+        The worker of each bucket.
+    '''
+    byworker = np.argsort(agents, kind='stable')
+    sorted_agents = agents[byworker]
+    new_bucket = np.ones(len(agents), dtype=bool)
+    new_bucket[1:] = sorted_agents[1:] != sorted_agents[:-1]
+    if times is not None:
+        window = np.floor(np.asarray(times)[byworker] / interval)
+        new_bucket[1:] |= window[1:] != window[:-1]
+    else:
+        counts = np.bincount(agents, minlength=K)
+        starts = np.cumsum(counts) - counts
+        position = np.arange(len(agents)) - starts[sorted_agents]
+        new_bucket |= position % size == 0
+    first_labels = byworker[new_bucket]
+    rank = np.empty(len(first_labels), dtype=int)
+    rank[np.argsort(first_labels, kind='stable')] = np.arange(len(first_labels))
+    buckets = np.empty(len(agents), dtype=int)
+    buckets[byworker] = rank[np.cumsum(new_bucket) - 1]
+    return buckets, agents[np.sort(first_labels)]
+
+class SharedArrays(object):
+    '''
+    Numpy arrays in shared memory blocks, so that the processes in a pool can read and write them without copying. The
+    parent process creates the arrays with add() and the pool's processes open them with attach(specs()). The parent
+    must call close(unlink=True) once the pool has finished.
+    '''
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+
+    def add(self, name, value):
+        value = np.asarray(value)
+        block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        self.blocks[name] = block
+        self.arrays[name] = np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)
+        self.arrays[name][...] = value
+        return self.arrays[name]
+
+    def specs(self):
+        return dict((name, (self.blocks[name].name, array.shape, array.dtype.str))
+                    for name, array in self.arrays.items())
+
+    @classmethod
+    def attach(cls, specs):
+        shared = cls()
+        for name, (block_name, shape, dtype) in specs.items():
+            shared.blocks[name] = shared_memory.SharedMemory(name=block_name)
+            shared.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shared.blocks[name].buf)
+        return shared
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = {}
+
+# state of each process in the pool used by DynIBCC when nprocesses > 1
+_filter_process = {}
+
+def _attach_filter_process(specs, params):
+    shared = SharedArrays.attach(specs)
+    combiner = DynIBCC(nclasses=params['nclasses'], nscores=params['nscores'], alpha0=params['alpha0'])
+    combiner.checkpointed_smoothing = params['checkpointed_smoothing']
+    combiner.alpha = shared.arrays['alpha']
+    _filter_process.update(params)
+    _filter_process['shared'] = shared
+    _filter_process['combiner'] = combiner
+
+def _filter_worker_group(task):
+    '''
+    Filters and smooths the chains of one group of workers for score l in a pool process, writing into the shared alpha.
+    '''
+    l, g = task
+    arrays = _filter_process['shared'].arrays
+    bounds = _filter_process['bounds']
+    order = arrays['order'][bounds[g]:bounds[g + 1]]
+    H = arrays['E_t'][arrays['objects'][order], :]
+    _filter_process['combiner']._filter_and_smooth(l, H, arrays['C%i' % l][order], arrays['Cknown'][order], order,
+                                                   _filter_process['nactive'][g], _filter_process['workers'][g])
+
 class DynIBCC(ibcc.IBCC):
     Tau = 1 # the total number of responses from all crowd members
     tauidxs_test = [] # the time-step indexes of the test data points
-    alpha0_tau = [] # the hyper-parameters copied out for each time-step. alpha0 has only one matrix for each agent. 
+    # Keep the filter's state only every sqrt(number of steps) steps and recompute the steps in between when smoothing,
+    # so the memory for the filter grows with the square root of the number of time-steps at the cost of running the
+    # filter twice.
+    checkpointed_smoothing = False
+    tau_dtype = np.float64 # type used to store alpha and lnPi for each time-step; np.float32 halves their memory
+    # the labels in the step-major order used to update all workers' states together, see lockstep_order()
+    lockstep_idxs = None
+    lockstep_nactive = None # number of workers with a label at each step
+    lockstep_workers = None # the workers ranked by their number of labels
+    # Number of processes that filter and smooth the workers' chains in parallel, each taking a group of workers with
+    # the labels, E_t and alpha in shared memory. None uses one per CPU.
+    nprocesses = 1
+    # Group each worker's consecutive labels into buckets with one state each, so that the filter, smoother, alpha and
+    # lnPi scale with the number of buckets rather than labels. Buckets hold bucket_size labels, or if timestamp_column
+    # is set, the labels whose times in that column of the sparse list fall in the same window of bucket_interval. The
+    # times are not rounded with discretedecisions, and NaN times raise a ValueError. Only used with the sparse list
+    # format. As in IBCC, a fourth column that is not the timestamp_column weights each label, whether or not the labels
+    # are bucketed.
+    bucket_size = None
+    timestamp_column = None
+    bucket_interval = None
+    Ctaus = None # the time-step of each label in the sparse list format
+    Tagents = None # the worker of each time-step in the sparse list format
+    bucket_labels = None # the labels sorted by the position of their bucket in the step-major order, if bucketed
+    bucket_label_pos = None # the position of the bucket of each label in bucket_labels
+    _filter_pool = None # the pool, shared arrays and number of groups of workers while inference runs in parallel
+    supports_inplace_updates = False # the per-step updates do not use IBCC's work buffers
+    cache_settings = ibcc.IBCC.cache_settings + ('bucket_size', 'timestamp_column', 'bucket_interval', 'tau_dtype')
 # Initialisation ---------------------------------------------------------------------------------------------------
     def _init_lnPi(self):
         '''
@@ -41,10 +307,26 @@ class DynIBCC(ibcc.IBCC):
             alpha0new = alpha0new[:, :, np.newaxis]
             alpha0new = np.repeat(alpha0new, nnew, axis=2)
             self.alpha0 = np.concatenate((self.alpha0, alpha0new), axis=2)
-        # Make sure self.alpha is the right size as well. Values of self.alpha not important as we recalculate below
-        self.alpha = np.zeros((self.nclasses, self.nscores, self.Tau), dtype=np.float)
-        self.lnPi = np.zeros((self.nclasses, self.nscores, self.Tau))        
-        self._expec_lnPi()        
+        # start each time-step from its worker's prior
+        self.alpha = self.alpha0[:, :, self._tau_workers()].astype(self.tau_dtype)
+        self.lnPi = np.zeros((self.nclasses, self.nscores, self.Tau), dtype=self.tau_dtype)
+        self._expec_lnpi(self.use_ml)
+
+    def _tau_workers(self):
+        '''
+        Returns the worker of each time-step.
+        '''
+        if self.table_format_flag:
+            return np.tile(np.arange(self.K), self.N)
+        return self.Tagents
+
+    def _tau_objects(self):
+        '''
+        Returns the data point of each time-step.
+        '''
+        if self.table_format_flag:
+            return np.repeat(np.arange(self.N), self.K)
+        return self.Cobjects
         
     def _init_params(self, force_reset=False):
         '''
@@ -73,289 +355,466 @@ class DynIBCC(ibcc.IBCC):
         # Initialise all objects relating to the crowd labels.
         self.C = {}
         self.Ctest = {}
+        weights = None
+        times = None
+        if not self.table_format_flag and crowdlabels.shape[1] > 3 and self.timestamp_column != 3:
+            # the optional fourth column weights each label, as in IBCC; missing weights count as 0
+            weights = crowdlabels[:, 3].astype(float)
+            weights[np.isnan(weights)] = 0
+        if not self.table_format_flag and self.timestamp_column is not None:
+            # keep the times as they are: neither filled in nor rounded like the scores
+            times = crowdlabels[:, self.timestamp_column].astype(float)
+            if np.any(np.isnan(times)):
+                raise ValueError('DynIBCC: %i labels have no time in timestamp_column %i.' %
+                                 (np.sum(np.isnan(times)), self.timestamp_column))
         crowdlabels[np.isnan(crowdlabels)] = -1
         if self.discretedecisions:
             crowdlabels = np.round(crowdlabels).astype(int)
         if self.table_format_flag:# crowd labels as a full KxN table? If false, use a sparse 3-column list, where 1st
             # column=classifier ID, 2nd column = obj ID, 3rd column = score.
             self.K = crowdlabels.shape[1]
+            if crowdlabels.shape[0] < self.N:
+                # the gold labels cover more data points than the table: give them empty rows so each row is a time-step
+                missing = np.zeros((self.N - crowdlabels.shape[0], self.K)) - 1
+                crowdlabels = np.concatenate((crowdlabels, missing), axis=0)
             for l in range(self.nscores):
-                Cl = np.zeros((self.N, self.K))
-                #crowd labels may not be supplied for all N data points in the gold labels, so use argwhere
-                lidxs = np.argwhere(crowdlabels==l)
-                Cl[lidxs[:,0], lidxs[:,1]] = 1
-                if not self.discretedecisions:
-                    if l + 1 < self.nscores:
-                        partly_l_idxs = np.bitwise_and(crowdlabels > l, crowdlabels < (l+1))  # partly above l
-                        Cl[partly_l_idxs] = (l + 1) - crowdlabels[partly_l_idxs]
-                    if l > 0:
-                        partly_l_idxs = np.bitwise_and(crowdlabels < l, crowdlabels > (l-1))  # partly below l
-                        Cl[partly_l_idxs] = crowdlabels[partly_l_idxs] - l + 1
-                self.C[l] = Cl
-            # pre-compute the indices into the pi arrays
-            # repeat for test labels only                
-            for l in range(self.nscores):
-                self.Ctest[l] = self.C[l][self.testidxs, :] 
-                
+                self.C[l] = self._score_memberships(crowdlabels, l)
             # Set the number of time-steps
             self.Tau = self.N * self.K
             # indexes for calculating the joint likelihood efficiently
-            self.tauidxs_test = np.arange(self.Tau, dtype=int).reshape((self.N, self.K))[self.testidxs, :]
+            if self.testidxs is None:
+                self.Ctest = self.C
+                self.tauidxs_test = np.arange(self.Tau).reshape((self.N, self.K))
+            else:
+                self.Ctest = dict((l, self.C[l][self.testidxs, :]) for l in range(self.nscores))
+                self.tauidxs_test = np.arange(self.Tau).reshape((self.N, self.K))[self.testidxs, :]
+            self.bucket_labels = None
         else:
-            self.K = np.nanmax(crowdlabels[:,0])+1 # add one because indexes start from 0
-            self.Cagents = crowdlabels[:,0].astype(int)
-            self.Cobjects = crowdlabels[:,1].astype(int)
-            testidxs = [i for i in range(len(self.Cobjects)) if self.testidxs[self.Cobjects[i]]]
-            self.Cagents_test = self.Cagents[testidxs]
-            self.Cobjects_test = self.Cobjects[testidxs]
+            self.K = int(np.nanmax(crowdlabels[:,0]))+1 # add one because indexes start from 0
+            index_type = np.int32 if max(self.K, self.N) < 2**31 else np.int64
+            self.Cagents = crowdlabels[:, 0].astype(index_type)
+            self.Cobjects = crowdlabels[:, 1].astype(index_type)
             for l in range(self.nscores):
-                Cl = crowdlabels[:, 2] == l
-                if not self.discretedecisions:
-                    partly_l_idxs = np.bitwise_and(crowdlabels[:, 2] > l, crowdlabels[:, 2] < l + 1)  # partly above l
-                    Cl[partly_l_idxs] = (l + 1) - crowdlabels[partly_l_idxs, 2]
-                    
-                    partly_l_idxs = np.bitwise_and(crowdlabels[:, 2] < l, crowdlabels[:, 2] > l - 1)  # partly below l
-                    Cl[partly_l_idxs] = crowdlabels[partly_l_idxs, 2] - l + 1
-                self.C[l] = Cl
-                self.Ctest[l] = Cl[testidxs]
+                self.C[l] = self._score_memberships(crowdlabels[:, 2], l)
+                if weights is not None:
+                    self.C[l] *= weights
             # Set the number of time-steps
-            self.Tau = len(self.C[0])
-            self.tauidxs_test = testidxs
+            self._set_buckets(times)
+            # the labels of the test data points
+            if self.testidxs is None:
+                self.Cagents_test = self.Cagents
+                self.Cobjects_test = self.Cobjects
+                self.Ctest = self.C
+                self.tauidxs_test = self.Ctaus
+            else:
+                testlabels = self.testidxs[self.Cobjects]
+                self.Cagents_test = self.Cagents[testlabels]
+                self.Cobjects_test = self.Cobjects[testlabels]
+                self.Ctest = dict((l, self.C[l][testlabels]) for l in range(self.nscores))
+                self.tauidxs_test = self.Ctaus[testlabels]
         # Set and reset object properties for the new dataset
         self.lnpCT = np.zeros((self.N, self.nclasses))
         self.conf_mat_ind = []
         # Reset the pre-calculated data for the training set in case goldlabels has changed
         self.alpha_tr = []
 
+    def _score_memberships(self, scores, l):
+        '''
+        Returns the weight of score l in each label. Scores between two integers are split between them, e.g. a score
+        of 1.25 gives 0.75 to score 1 and 0.25 to score 2. Missing scores, i.e. -1, have no weight.
+        '''
+        lower = np.floor(scores)
+        frac = scores - lower
+        Cl = np.zeros(scores.shape, dtype=self.label_dtype)
+        Cl[lower == l] = 1 - frac[lower == l]
+        Cl[lower == l - 1] = frac[lower == l - 1]
+        return Cl
+
+    def _set_buckets(self, times=None):
+        '''
+        Assigns the labels in the sparse list to time-steps: one for each label, or one for each bucket of labels. times
+        holds the values of the timestamp_column, if it is set.
+        '''
+        if self.timestamp_column is not None:
+            self.Ctaus, self.Tagents = label_buckets(self.Cagents, self.K, times=times, interval=self.bucket_interval)
+        elif self.bucket_size is not None:
+            self.Ctaus, self.Tagents = label_buckets(self.Cagents, self.K, size=self.bucket_size)
+        else:
+            self.Ctaus = np.arange(len(self.Cagents))
+            self.Tagents = self.Cagents
+        self.Tau = len(self.Tagents)
+        self.lockstep_idxs, self.lockstep_nactive, self.lockstep_workers = lockstep_order(self.Tagents, self.K)
+        if self.Tau == len(self.Cagents):
+            self.bucket_labels = None
+            self.bucket_label_pos = None
+            return
+        logging.info('DynIBCC: %i labels in %i buckets' % (len(self.Cagents), self.Tau))
+        position = np.empty(self.Tau, dtype=int)
+        position[self.lockstep_idxs] = np.arange(self.Tau)
+        label_pos = position[self.Ctaus]
+        self.bucket_labels = np.argsort(label_pos, kind='stable')
+        self.bucket_label_pos = label_pos[self.bucket_labels]
+
+    def _worker_label_matrices(self):
+        if self.table_format_flag:
+            return self.C
+        # labels from the same worker for the same data point are summed
+        return dict((l, csr_matrix((self.C[l], (self.Cobjects, self.Cagents)), shape=(self.N, self.K)))
+                    for l in range(self.nscores))
+
+    def _votes(self, l):
+        if self.table_format_flag:
+            return np.sum(self.C[l], axis=1)
+        return np.bincount(self.Cobjects, self.C[l], minlength=self.N)
+
 # Posterior Updates to Hyper-parameters -----------------------------------------------------------------------------
-    def _post_Alpha(self):#Posterior update to hyper-parameters 
+    def _post_alpha(self):#Posterior update to hyper-parameters 
         if self.nclasses>2:
-            for l in range(self.nscores):
-                self.post_Alpha_binary(l)
+            scores = range(self.nscores)
         else:
-            self.post_Alpha_binary(1)
+            scores = [1]
+        if self._filter_pool is None:
+            for l in scores:
+                self.post_Alpha_binary(l)
+            return
+        pool, shared, ngroups = self._filter_pool
+        np.copyto(shared.arrays['E_t'], self.E_t)
+        if self.alpha is not shared.arrays['alpha']:
+            # alpha was reset since the pool started
+            np.copyto(shared.arrays['alpha'], self.alpha)
+            self.alpha = shared.arrays['alpha']
+        # the chains of different workers and scores are independent given E_t
+        pool.map(_filter_worker_group, [(l, g) for l in scores for g in range(ngroups)])
 
-    def h_cov(self, n):
-        h = self.E_t[n, :].reshape((1,1,self.nclasses))
-            # the expanded vector to use with block-diagonal covariance
-        return block_diag(*np.tile(h, (self.K, 1, 1))).T  # nclasses*K x K):
-               
     def post_Alpha_binary_sparselist(self, l=1):
         #l is the index into alpha we are dealing with
+        if self.bucket_labels is not None:
+            self._filter_and_smooth_buckets(l)
+            return
+        order = self.lockstep_idxs
+        H = self.E_t[self.Cobjects[order], :] # expected target of the data point of each label
+        self._filter_and_smooth(l, H, self.C[l][order], self.Cknown[order], order, self.lockstep_nactive,
+                                self.lockstep_workers)
+
+    def post_Alpha_binary_table(self, l=1):
+        # l is the index into alpha we are dealing with
+        # Every worker has a time-step for each row of the table, tau = n * K + k, so the time-steps are already in the
+        # step-major order used by _filter_and_smooth, with all K workers active at every step. The covariance of the
+        # joint state of all workers is block-diagonal, so only the K blocks of nclasses x nclasses are kept.
+        H = np.repeat(self.E_t, self.K, axis=0)
+        nactive = np.zeros(self.N, dtype=int) + self.K
+        self._filter_and_smooth(l, H, self.C[l].reshape(-1), np.asarray(self.Cknown).reshape(-1), np.arange(self.Tau),
+                                nactive, np.arange(self.K))
+
+    def _filter_and_smooth(self, l, H, c, total, order, nactive, workers):
+        '''
+        Updates alpha[:, l, :] by running a Kalman filter and smoother over each worker's chain of time-steps. Each
+        worker's chain is independent of the others given E_t, so the time-steps are visited in a step-major order
+        (see lockstep_order()): each iteration of the loops in _filter() and _smooth() updates the states of all workers
+        that have a time-step at that step with batched array operations.
+
+        If checkpointed_smoothing is set, the steps are split into segments of about the square root of the number of
+        steps. The filter only keeps its state at the start of each segment, and the smoother recomputes the filter over
+        each segment, from the last segment back to the first, before smoothing it.
+
+        Parameters
+        ----------
+
+        l : int
+            The score whose log odds are the state.
+        H, c, total : numpy arrays
+            The expected target of the data point (Tau x nclasses), the weight of score l and the total weight of the
+            label at each time-step, in step-major order.
+        order : Tau numpy array
+            The index into alpha of each time-step in step-major order.
+        nactive : numpy array
+            Number of workers with a time-step at each step. These are always the first workers in the ranking.
+        workers : numpy array
+            The workers in order of rank.
+        '''
+        offsets = np.cumsum(nactive) - nactive
+        nsteps = len(nactive)
+        if self.checkpointed_smoothing:
+            interval = int(np.ceil(np.sqrt(nsteps)))
+        else:
+            interval = nsteps
+        segment_starts = list(range(0, nsteps, interval))
         #FILTERING -- UPDATES GIVEN PREVIOUS TIMESTEPS
         #p(\pi_t | data up to and including t)
+        checkpoints = []
+        state = None
+        for s0 in segment_starts:
+            checkpoints.append(state)
+            filtered, state = self._filter(l, H, c, total, offsets, nactive, workers, s0, min(s0 + interval, nsteps),
+                                           state)
+        #SMOOTHING -- UPDATES GIVEN ALL TIMESTEPS
+        #pi(\pi_t | all data up to time self.Tau)
+        lambda_mean = np.zeros((len(workers), self.nclasses))
+        Lambda_cov = np.zeros((len(workers), self.nclasses, self.nclasses))
+        for i in range(len(segment_starts) - 1, -1, -1):
+            s0 = segment_starts[i]
+            s1 = min(s0 + interval, nsteps)
+            if i < len(segment_starts) - 1:
+                # the filter's values for the last segment are still available, the others are recomputed
+                filtered, _ = self._filter(l, H, c, total, offsets, nactive, workers, s0, s1, checkpoints[i])
+            self._smooth(l, H, order, offsets, nactive, s0, s1, filtered, lambda_mean, Lambda_cov)
+
+    def _filter(self, l, H, c, total, offsets, nactive, workers, s0, s1, state):
+        '''
+        Runs the filter over steps s0 to s1-1, starting from the prior if s0 is 0, or otherwise from the state of the
+        filter after step s0-1. Returns the values needed by the smoother for each time-step in these steps, and the
+        state after step s1-1.
+        '''
+        base = offsets[s0]
+        ntau = offsets[s1 - 1] + nactive[s1 - 1] - base
         # Variables used in smoothing step but calculated during filtering
-        Wmean_po = np.zeros((self.nclasses, self.Tau))
-        P_po = np.zeros((self.nclasses,self.nclasses,self.Tau))
-        Kalman = np.zeros((self.nclasses, self.Tau))
+        Wmean_po = np.zeros((ntau, self.nclasses))
+        P_po = np.zeros((ntau, self.nclasses, self.nclasses))
+        Kalman = np.zeros((ntau, self.nclasses))
+        eta_pr = np.zeros(ntau)
+        r_pr = np.zeros(ntau)
         # filtering variables
-        q = np.zeros(self.K)
-        tau_prev = np.zeros(self.K) -1
         I = np.eye(self.nclasses)
-        eta_pr = np.zeros(self.Tau)
-        r_pr = np.zeros(self.Tau)
-        # loop through all timesteps individually by iterating through each row of the sparselist of crowd labels
-        tau = 0
-        while tau < self.Tau:
-            k = self.Cagents[tau]
-            i = self.Cobjects[tau]
-            c = self.C[l][tau]
-            tau_pr = tau_prev[k]
-            tau_prev[k] = tau
-            h = self.E_t[i, :].reshape((self.nclasses, 1))  # column vector
-            if tau_pr == -1:
-                Wmean_pr, P_pr = alpha_to_state(self.alpha0[:,:,k], l)  # vector of size nclasses, matrix nclasses^2
+        if state is None:
+            q = np.zeros(len(workers))
+        else:
+            Wmean_prev, P_prev, q = state
+            q = q.copy()
+        for s in range(s0, s1):
+            n = nactive[s]
+            steps = slice(offsets[s] - base, offsets[s] - base + n)
+            if s == 0:
+                Wmean_pr, P_pr = prior_state(self.alpha0[:, :, workers], l)
             else:
-                Wmean_pr = Wmean_po[:,tau_pr]
-                P_pr = P_po[:,:,tau_pr] + q[k]*I
-            eta_pr[tau] = h.T.dot(Wmean_pr)
-            r_pr[tau] = h.T.dot(P_pr).dot(h)
-            alpha_tilde_pr,alpha_tilde_pr_sum = state_to_alpha(eta_pr[tau], r_pr[tau])
-            #update to get posterior given current time-step
-            alpha_tilde_po = alpha_tilde_pr + c
-            alpha_tilde_po_sum = alpha_tilde_pr_sum + 1
-            #check r_po
-            eta_po = np.log(alpha_tilde_po/alpha_tilde_po_sum)
-            r_po = (1/alpha_tilde_po) + (1/alpha_tilde_po_sum)
-            # calculate update vector
-            z = eta_po - eta_pr[tau]
-            # estimated prior mean and uncertainty
-            pi_tilde_pr = alpha_tilde_pr/alpha_tilde_pr_sum
-            u_pr = pi_tilde_pr * (1-pi_tilde_pr)
-            # estimated means given data up to time tau
-            pi_tilde_po = alpha_tilde_po/alpha_tilde_po_sum
-            u_po = pi_tilde_po * (1-pi_tilde_po)
-            q[k] = (u_po>u_pr) * (u_po - u_pr)
-            
-            Kalman_tau = P_pr.T.dot(h) / r_pr[tau]
-            Kalman[:, tau] = Kalman_tau.reshape(-1)
-            R = 1 - (r_po/r_pr[tau])
-            
-            Wmean_po[:, tau] = Wmean_pr + Kalman[:, tau] * z
-            P_po[:, :, tau] = P_pr - (Kalman_tau.dot(h.T).dot(P_pr) * R)
-            
-            tau += 1
+                # the workers with a time-step at this step are the first n of those at the previous step
+                Wmean_pr = Wmean_prev[:n]
+                P_pr = P_prev[:n] + q[:n, np.newaxis, np.newaxis] * I
+            Wmean_po[steps], P_po[steps], Kalman[steps], eta_pr[steps], r_pr[steps], q[:n] = filter_step(
+                Wmean_pr, P_pr, H[base:][steps], c[base:][steps], total[base:][steps])
+            Wmean_prev = Wmean_po[steps]
+            P_prev = P_po[steps]
+        state = (Wmean_prev.copy(), P_prev.copy(), q)
+        return (Wmean_po, P_po, Kalman, eta_pr, r_pr), state
 
-        #SMOOTHING -- UPDATES GIVEN ALL TIMESTEPS
-        #pi(\pi_t | all data up to time self.Tau)
-        lambda_mean = np.zeros((self.nclasses, self.K))
-        Lambda_cov = np.zeros((self.nclasses, self.nclasses, self.K))
-        
-        while tau > 0:
-            tau-=1
-            k = self.Cagents[tau]
-            i = self.Cobjects[tau]
-            h = self.E_t[i, :].reshape((self.nclasses, 1))
-                        
-            delta_Wmean = P_po[:, :, tau].dot(lambda_mean[:, k])  # P.T?
-            delta_P = P_po[:, :, tau].dot(Lambda_cov[:, :, k]).dot(P_po[:, :, tau].T)  # both are P.T?
-            
-            Wmean_po[:,tau] = Wmean_po[:,tau] - delta_Wmean
-            P_po[:,:,tau] = P_po[:,:,tau]-delta_P
-            
-            eta_po = h.T.dot(Wmean_po[:,tau])
-            r_po = h.T.dot(P_po[:,:,tau]).dot(h)
-            
-            z = eta_po - eta_pr[tau]
-            R = 1 - (r_po/r_pr[tau])
-            B = I - Kalman[:,tau][:,np.newaxis].dot(h.T)
-            
-            lambda_mean[:,k] = B.T.dot(lambda_mean[:,k]) - h.reshape(-1)*z/r_pr[tau]
-            Lambda_cov[:,:,k] = B.T.dot(Lambda_cov[:,:,k]).dot(B) + (h*R/r_pr[tau]).dot(h.T)
-            
-            pi_var = np.diag(P_po[:,:,tau])
-            
-            alpha_l, alphasum = state_to_alpha(Wmean_po[:,tau],pi_var)
-            self.alpha[:, l, tau] = alpha_l
+    def _smooth(self, l, H, order, offsets, nactive, s0, s1, filtered, lambda_mean, Lambda_cov):
+        '''
+        Runs the smoother backwards over steps s1-1 to s0, given the filter's values for these steps, and writes the
+        smoothed alpha. lambda_mean and Lambda_cov are updated in place, so they carry over to the previous segment.
+        '''
+        Wmean_po, P_po, Kalman, eta_pr, r_pr = filtered
+        base = offsets[s0]
+        for s in range(s1 - 1, s0 - 1, -1):
+            n = nactive[s]
+            steps = slice(offsets[s] - base, offsets[s] - base + n)
+            Wmean, P, lambda_mean[:n], Lambda_cov[:n] = smooth_step(Wmean_po[steps], P_po[steps], Kalman[steps],
+                eta_pr[steps], r_pr[steps], H[base:][steps], lambda_mean[:n], Lambda_cov[:n])
+
+            pi_var = np.diagonal(P, axis1=1, axis2=2)
+            alpha_l, alphasum = state_to_alpha(Wmean, pi_var)
+            taus = order[base:][steps]
+            self.alpha[:, l, taus] = alpha_l.T
             if self.nclasses==2:
-                self.alpha[:,1-l,tau] = alphasum - self.alpha[:,l,tau]
-                
-    def post_Alpha_binary_table(self, l=1):
-        # l is the index into alpha we are dealing with
-        # FILTERING -- UPDATES GIVEN PREVIOUS TIMESTEPS
-        # p(\pi_t | data up to and including t)
-        # Variables used in smoothing step but calculated during filtering
-        Wmean_po = np.zeros((self.nclasses * self.K, self.Tau))
-        P_po = {}  # np.zeros((self.nclasses * self.K, self.nclasses * self.K, self.N))
-        Kalman = {}  # np.zeros((self.nclasses * self.K, self.K, self.N))
-        # indicates which blocks of the kalman matrix are used
-        # filtering variables
-        q = np.zeros((1, self.K))
-        I = np.tile(np.eye(self.nclasses)[np.newaxis, :, :], (self.K, 1, 1))
-        I = block_diag(*I)
-        eta_pr = np.zeros((self.Tau, self.K))
-        r_pr = np.zeros((self.Tau, self.K))
-        # loop through each row of the table in turn (each row is a timestep). Tau also corresponds to the object ID
-        n = 0 # the data point index
-        while n < self.N:
-            logging.debug("Alpha update filter: %i / %i" % (n,self.N) )
-            h_cov = self.h_cov(n)
-            # initialise the state priors
-            if n==0:
-                Wmean_pr, P_pr = alpha_to_state(self.alpha0, l)
+                self.alpha[:, 1-l, taus] = (alphasum - alpha_l).T
+
+    def _filter_and_smooth_buckets(self, l):
+        '''
+        Updates alpha[:, l, :] when each time-step is a bucket of labels. The filter combines all labels in a bucket in
+        one update in information form, with each label linearised around the bucket's prior as in filter_step(), so a
+        bucket with one label gives the same update as filter_step(). The state noise added after a bucket is the sum of
+        the noise after each of its labels. The smoother is a Rauch-Tung-Striebel smoother over the filtered state of
+        each bucket, so the cost and memory of both passes scale with the number of buckets.
+        '''
+        order = self.lockstep_idxs
+        nactive = self.lockstep_nactive
+        offsets = np.cumsum(nactive) - nactive
+        label_bounds = np.searchsorted(self.bucket_label_pos, np.append(offsets, self.Tau))
+        I = np.eye(self.nclasses)
+        Wmean_f = np.zeros((self.Tau, self.nclasses))
+        P_f = np.zeros((self.Tau, self.nclasses, self.nclasses))
+        q = np.zeros(self.Tau)
+        #FILTERING
+        for s in range(len(nactive)):
+            n = nactive[s]
+            steps = slice(offsets[s], offsets[s] + n)
+            if s == 0:
+                Wmean_pr, P_pr = prior_state(self.alpha0[:, :, self.lockstep_workers], l)
             else:
-                Wmean_pr = Wmean_po[:, n-1]
-                P_pr = P_po[n-1] + np.tile(q, (self.nclasses, 1)).flatten('F') * I
-            # priors
-            eta_pr[n, :] = h_cov.T.dot(Wmean_pr).reshape(-1)
-            r_pr[n, :] = np.diag(h_cov.T.dot(P_pr).dot(h_cov)).reshape(-1) # possibly doing too much computation here?
-            alpha_tilde_pr, alpha_tilde_pr_sum = state_to_alpha(eta_pr[n, :], r_pr[n, :])
-            # replace any missing c values
-            c = self.C[l][n,:]
-            total_n = self.Cknown[n,:]
-            # update to get posterior given current time-step
-            alpha_tilde_po = alpha_tilde_pr + c
-            alpha_tilde_po_sum = alpha_tilde_pr_sum + total_n
-#             logging.debug("Alpha_tilde_po " + str(alpha_tilde_po) + ", tau=" + str(tau))
-            # check r_po
-            eta_po = np.log(alpha_tilde_po / alpha_tilde_po_sum)
-            r_po = (1.0 / alpha_tilde_po) + (1.0 / alpha_tilde_po_sum)
-            # update from this observation at tau
-            z = eta_po - eta_pr[n, :]
-            pi_tilde_pr = alpha_tilde_pr / alpha_tilde_pr_sum
-            u_pr = pi_tilde_pr * (1 - pi_tilde_pr)
-            pi_tilde_po = alpha_tilde_po / alpha_tilde_po_sum
-            u_po = pi_tilde_po * (1 - pi_tilde_po)
-            q[:] = (u_po > u_pr) * (u_po - u_pr)
-            Kalman[n] = P_pr.T.dot(h_cov) / r_pr[n, :]  # JK x K # / np.tile(r_pr[tau, :], (self.nclasses, 1)).reshape((self.nclasses * self.K, 1), order='F')
-            R = 1 - (r_po / r_pr[n, :])
-            R = np.tile(R, (self.nclasses, 1)).flatten('F')
-            Wmean_po[:, n] = Wmean_pr + np.sum(Kalman[n] * z, axis=1)  #* np.tile(z, (self.nclasses, 1)).reshape((self.nclasses * self.K, 1), order='F')).reshape(-1)  # kalman has too many columns !!!
-            P_po[n] = P_pr - (Kalman[n].dot(h_cov.T).dot(P_pr) * R)
-            # increment the timestep counter
-            n += 1
-        logging.debug("Completed " + str(n) + " filter steps.")
-        # SMOOTHING -- UPDATES GIVEN ALL TIMESTEPS
-        # pi(\pi_t | all data up to time self.N)
-        lambda_mean = np.zeros((self.nclasses * self.K))
-        Lambda_cov = np.zeros((self.nclasses * self.K, self.nclasses * self.K))
-        while n > 0:
-            n -= 1
-            logging.debug("Alpha update smoother: " + str(n) + "/" + str(self.N))
-            h_cov = self.h_cov(n)
-            delta_Wmean = P_po[n].dot(lambda_mean)
-            delta_P = P_po[n].dot(Lambda_cov).dot(P_po[n].T)
-            Wmean_po[:, n] = Wmean_po[:, n] - delta_Wmean.reshape(-1)
-            P_po[n] = P_po[n] - delta_P
-            eta_po = h_cov.T.dot(Wmean_po[:, n])
-            r_po = np.diag(h_cov.T.dot(P_po[n]).dot(h_cov))
-            z = eta_po - eta_pr[n, :]
-            z_rpr = z / r_pr[n, :]  # np.tile(z / r_pr[tau, :], (self.nclasses, 1)).reshape((self.nclasses * self.K, 1), order='F')
-            R = 1 - (r_po / r_pr[n, :])
-            B = I - Kalman[n].dot(h_cov.T)
-            lambda_mean = B.T.dot(lambda_mean) - np.sum(h_cov * z_rpr, axis=1)
-            Lambda_cov = B.T.dot(Lambda_cov).dot(B) + (h_cov * R / r_pr[n, :]).dot(h_cov.T)
-            pi_var = np.diag(P_po[n]).reshape((self.nclasses, self.K), order='F')
-            alpha_l, alphasum = state_to_alpha(Wmean_po[:, n].reshape((self.nclasses, self.K), order='F'), pi_var)
-            if self.verbose:
-                logging.debug("Alpha: " + str(alpha_l))
-            agentIdx = np.arange(self.K)
-            timeIdx = np.tile([n], (self.K))
-            tauIdx = np.ravel_multi_index((timeIdx, agentIdx), (self.N, self.K))
-
-            self.alpha[:, l, tauIdx] = alpha_l
-            if self.nclasses == 2:
-                self.alpha[:, 1 - l, tauIdx] = alphasum - self.alpha[:, l, tauIdx]
-                
+                Wmean_pr = Wmean_f[offsets[s - 1]:offsets[s - 1] + n]
+                P_pr = P_f[offsets[s - 1]:offsets[s - 1] + n] + q[offsets[s - 1]:offsets[s - 1] + n, np.newaxis,
+                                                                  np.newaxis] * I
+            labels = self.bucket_labels[label_bounds[s]:label_bounds[s + 1]]
+            rows = self.bucket_label_pos[label_bounds[s]:label_bounds[s + 1]] - offsets[s]
+            h = self.E_t[self.Cobjects[labels], :]
+            eta_pr = np.sum(h * Wmean_pr[rows], axis=1)
+            r_pr = np.einsum('mj,mjk,mk->m', h, P_pr[rows], h)
+            eta_po, r_po, q_labels = observe(eta_pr, r_pr, self.C[l][labels], self.Cknown[labels])
+            # each label is a linear observation of the state with precision R / r_po
+            R = 1 - (r_po/r_pr)
+            precision = R / r_po
+            info_P = np.linalg.inv(P_pr)
+            info_mean = np.einsum('ajk,ak->aj', info_P, Wmean_pr)
+            np.add.at(info_P, rows, h[:, :, np.newaxis] * h[:, np.newaxis, :] * precision[:, np.newaxis, np.newaxis])
+            np.add.at(info_mean, rows, h * ((eta_pr * R + eta_po - eta_pr) / r_po)[:, np.newaxis])
+            P_f[steps] = np.linalg.inv(info_P)
+            Wmean_f[steps] = np.einsum('ajk,ak->aj', P_f[steps], info_mean)
+            q[steps] = np.bincount(rows, q_labels, minlength=n)
+        #SMOOTHING
+        for s in range(len(nactive) - 1, -1, -1):
+            n = nactive[s]
+            steps = slice(offsets[s], offsets[s] + n)
+            Wmean = Wmean_f[steps].copy()
+            P = P_f[steps].copy()
+            if s < len(nactive) - 1:
+                # the workers with another bucket are the first m at this step
+                m = nactive[s + 1]
+                P_pr = P[:m] + q[steps][:m, np.newaxis, np.newaxis] * I
+                gain = np.linalg.solve(P_pr, P[:m]).transpose((0, 2, 1))
+                Wmean[:m] += np.einsum('ajk,ak->aj', gain, Wmean_next - Wmean[:m])
+                P[:m] += np.matmul(np.matmul(gain, P_next - P_pr), gain.transpose((0, 2, 1)))
+            Wmean_next = Wmean
+            P_next = P
+
+            alpha_l, alphasum = state_to_alpha(Wmean, np.diagonal(P, axis1=1, axis2=2))
+            taus = order[steps]
+            self.alpha[:, l, taus] = alpha_l.T
+            if self.nclasses==2:
+                self.alpha[:, 1-l, taus] = (alphasum - alpha_l).T
+
 # Likelihoods of observations and current estimates of parameters --------------------------------------------------
     def _lnjoint(self, alldata=False):
         '''
-        For use with crowdsourced data in table format (should be converted on input)
+        Adds up the expected log likelihood of each label, taken from lnPi at the label's time-step. In the sparse list
+        format, the contributions of the labels are summed for each data point with bincount, so only one value per
+        label is held in memory rather than an N x K array.
         '''
-        if self.uselowerbound or alldata:
-            for j in range(self.nclasses):
-                data = np.zeros((self.N, self.K), dtype=float)
+        test_only = not (self.uselowerbound or alldata) and self.testidxs is not None
+        for j in range(self.nclasses):
+            if self.table_format_flag:
+                data = 0
                 for l in range(self.nscores):
-                    if self.table_format_flag:
-                        data += self.lnPi[j, l, :].reshape((self.N,self.K)) * self.C[l]
+                    if test_only:
+                        data = data + self.lnPi[j, l, self.tauidxs_test] * self.Ctest[l]
                     else:
-                        data[self.Cobjects, self.Cagents] += self.lnPi[j, l, :] * self.C[l]
-                self.lnpCT[:, j] = np.sum(data, 1) + self.lnkappa[j]
-        else:  # no need to calculate in full - only do for test data points
-            for j in range(self.nclasses):
-                if self.table_format_flag:
-                    data = np.zeros((self.Ntest, self.K), dtype=float)
+                        data = data + self.lnPi[j, l, :].reshape((self.N, self.K)) * self.C[l]
+                lnpCT_j = np.sum(data, 1)
+            else:
+                if test_only:
+                    objects, taus, C = self.Cobjects_test, self.tauidxs_test, self.Ctest
                 else:
-                    data = np.zeros((self.N, self.K), dtype=float)
+                    objects, taus, C = self.Cobjects, self.Ctaus, self.C
+                lnp_labels = np.zeros(len(objects))
                 for l in range(self.nscores):
-                    if self.table_format_flag:
-                        data += self.lnPi[j, l, self.tauidxs_test] * self.Ctest[l]
-                    else:
-                        data[self.Cobjects_test, self.Cagents_test] += self.lnPi[j, l, self.tauidxs_test] * self.Ctest[l]
-                if not self.table_format_flag:
-                    data = data[self.testidxs,:]
-                self.lnpCT[self.testidxs, j] = np.sum(data, 1) + self.lnkappa[j]
-
+                    lnp_labels += self.lnPi[j, l, taus] * C[l]
+                lnpCT_j = np.bincount(objects, lnp_labels, minlength=self.N)
+                if test_only:
+                    lnpCT_j = lnpCT_j[self.testidxs]
+            if test_only:
+                self.lnpCT[self.testidxs, j] = lnpCT_j + self.lnkappa[j]
+            else:
+                self.lnpCT[:, j] = lnpCT_j + self.lnkappa[j]
 
     def _post_lnpi(self):
-        if self.alpha0_tau==[]:
-            if self.table_format_flag:
-                self.alpha0_tau = np.tile(self.alpha0, (1,1,self.N))
-                self.piprior_const = np.sum(gammaln(np.sum(self.alpha0,1)) - np.sum(gammaln(self.alpha0),1)) * self.N               
-            else:
-                self.alpha0_tau = self.alpha0[:,:,self.Cagents]
-                self.piprior_const = np.sum(gammaln(np.sum(self.alpha0_tau,1)) - np.sum(gammaln(self.alpha0_tau),1))
-        return np.sum(np.sum((self.alpha0_tau-1)*self.lnPi,1)) + self.piprior_const
+        # sum lnPi over each worker's time-steps, so the prior does not need to be copied out for each time-step
+        workers = self._tau_workers()
+        alpha0 = self.alpha0[:, :, :self.K]
+        lnPi_sum = np.zeros(alpha0.shape)
+        for j in range(self.nclasses):
+            for l in range(self.nscores):
+                lnPi_sum[j, l] = np.bincount(workers, self.lnPi[j, l], minlength=self.K)
+        ntau = np.bincount(workers, minlength=self.K)
+        piprior_const = np.sum(ntau * (gammaln(np.sum(alpha0, 1)) - np.sum(gammaln(alpha0), 1)))
+        return np.sum((alpha0 - 1) * lnPi_sum) + piprior_const
+
+# Parallel filtering ------------------------------------------------------------------------------------------------
+    def _run_inference(self):
+        nprocesses = self.nprocesses or multiprocessing.cpu_count()
+        if nprocesses <= 1 or self.K <= 1:
+            super(DynIBCC, self)._run_inference()
+            return
+        if self.bucket_labels is not None:
+            raise ValueError('DynIBCC does not support nprocesses > 1 with buckets of labels.')
+        self._start_filter_pool(nprocesses)
+        try:
+            super(DynIBCC, self)._run_inference()
+        finally:
+            self._stop_filter_pool()
+
+    def _worker_groups(self, ngroups):
+        '''
+        Splits the workers into ngroups groups with similar numbers of time-steps. Returns a list with the step-major
+        order, nactive and ranked workers of each group, as lockstep_order() gives for all workers.
+        '''
+        groups = []
+        if self.table_format_flag:
+            for g in range(ngroups):
+                workers = np.arange(g, self.K, ngroups)
+                order = (np.arange(self.N)[:, np.newaxis] * self.K + workers[np.newaxis, :]).reshape(-1)
+                groups.append((order, np.zeros(self.N, dtype=int) + len(workers), workers))
+        else:
+            # dealing out the workers in order of rank balances the number of labels in each group
+            group_of = np.zeros(self.K, dtype=int)
+            group_of[self.lockstep_workers] = np.arange(len(self.lockstep_workers)) % ngroups
+            for g in range(ngroups):
+                idxs = np.flatnonzero(group_of[self.Cagents] == g)
+                order, nactive, workers = lockstep_order(self.Cagents[idxs], self.K)
+                groups.append((idxs[order], nactive, workers))
+        return [group for group in groups if len(group[2])]
+
+    def _start_filter_pool(self, nprocesses):
+        groups = self._worker_groups(nprocesses)
+        shared = SharedArrays()
+        self.alpha = shared.add('alpha', self.alpha)
+        shared.add('E_t', self.E_t)
+        shared.add('objects', self._tau_objects())
+        for l in range(self.nscores):
+            shared.add('C%i' % l, np.asarray(self.C[l], dtype=float).reshape(-1))
+        shared.add('Cknown', np.asarray(self.Cknown, dtype=float).reshape(-1))
+        shared.add('order', np.concatenate([group[0] for group in groups]))
+        params = {'nclasses': self.nclasses, 'nscores': self.nscores, 'alpha0': self.alpha0,
+                  'checkpointed_smoothing': self.checkpointed_smoothing,
+                  'bounds': np.cumsum([0] + [len(group[0]) for group in groups]),
+                  'nactive': [group[1] for group in groups], 'workers': [group[2] for group in groups]}
+        logging.info('DynIBCC: filtering %i groups of workers in %i processes' % (len(groups), nprocesses))
+        pool = multiprocessing.Pool(min(nprocesses, len(groups)), initializer=_attach_filter_process,
+                                    initargs=(shared.specs(), params))
+        self._filter_pool = (pool, shared, len(groups))
+
+    def _stop_filter_pool(self):
+        pool, shared, _ = self._filter_pool
+        self._filter_pool = None
+        pool.close()
+        pool.join()
+        # copy alpha out of shared memory before it is released
+        self.alpha = np.array(self.alpha)
+        shared.close(unlink=True)
+
+# Prediction with a frozen model -----------------------------------------------------------------------------------
+    def _frozen_lnpi(self):
+        '''
+        Uses the state of each worker's confusion matrix at their last label in the training data. Workers without any
+        labels keep the prior.
+        '''
+        lnPi = np.tile(self._prior_lnpi()[:, :, np.newaxis], (1, 1, int(self.K)))
+        seen, last_tau = self._last_taus()
+        lnPi[:, :, seen] = self.lnPi[:, :, last_tau[seen]]
+        return lnPi
+
+    def _last_taus(self):
+        '''
+        Returns a boolean array marking the workers with at least one label, and the time-step of each worker's last
+        label.
+        '''
+        K = int(self.K)
+        if self.table_format_flag:
+            labelled = np.asarray(self.Cknown) > 0
+            seen = np.any(labelled, axis=0)
+            last_obj = self.N - 1 - np.argmax(labelled[::-1, :], axis=0)
+            last_tau = last_obj * K + np.arange(K)
+        else:
+            last_tau = np.zeros(K, dtype=int) - 1
+            np.maximum.at(last_tau, self.Tagents, np.arange(self.Tau))
+            seen = last_tau >= 0
+        return seen, last_tau
 
 # Loader and Runner helper functions -------------------------------------------------------------------------------
 if __name__ == '__main__':
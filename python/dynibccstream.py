@@ -0,0 +1,211 @@
+'''
+Online version of DynIBCC for following the reliability of workers while their labels arrive. Only the latest filtered
+state of each worker's confusion matrix is kept, so each label is processed in constant time and the current estimates
+are available without rerunning DynIBCC over the whole history:
+
+    stream = DynIBCCStream(nclasses=2, nscores=2, lag=10)   # or DynIBCCStream.from_combiner(trained_dynibcc)
+    stream.add_label(worker, subject, score)
+    stream.confusion_matrix(worker)     # the worker's current expected confusion matrix
+    stream.posterior([subject])         # posterior class probabilities of subjects given their labels so far
+
+Each label updates its worker's state with one step of the same Kalman filter as DynIBCC. The expected target value of
+the subject is its posterior given its earlier labels and the new label under the worker's predicted confusion matrix.
+With lag > 0, each worker's last lag labels are smoothed again after each of their labels (fixed-lag smoothing) and
+the contributions of those labels to their subjects' posteriors are revised. Older labels are not revisited, so the
+results approximate those of a batch run of DynIBCC over the same labels.
+'''
+from collections import deque
+import numpy as np
+from scipy.special import psi
+from dynibcc import filter_step, smooth_step, prior_state, state_to_alpha
+
+
+def _normalise(lnp):
+    p = np.exp(lnp - np.max(lnp))
+    return p / np.sum(p)
+
+
+class DynIBCCStream(object):
+    '''
+    Parameters
+    ----------
+
+    nclasses : int
+        Number of target classes.
+    nscores : int
+        Number of scores that the workers can assign.
+    alpha0 : nclasses x nscores numpy array
+        Prior hyperparameters of the confusion matrix of a new worker. Defaults to the same prior as IBCC.
+    nu0 : nclasses numpy array
+        Prior pseudo-counts of the target classes.
+    lag : int
+        Number of each worker's most recent labels that are smoothed after each of their labels. 0 keeps the
+        filtered estimates only.
+    '''
+    def __init__(self, nclasses=2, nscores=2, alpha0=None, nu0=None, lag=0):
+        self.nclasses = nclasses
+        self.nscores = nscores
+        if alpha0 is None:
+            alpha0 = np.ones((nclasses, nscores))
+            if nclasses <= nscores:
+                alpha0[range(nclasses), range(nclasses)] += 1
+        self.alpha0 = np.asarray(alpha0, dtype=float).reshape((nclasses, nscores))
+        if nu0 is None:
+            nu0 = np.ones(nclasses)
+        self.nu0 = np.asarray(nu0, dtype=float).reshape(-1)
+        self.lag = lag
+        # the scores whose log odds are tracked by the filter, as in DynIBCC._post_alpha()
+        self.tracked_scores = np.arange(nscores) if nclasses > 2 else np.array([1])
+        Wmean, P = zip(*[prior_state(self.alpha0[:, :, np.newaxis], l) for l in self.tracked_scores])
+        self.prior_Wmean = np.concatenate(Wmean) # one row for each tracked score
+        self.prior_P = np.concatenate(P)
+        self.workers = {} # worker ID -> dictionary with the latest filtered state and the labels that can be smoothed
+        self.subjects = {} # subject ID -> (log likelihood of its labels for each class, posterior counted in ET_sum)
+        self.ET_sum = np.zeros(nclasses) # sum of the posteriors of all subjects
+        self.nlabels = 0
+        self._update_lnkappa()
+
+    @classmethod
+    def from_combiner(cls, combiner, lag=0):
+        '''
+        Continues from a DynIBCC model trained with combine_classifications(). Worker IDs are the worker indexes used in
+        training, and each worker starts from their state at their last label. The class proportions start from those
+        learned in training, but the subjects from training have no labels in the stream.
+        '''
+        alpha0 = combiner.alpha0[:, :, 0] if combiner.alpha0.ndim == 3 else combiner.alpha0
+        stream = cls(combiner.nclasses, combiner.nscores, alpha0, combiner.nu0, lag)
+        seen, last_tau = combiner._last_taus()
+        workers = np.flatnonzero(seen)
+        alpha = np.asarray(combiner.alpha[:, :, last_tau[workers]], dtype=float)
+        states = [prior_state(alpha, l) for l in stream.tracked_scores]
+        for i, k in enumerate(workers):
+            state = stream._new_worker(k)
+            state['Wmean'] = np.array([Wmean[i] for Wmean, _ in states])
+            state['P'] = np.array([P[i] for _, P in states])
+        stream.ET_sum = np.reshape(combiner.nu, -1) - stream.nu0
+        stream._update_lnkappa()
+        return stream
+
+    def _new_worker(self, worker):
+        state = {'Wmean': self.prior_Wmean.copy(), 'P': self.prior_P.copy(), 'q': np.zeros(len(self.tracked_scores)),
+                 'recent': deque(maxlen=self.lag)}
+        self.workers[worker] = state
+        return state
+
+    def _update_lnkappa(self):
+        nu = self.nu0 + self.ET_sum
+        self.lnkappa = psi(nu) - psi(np.sum(nu))
+
+    def _alpha(self, Wmean, P):
+        '''
+        Converts the states of the tracked scores of one worker to the hyperparameters of their confusion matrix.
+        '''
+        alpha = self.alpha0.copy()
+        alpha_l, alphasum = state_to_alpha(Wmean, np.diagonal(P, axis1=1, axis2=2))
+        alpha[:, self.tracked_scores] = alpha_l.T
+        if self.nclasses == 2:
+            alpha[:, 0] = alphasum[0] - alpha_l[0]
+        return alpha
+
+    def _lnpi(self, Wmean, P):
+        alpha = self._alpha(Wmean, P)
+        return psi(alpha) - psi(np.sum(alpha, axis=1))[:, np.newaxis]
+
+    def _score_weights(self, score, weight):
+        # scores between two integers are split between them, as in IBCC._preprocess_crowdlabels
+        c = np.zeros(self.nscores)
+        lower = min(int(np.floor(score)), self.nscores - 1)
+        frac = min(max(score - lower, 0), 1)
+        c[lower] += weight * (1 - frac)
+        c[min(lower + 1, self.nscores - 1)] += weight * frac
+        return c
+
+    def _add_to_subject(self, subject, lnlik_change):
+        lnlik, ET = self.subjects.get(subject, (np.zeros(self.nclasses), np.zeros(self.nclasses)))
+        lnlik = lnlik + lnlik_change
+        ET_new = _normalise(self.lnkappa + lnlik)
+        self.ET_sum += ET_new - ET
+        self.subjects[subject] = (lnlik, ET_new)
+        self._update_lnkappa()
+
+# Online updates ---------------------------------------------------------------------------------------------------
+    def add_label(self, worker, subject, score, weight=1.0):
+        '''
+        Updates the worker's state and the subject's posterior with one label. Labels with missing (NaN or negative)
+        scores are ignored.
+        '''
+        if not np.isfinite(score) or score < 0:
+            return
+        state = self.workers.get(worker)
+        if state is None:
+            state = self._new_worker(worker)
+        c = self._score_weights(score, weight)
+        ntracked = len(self.tracked_scores)
+
+        Wmean_pr = state['Wmean']
+        P_pr = state['P'] + state['q'][:, np.newaxis, np.newaxis] * np.eye(self.nclasses)
+        lnlik = self.subjects[subject][0] if subject in self.subjects else np.zeros(self.nclasses)
+        h = _normalise(self.lnkappa + lnlik + self._lnpi(Wmean_pr, P_pr).dot(c))
+        H = np.tile(h, (ntracked, 1))
+        Wmean_po, P_po, Kalman, eta_pr, r_pr, q = filter_step(Wmean_pr, P_pr, H, c[self.tracked_scores],
+                                                              np.zeros(ntracked) + weight)
+        state['Wmean'], state['P'], state['q'] = Wmean_po, P_po, q
+
+        contribution = self._lnpi(Wmean_po, P_po).dot(c)
+        self._add_to_subject(subject, contribution)
+        self.nlabels += 1
+        if self.lag:
+            state['recent'].append({'subject': subject, 'c': c, 'H': H, 'Wmean_po': Wmean_po, 'P_po': P_po,
+                                    'Kalman': Kalman, 'eta_pr': eta_pr, 'r_pr': r_pr, 'contribution': contribution})
+            self._smooth_recent(state)
+
+    def add_labels(self, crowdlabels):
+        '''
+        Adds the labels in a sparse list (rows of worker, subject, score and optionally a weight) in order.
+        '''
+        for row in crowdlabels:
+            weight = row[3] if len(row) > 3 else 1.0
+            self.add_label(row[0], row[1], row[2], weight)
+
+    def _smooth_recent(self, state):
+        '''
+        Runs the smoother back over the worker's recent labels, starting from their latest filtered state, and revises
+        the contribution of each label to the posterior of its subject.
+        '''
+        ntracked = len(self.tracked_scores)
+        lambda_mean = np.zeros((ntracked, self.nclasses))
+        Lambda_cov = np.zeros((ntracked, self.nclasses, self.nclasses))
+        for record in reversed(state['recent']):
+            Wmean, P, lambda_mean, Lambda_cov = smooth_step(record['Wmean_po'], record['P_po'], record['Kalman'],
+                record['eta_pr'], record['r_pr'], record['H'], lambda_mean, Lambda_cov)
+            contribution = self._lnpi(Wmean, P).dot(record['c'])
+            self._add_to_subject(record['subject'], contribution - record['contribution'])
+            record['contribution'] = contribution
+
+# Current estimates ------------------------------------------------------------------------------------------------
+    def alpha(self, worker):
+        '''
+        Hyperparameters of the worker's current confusion matrix. Workers without labels have the prior.
+        '''
+        state = self.workers.get(worker)
+        if state is None:
+            return self.alpha0.copy()
+        return self._alpha(state['Wmean'], state['P'])
+
+    def confusion_matrix(self, worker):
+        '''
+        The worker's current expected confusion matrix, nclasses x nscores.
+        '''
+        alpha = self.alpha(worker)
+        return alpha / np.sum(alpha, axis=1)[:, np.newaxis]
+
+    def posterior(self, subjects):
+        '''
+        Posterior class probabilities of the subjects given their labels so far, len(subjects) x nclasses. Subjects
+        without labels have the expected class proportions.
+        '''
+        pT = np.empty((len(subjects), self.nclasses))
+        for i, subject in enumerate(subjects):
+            lnlik = self.subjects[subject][0] if subject in self.subjects else 0
+            pT[i] = _normalise(self.lnkappa + lnlik)
+        return pT
@@ -1,20 +1,133 @@
 '''
 @author: Edwin Simpson
 '''
-import sys, logging
+import sys, logging, threading, time
 import numpy as np
+from contextlib import nullcontext
 from copy import deepcopy
-from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse import coo_matrix, csr_matrix, diags, isspmatrix_csr
+# the kernels behind csr_matrix.dot, which add the product to an existing output array instead of allocating one
+from scipy.sparse._sparsetools import csr_matvecs, csc_matvecs
 from scipy.special import psi, gammaln
 from ibccdata import DataHandler
+import ibccinit, ibccmemory, ibcctopk
 from scipy.optimize import fmin, fmin_cobyla
 from scipy.stats import gamma
 
+def sparse_dot_add(A, X, out, transpose=False):
+    '''
+    Adds A . X, or A.T . X if transpose is True, to out, where A is a scipy.sparse csr matrix and X and out are
+    C-contiguous float64 arrays. Unlike A.dot(X), no array is allocated for the product.
+    '''
+    nrows, ncols = A.shape
+    if not isspmatrix_csr(A) or not X.flags.c_contiguous or not out.flags.c_contiguous:
+        out += A.T.dot(X) if transpose else A.dot(X)
+    elif transpose:
+        # the rows of a csr matrix are the columns of its transpose in the csc format
+        csc_matvecs(ncols, nrows, X.shape[1], A.indptr, A.indices, A.data, X.ravel(), out.ravel())
+    else:
+        csr_matvecs(nrows, ncols, X.shape[1], A.indptr, A.indices, A.data, X.ravel(), out.ravel())
+
+
+class CancellationToken(object):
+    '''
+    Flag that can be set from another thread to stop a call to combine_classifications. The run stops at the next
+    iteration and returns the current estimates. Unlike IBCC.keeprunning, a token only affects the runs it is passed to.
+    '''
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+
+def label_arrays(labels, table_format=False):
+    '''
+    Splits crowd labels in either of the formats accepted by IBCC.combine_classifications() into the worker, data point,
+    score and weight of each label, dropping labels with missing scores. Weights come from the optional fourth column
+    of the sparse list; missing weights count as 0, and weights default to 1. Returns workers, objects, scores, weights
+    and the number of data points, N.
+    '''
+    if table_format:
+        N = labels.shape[0]
+        objects, workers = np.nonzero(np.isfinite(labels) & (labels >= 0))
+        scores = labels[objects, workers].astype(float)
+        weights = np.ones(len(scores))
+    else:
+        labels = np.asarray(labels, dtype=float)
+        labels = labels[np.isfinite(labels[:, 2]) & (labels[:, 2] >= 0)]
+        workers = labels[:, 0].astype(int)
+        objects = labels[:, 1].astype(int)
+        scores = labels[:, 2]
+        if labels.shape[1] > 3:
+            weights = labels[:, 3].copy()
+            weights[np.isnan(weights)] = 0
+        else:
+            weights = np.ones(len(scores))
+        N = int(np.max(objects)) + 1 if len(objects) else 0
+    return workers, objects, scores, weights, N
+
+
+def split_scores(workers, objects, scores, weights, nscores):
+    '''
+    Splits each score between two integers into a label for each of them, weighted by how close the score is to each,
+    as in IBCC._preprocess_crowdlabels. Returns the workers, objects, integer scores and weights of the labels.
+    '''
+    lower = np.minimum(np.floor(scores).astype(int), nscores - 1)
+    frac = np.clip(scores - lower, 0, 1)
+    split = frac > 0
+    workers = np.concatenate((workers, workers[split]))
+    objects = np.concatenate((objects, objects[split]))
+    scores = np.concatenate((lower, np.minimum(lower[split] + 1, nscores - 1)))
+    weights = np.concatenate((weights * (1 - frac), weights[split] * frac[split]))
+    return workers, objects, scores, weights
+
+
+def score_labels(table, lnkappa, workers, objects, scores, N, weights=None):
+    '''
+    Posterior class probabilities for N objects given their labels and a frozen model. table is the K+1 x nscores x
+    nclasses array from IBCC.lnpi_lookup_table(); worker IDs outside 0..K-1 use its last row, i.e. the prior. lnkappa
+    holds the expected log class proportions. weights optionally gives a weight for each label, e.g. a count of
+    repeats. Labels with missing (NaN or negative) scores are ignored. Returns an N x nclasses array.
+    '''
+    K, nscores, nclasses = table.shape
+    K -= 1
+    scores = np.asarray(scores, dtype=float)
+    weights = np.ones(len(scores)) if weights is None else np.asarray(weights, dtype=float)
+    valid = np.isfinite(scores) & (scores >= 0)
+    if not np.all(valid):
+        workers = workers[valid]
+        objects = objects[valid]
+        scores = scores[valid]
+        weights = weights[valid]
+    workers, objects, scores, weights = split_scores(workers, objects, scores, weights, nscores)
+    rows = np.where((workers >= 0) & (workers < K), workers, K)
+    lnp_labels = table[rows, scores, :] * weights[:, np.newaxis]
+
+    lnjoint = np.empty((N, nclasses))
+    for j in range(nclasses):
+        lnjoint[:, j] = np.bincount(objects, weights=lnp_labels[:, j], minlength=N)
+    lnjoint += np.reshape(lnkappa, (1, nclasses))
+    lnjoint -= np.max(lnjoint, axis=1)[:, np.newaxis]
+    pT = np.exp(lnjoint)
+    pT /= np.sum(pT, axis=1)[:, np.newaxis]
+    return pT
+
+
 class IBCC(object):
 # Print extra debug info
     verbose = False
     keeprunning = True # set to false causes the combine_classifications method to exit without completing if another 
     # thread is checking whether IBCC is taking too long. Probably won't work well if the optimize_hyperparams is true.    
+    # Per-run controls for stopping early; see combine_classifications(). stop_reason records why the last run ended.
+    iteration_callback = None
+    time_budget = None
+    cancel_token = None
+    run_start = None
+    stop_reason = None
 # Configuration for variational Bayes (VB) algorithm for approximate inference -------------------------------------
     # determine convergence by calculating lower bound? Quicker to set=False so we check convergence of target variables
     uselowerbound = False
@@ -22,12 +135,53 @@ class IBCC(object):
     max_iterations = 500
     conv_threshold = 1e-5
     conv_check_freq = 2
+    # Reuse work buffers that are allocated once per run instead of creating new temporary arrays in each iteration.
+    # Keeps memory use flat for large N and gives the same results as the default updates. With both the sparse list and
+    # table formats, no N x nclasses array is created per score; with label_dtype=np.float32 and the sparse list, each
+    # product still makes a float64 copy of one score's labels. Has no effect with topk, which uses its own sparse updates.
+    inplace_updates = False
+    supports_inplace_updates = True # False for subclasses whose updates do not use the work buffers
+    workspace = None
+    # Set to an ibccprofile.PhaseProfiler to record the time and peak memory of each phase of combine_classifications
+    profiler = None
+    # Set to an ibcccache.ResultCache to reuse the results of earlier runs with identical inputs and settings
+    result_cache = None
+    # Settings that change the result, in addition to the priors, hashed by the result cache. Subclasses add their own.
+    cache_settings = ('nclasses', 'nscores', 'uselowerbound', 'use_ml', 'conv_threshold', 'conv_check_freq',
+                      'min_iterations', 'max_iterations', 'discretedecisions', 'clusteridxs_alpha0', 'init_method',
+                      'fixed_lnkappa', 'topk', 'label_dtype', 'memory_limit')
+    # Limit in bytes on the estimated memory for a run. If the current settings would exceed it, the run stores the
+    # crowd labels as float32 and, if that is smaller, uses the in-place updates; if that is still too much, a
+    # MemoryError is raised before the large arrays are allocated. The settings are restored after the run. See
+    # ibccmemory.py.
+    memory_limit = None
+    label_dtype = np.float64 # type used to store the crowd labels in C
+    memory_report_attrs = ibccmemory.COMBINER_ATTRS
+    # The trained parameters and expectations that describe the model after a run, saved by ibcccache.ResultCache.
+    # Subclasses with other parameters replace them.
+    model_attrs = ('alpha', 'nu', 'lnPi', 'lnkappa')
+    # Workers' parameters are independent given kappa, so ibccparallel can solve connected components separately
+    independent_workers = True
+    # If set, the expected log class proportions are held at these values instead of being updated from E_t, e.g. when
+    # separate parts of a data set are solved independently and kappa is updated over all of them (see ibccparallel.py)
+    fixed_lnkappa = None
+    # How the targets are initialised: 'votes' uses the crowd's votes plus nu0; 'spectral' estimates each worker's
+    # accuracy from their agreement with the other workers, which copes with adversarial workers (see ibccinit.py)
+    init_method = 'votes'
+    # If set, only the top k classes of each data point are kept in E_t, as a scipy.sparse matrix, with the mass of the
+    # other classes in E_t_residual. For problems with many classes; needs the sparse list input (see ibcctopk.py).
+    topk = None
+    E_t_residual = None
+    topk_labels = None # the entries of C sorted by data point, used with topk
     
 # Data set attributes -----------------------------------------------------------------------------------------------
     discretedecisions = False  # If true, decisions are rounded to discrete integers. If false, you can submit undecided
     # responses as fractions between two classes. E.g. 2.3 means that 0.3 of the decision will go to class 3, and 0.7
     # will go to class 2. Only neighbouring classes can have uncertain decisions in this way.
     table_format_flag = False  
+    # Collapse repeated (worker, object, score) rows of a sparse list into one weighted entry before building C. A
+    # fourth column in the sparse list gives a weight for each row, e.g. the number of times it was repeated.
+    compact_duplicates = True
     nclasses = None
     nscores = None
     K = None
@@ -160,6 +314,38 @@ class IBCC(object):
             logging.debug('Nu0: ' + str(self.nu0))
         if self.nu ==[] or force_reset:
             self._init_lnkappa()
+        self._init_workspace()
+
+
+    def _init_workspace(self):
+        '''
+        Allocates the work buffers used by the in-place VB updates. Buffers are kept between runs and only reallocated
+        when the number of data points or test points changes.
+        '''
+        if not self.inplace_updates or self.topk is not None:
+            return
+        if self.testidxs is not None:
+            test_rows = np.flatnonzero(self.testidxs)
+        else:
+            test_rows = None
+        Ntest = self.N if test_rows is None else len(test_rows)
+        ws = self.workspace
+        Ndot = self.N if self.table_format_flag else 0
+        if ws is None or ws['oldET'].shape != (self.N, self.nclasses) or ws['rowbuf'].shape[0] != Ntest \
+                or ws['dotbuf'].shape[0] != Ndot:
+            ws = {}
+            ws['oldET'] = np.zeros((self.N, self.nclasses)) # copy of E_t for the convergence check
+            ws['testbuf'] = np.zeros((Ntest, self.nclasses)) # values for the test points only
+            ws['rowbuf'] = np.zeros(Ntest) # row maxima and normalisation constants
+            # products of dense crowd label tables with lnPi; the sparse products are added to their output directly
+            ws['dotbuf'] = np.zeros((Ndot, self.nclasses))
+            ws['countbuf'] = np.zeros((self.K, self.nclasses)) # counts for each worker
+            ws['lnpibuf'] = np.zeros((self.K, self.nclasses)) # lnPi for one score, contiguous for the sparse products
+            self.workspace = ws
+        elif ws['countbuf'].shape[0] != self.K:
+            ws['countbuf'] = np.zeros((self.K, self.nclasses))
+            ws['lnpibuf'] = np.zeros((self.K, self.nclasses))
+        ws['test_rows'] = test_rows
 
 
     def _init_lnkappa(self):
@@ -206,6 +392,9 @@ class IBCC(object):
 
 
     def _init_t(self):
+        if self.topk is not None:
+            self._init_t_topk()
+            return
         if np.any(self.E_t):
             if self.sparse:
                 oldE_t = self.E_t_sparse
@@ -221,11 +410,13 @@ class IBCC(object):
         # initialise t to the vote distributions
         self.E_t = np.zeros((self.N, self.nclasses)) + self.nu0.T
         for l in range(self.nclasses):
-            self.E_t[:, l] += np.sum(self.C[l], axis=1)
+            self.E_t[:, l] += self._votes(l)
         self.E_t /= np.sum(self.E_t, axis=1)[:, None]
 
         if np.any(oldE_t):
-            self.E_t[0:Nold, :] = oldE_t[0:Nold, :]
+            # rows without a previous estimate, e.g. new data points after a warm start, are NaN and keep the votes
+            known = np.all(np.isfinite(oldE_t[0:Nold, :]), axis=1)
+            self.E_t[0:Nold, :][known] = oldE_t[0:Nold, :][known]
         uncert_trainidxs = self.trainidxs.copy()  # look for labels that are not discrete values of valid classes
         for j in range(self.nclasses):
             # training labels
@@ -248,6 +439,37 @@ class IBCC(object):
             self.E_t_sparse = self.E_t # current working version is a sparse set of observations of the complete space of data points            
 
 
+    def _votes(self, l):
+        '''
+        Returns the total weight of the crowd labels with score l that each data point received.
+        '''
+        return np.asarray(self.C[l].sum(axis=1)).reshape(-1)
+
+
+    def _init_spectral(self):
+        '''
+        Replaces the vote-based initial targets with the method-of-moments estimate from ibccinit.py: the posterior
+        hyperparameters are updated from the estimated targets, then E_t is updated from the resulting confusion
+        matrices. Using the model's own update lets subclasses with other parameters share this initialisation.
+        '''
+        if self.nscores != self.nclasses or self.topk is not None:
+            logging.info('IBCC: the spectral initialisation needs one score per class and dense targets; using the '
+                         'votes instead.')
+            return
+        self.E_t = ibccinit.spectral_targets(self._worker_label_matrices(), self.nscores, self.E_t, self.trainidxs)
+        self._post_alpha()
+        self._expec_lnpi(self.use_ml)
+        self._expec_t()
+        if self.sparse:
+            self.E_t_sparse = self.E_t
+
+    def _worker_label_matrices(self):
+        '''
+        Returns the crowd labels as a dictionary of N x K matrices, one per score, as used by ibccinit.py.
+        '''
+        return self.C
+
+
 # Data preprocessing and helper functions --------------------------------------------------------------------------
     def _desparsify_crowdlabels(self, crowdlabels):
         '''
@@ -328,6 +550,11 @@ class IBCC(object):
     def _preprocess_crowdlabels(self, crowdlabels):
         # Initialise all objects relating to the crowd labels.
         C = {}
+        weights = None
+        if not self.table_format_flag and crowdlabels.shape[1] > 3:
+            # keep the weights apart so that missing weights are not read as -1 and weights are not rounded
+            weights = crowdlabels[:, 3].astype(float)
+            crowdlabels = crowdlabels[:, :3]
         crowdlabels[np.isnan(crowdlabels)] = -1
         if self.discretedecisions:
             crowdlabels = np.round(crowdlabels).astype(int)
@@ -335,7 +562,7 @@ class IBCC(object):
             # column=classifier ID, 2nd column = obj ID, 3rd column = score.
             self.K = crowdlabels.shape[1]
             for l in range(self.nscores):
-                Cl = np.zeros((self.N, self.K))
+                Cl = np.zeros((self.N, self.K), dtype=self.label_dtype)
                 #crowd labels may not be supplied for all N data points in the gold labels, so use argwhere
                 lidxs = np.argwhere(crowdlabels==l)
                 Cl[lidxs[:,0], lidxs[:,1]] = 1
@@ -350,27 +577,28 @@ class IBCC(object):
         else:
             if self.K < int(np.nanmax(crowdlabels[:,0]))+1:
                 self.K = int(np.nanmax(crowdlabels[:,0]))+1 # add one because indexes start from 0
+            workers, objects, scores, weights = self._compact_crowdlabels(crowdlabels, weights)
             for l in range(self.nscores):
-                lIdxs = np.argwhere(crowdlabels[:, 2] == l)[:,0]
-                data = np.ones((len(lIdxs), 1)).reshape(-1)
-                rows = np.array(crowdlabels[lIdxs, 1]).reshape(-1)
-                cols = np.array(crowdlabels[lIdxs, 0]).reshape(-1)
+                lIdxs = scores == l
+                data = weights[lIdxs]
+                rows = objects[lIdxs]
+                cols = workers[lIdxs]
                 
                 if not self.discretedecisions:
-                    partly_l_idxs = np.bitwise_and(crowdlabels[:, 2] > l, crowdlabels[:, 2] < l + 1)  # partly above l
-                    data = np.concatenate((data, (l + 1) - crowdlabels[partly_l_idxs, 2]))
-                    rows = np.concatenate((rows, crowdlabels[partly_l_idxs, 1].reshape(-1)))
-                    cols = np.concatenate((cols, crowdlabels[partly_l_idxs, 0].reshape(-1)))
+                    partly_l_idxs = np.bitwise_and(scores > l, scores < l + 1)  # partly above l
+                    data = np.concatenate((data, weights[partly_l_idxs] * ((l + 1) - scores[partly_l_idxs])))
+                    rows = np.concatenate((rows, objects[partly_l_idxs]))
+                    cols = np.concatenate((cols, workers[partly_l_idxs]))
                     
-                    partly_l_idxs = np.bitwise_and(crowdlabels[:, 2] < l, crowdlabels[:, 2] > l - 1)  # partly below l
-                    data = np.concatenate((data, crowdlabels[partly_l_idxs, 2] - l + 1))
-                    rows = np.concatenate((rows, crowdlabels[partly_l_idxs, 1].reshape(-1)))
-                    cols = np.concatenate((cols, crowdlabels[partly_l_idxs, 0].reshape(-1)))
-                Cl = csr_matrix(coo_matrix((data,(rows,cols)), shape=(self.N, self.K)))
+                    partly_l_idxs = np.bitwise_and(scores < l, scores > l - 1)  # partly below l
+                    data = np.concatenate((data, weights[partly_l_idxs] * (scores[partly_l_idxs] - l + 1)))
+                    rows = np.concatenate((rows, objects[partly_l_idxs]))
+                    cols = np.concatenate((cols, workers[partly_l_idxs]))
+                Cl = csr_matrix(coo_matrix((data.astype(self.label_dtype), (rows,cols)), shape=(self.N, self.K)))
                 C[l] = Cl
         # Set and reset object properties for the new dataset
         self.C = C
-        self.lnpCT = np.zeros((self.N, self.nclasses))
+        self.lnpCT = np.zeros((self.N, self.nclasses)) if self.topk is None else None
         self.conf_mat_ind = []
         # pre-compute the indices into the pi arrays
         # repeat for test labels only
@@ -387,11 +615,51 @@ class IBCC(object):
         self.alpha_tr = None
 
 
+    def _compact_crowdlabels(self, crowdlabels, weights=None):
+        '''
+        Splits a sparse list of crowd labels into worker, object, score and weight arrays, dropping missing scores and
+        zero or missing weights. If compact_duplicates is set, rows with the same worker, object and score are merged
+        into one entry whose weight is the sum of their weights. Weights are given separately or come from the optional
+        fourth column, and default to 1.
+        '''
+        if weights is None and crowdlabels.shape[1] > 3:
+            weights = crowdlabels[:, 3]
+        if weights is not None:
+            weights = np.array(weights, dtype=float)
+            weights[np.isnan(weights)] = 0
+            valid = (crowdlabels[:, 2] > -1) & (weights != 0)
+            weights = weights[valid]
+        else:
+            valid = crowdlabels[:, 2] > -1
+            weights = np.ones(np.sum(valid))
+        workers = crowdlabels[valid, 0].astype(int)
+        objects = crowdlabels[valid, 1].astype(int)
+        scores = crowdlabels[valid, 2]
+        if not self.compact_duplicates or len(scores) < 2:
+            return workers, objects, scores, weights
+
+        order = np.lexsort((scores, workers, objects))
+        workers = workers[order]
+        objects = objects[order]
+        scores = scores[order]
+        starts = np.ones(len(scores), dtype=bool)
+        starts[1:] = (workers[1:] != workers[:-1]) | (objects[1:] != objects[:-1]) | (scores[1:] != scores[:-1])
+        starts = np.flatnonzero(starts)
+        if len(starts) == len(scores):
+            return workers, objects, scores, weights[order]
+        logging.debug('IBCC: merged %i crowd labels into %i weighted entries' % (len(scores), len(starts)))
+        weights = np.add.reduceat(weights[order], starts)
+        return workers[starts], objects[starts], scores[starts], weights
+
+
     def _resparsify_t(self):
         '''
         Puts the expectations of target values, E_t, at the points we observed crowd labels back to their original 
         indexes in the output array. Values are inserted for the unobserved indices using only kappa (class proportions).
         '''
+        if self.topk is not None:
+            self._resparsify_t_topk()
+            return
         E_t_full = np.zeros((self.full_N, self.nclasses))
         E_t_full[:] = (np.exp(self.lnkappa) / np.sum(np.exp(self.lnkappa),axis=0)).T
         E_t_full[self.observed_idxs,:] = self.E_t
@@ -401,7 +669,7 @@ class IBCC(object):
 
 # Run the inference algorithm --------------------------------------------------------------------------------------
     def combine_classifications(self, crowdlabels, goldlabels=None, testidxs=None, optimise_hyperparams=0, maxiter=200, 
-                                table_format=False):
+                                table_format=False, callback=None, time_budget=None, cancel_token=None):
         '''
         Takes crowdlabels in either sparse list or table formats, along with optional training labels (goldlabels)
         and applies data-preprocessing steps before running inference for the model parameters and target labels.
@@ -418,7 +686,9 @@ class IBCC(object):
             The N_labels x 3 array is a sparse format and is more compact if most data points are 
             only labelled by a small subset of workers. Each row represents a label, where the first column is the 
             worker/agent/base classifier ID, the second column is the data point ID, and the third column is the label
-            that was assigned by that worker to that data point. 
+            that was assigned by that worker to that data point. An optional fourth column gives a weight for each
+            row, such as the number of times the same label was given; rows with the same worker, data point and score
+            are merged by adding their weights. 
             
             The N_data_points x N_workers array is a matrix where each row corresponds to a data point and each column
             to a worker/agent/base classifier. Any missing entries should be np.NaN or -1. To use this matrix as 
@@ -436,6 +706,16 @@ class IBCC(object):
         table_format : bool
             Set this to true if the crowdlabels are a matrix with rows corresponding to data points and columns 
             corresponding to workers. 
+        callback : function
+            Optional function called after every VB iteration as callback(nIts, change, L), where nIts is the number of
+            iterations completed, change is the last convergence measure (np.inf until it is first checked) and L is the
+            last value of the lower bound (None if the lower bound is not used). Return True to stop the run.
+        time_budget : float
+            Optional limit in seconds on the time taken by this call. The budget is checked between iterations, so the
+            run stops at the first iteration boundary after it runs out. If the lower bound is being used, the target
+            values from the iteration with the highest lower bound are returned.
+        cancel_token : CancellationToken
+            Optional token that can be cancelled from another thread to stop the run at the next iteration.
         
         Returns
         -------
@@ -445,30 +725,228 @@ class IBCC(object):
         
         '''
         self.table_format_flag = table_format
+        self.iteration_callback = callback
+        self.time_budget = time_budget
+        self.cancel_token = cancel_token
+        self.run_start = time.monotonic()
         oldK = self.K
-        crowdlabels = self._desparsify_crowdlabels(crowdlabels)
-        self._preprocess_goldlabels(goldlabels)        
-        self._set_test_and_train_idxs(testidxs)
-        self._preprocess_crowdlabels(crowdlabels)
-        self._init_t()
-
-        #Check that we have the right number of agents/base classifiers, K, and initialise parameters if necessary
-        if self.K != oldK or not np.any(self.nu) or not np.any(self.alpha):  # data shape has changed or not initialised yet
-            self._init_params()  
-
-        # Either run the model optimisation or just use the inference method with fixed hyper-parameters  
-        if optimise_hyperparams==1 or optimise_hyperparams=='ML':
-            self.optimize_hyperparams(maxiter=maxiter)
-        elif optimise_hyperparams==2 or optimise_hyperparams=='MAP':
-            self.optimize_hyperparams(maxiter=maxiter, use_MAP=True)
-        else:
-            self._run_inference() 
-        if self.sparse:
-            self._resparsify_t()
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache.key(self, crowdlabels, goldlabels, testidxs, table_format,
+                                              optimise_hyperparams, maxiter)
+            if self._load_cached_result(cache_key):
+                return self.E_t
+        if self.inplace_updates and not self.supports_inplace_updates:
+            raise ValueError('%s does not support inplace_updates.' % type(self).__name__)
+        if self.profiler is not None:
+            self.profiler.start_run(type(self).__name__)
+        saved_settings = {}
+        try:
+            with self._phase('desparsify'):
+                crowdlabels = self._desparsify_crowdlabels(crowdlabels)
+            with self._phase('gold_preprocessing'):
+                self._preprocess_goldlabels(goldlabels)
+                self._set_test_and_train_idxs(testidxs)
+            with self._phase('crowd_preprocessing'):
+                if self.memory_limit is not None:
+                    saved_settings = self._apply_memory_limit(crowdlabels)
+                self._preprocess_crowdlabels(crowdlabels)
+            with self._phase('init'):
+                self._init_t()
+                #Check that we have the right number of agents/base classifiers, K, and initialise parameters if necessary
+                if self.K != oldK or not np.any(self.nu) or not np.any(self.alpha):  # data shape has changed or not initialised yet
+                    self._init_params()  
+                else:
+                    self._init_workspace()
+                if self.init_method == 'spectral':
+                    self._init_spectral()
+
+            # Either run the model optimisation or just use the inference method with fixed hyper-parameters  
+            if optimise_hyperparams==1 or optimise_hyperparams=='ML':
+                self.optimize_hyperparams(maxiter=maxiter)
+            elif optimise_hyperparams==2 or optimise_hyperparams=='MAP':
+                self.optimize_hyperparams(maxiter=maxiter, use_MAP=True)
+            else:
+                self._run_inference() 
+            if self.sparse:
+                with self._phase('resparsify'):
+                    self._resparsify_t()
+        finally:
+            for name, value in saved_settings.items():
+                setattr(self, name, value)
+            if self.profiler is not None:
+                self.profiler.end_run()
+        # only complete runs are cached; runs stopped early by a time budget, cancellation etc. are not reproducible
+        if cache_key is not None and self.stop_reason in ('converged', 'max_iterations', None) and self.topk is None:
+            self.result_cache.store(cache_key, self)
         return self.E_t      
 
 
+    def _load_cached_result(self, cache_key):
+        '''
+        Restores the results of an earlier run from the result cache. Returns False if there is no cached result.
+        '''
+        cached = self.result_cache.load(cache_key)
+        if cached is None:
+            return False
+        logging.info('IBCC: using cached result %s' % cache_key)
+        self.E_t = cached['E_t']
+        for name in self.model_attrs:
+            setattr(self, name, cached[name])
+        self.nIts = 0
+        self.stop_reason = 'cached'
+        return True
+
+
+    def _phase(self, name, iteration=None):
+        '''
+        Context manager that times a phase of the run if a profiler is attached.
+        '''
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, iteration)
+
+
+    def profile_report(self):
+        '''
+        Returns the timings, call counts and peak memory for each phase of the last run, or None if no profiler is
+        attached. See ibccprofile.PhaseProfiler.report().
+        '''
+        if self.profiler is None:
+            return None
+        return self.profiler.report()
+
+
+# Memory accounting ------------------------------------------------------------------------------------------------
+    def estimate_memory(self, N, K, nlabels, Ntest=None, table_format=None, label_dtype=None, inplace_updates=None):
+        '''
+        Estimates the bytes needed to run this combiner on a data set with N data points, K workers and nlabels crowd
+        labels, using the current settings unless label_dtype or inplace_updates are given. See
+        ibccmemory.estimate_memory().
+        '''
+        if table_format is None:
+            table_format = self.table_format_flag
+        if label_dtype is None:
+            label_dtype = self.label_dtype
+        if inplace_updates is None:
+            inplace_updates = self.inplace_updates
+        return ibccmemory.estimate_memory(N, K, nlabels, self.nclasses, self.nscores, Ntest, table_format,
+                                          np.dtype(label_dtype).itemsize, inplace_updates)
+
+    def memory_report(self, dh=None):
+        '''
+        Returns the bytes currently held by each of the combiner's large arrays and, if dh is given, by the
+        DataHandler's arrays and maps. See ibccmemory.memory_report().
+        '''
+        return ibccmemory.memory_report(self, dh)
+
+    def _apply_memory_limit(self, crowdlabels):
+        '''
+        Chooses the settings with the smallest estimated memory for the current data set if the current settings do
+        not fit within memory_limit. Returns the previous values of the settings that were changed, so that
+        combine_classifications can restore them after the run.
+        '''
+        if self.table_format_flag:
+            K = crowdlabels.shape[1]
+            nlabels = np.sum(np.isfinite(crowdlabels))
+        else:
+            K = max(self.K, int(np.nanmax(crowdlabels[:, 0])) + 1)
+            nlabels = crowdlabels.shape[0]
+        Ntest = self.Ntest if self.testidxs is not None else None
+        peak = self.estimate_memory(self.N, K, nlabels, Ntest)['peak']
+        if peak <= self.memory_limit:
+            return {}
+        candidates = [(np.float32, self.inplace_updates)]
+        if self.supports_inplace_updates and self.topk is None:
+            candidates.append((np.float32, not self.inplace_updates))
+        peaks = [self.estimate_memory(self.N, K, nlabels, Ntest, label_dtype=label_dtype,
+                                      inplace_updates=inplace_updates)['peak']
+                 for label_dtype, inplace_updates in candidates]
+        best = int(np.argmin(peaks))
+        if peaks[best] > self.memory_limit:
+            raise MemoryError('IBCC needs an estimated %i bytes for %i data points, %i workers and %i labels, but '
+                              'memory_limit is %i bytes.' % (peaks[best], self.N, K, nlabels, self.memory_limit))
+        label_dtype, inplace_updates = candidates[best]
+        logging.info('IBCC: estimated memory %i bytes exceeds the limit of %i bytes; using %i bytes with float32 crowd '
+                     'labels and inplace_updates=%s for this run' % (peak, self.memory_limit, peaks[best],
+                                                                     inplace_updates))
+        saved_settings = {'label_dtype': self.label_dtype, 'inplace_updates': self.inplace_updates}
+        self.label_dtype = label_dtype
+        self.inplace_updates = inplace_updates
+        return saved_settings
+
+# Prediction with a frozen model -----------------------------------------------------------------------------------
+    def _prior_lnpi(self):
+        '''
+        Expected log confusion matrix under the prior, alpha0, used for workers that were not seen in training. Where
+        alpha0 has one matrix per worker, the first one is used, as in _init_lnPi for new agents.
+        '''
+        alpha0 = self.alpha0 if self.alpha0.ndim == 2 else self.alpha0[:, :, 0]
+        alpha0 = np.asarray(alpha0, dtype=float)
+        return psi(alpha0) - psi(np.sum(alpha0, axis=1))[:, np.newaxis]
+
+
+    def _frozen_lnpi(self):
+        '''
+        Returns the trained expected log confusion matrices as an nclasses x nscores x K array, one for each worker.
+        '''
+        return self.lnPi
+
+
+    def lnpi_lookup_table(self):
+        '''
+        Returns the trained expected log confusion matrices as a K+1 x nscores x nclasses array, so that the values for
+        a worker and score can be gathered as one contiguous row. The final row, K, holds the values under the prior for
+        workers that were not seen in training.
+        '''
+        if not np.any(self.lnPi) or not np.any(self.nu):
+            raise ValueError('The model must be trained with combine_classifications() before it can score new data.')
+        lnPi = self._frozen_lnpi()
+        K = lnPi.shape[2]
+        table = np.empty((K + 1, self.nscores, self.nclasses))
+        table[:K] = lnPi.transpose((2, 1, 0))
+        table[K] = self._prior_lnpi().T
+        return table
+
+
+    def predict_proba(self, new_labels, table_format=False):
+        '''
+        Scores new data points using the trained model without updating it. Each data point's log joint probability is
+        lnkappa plus the sum of the trained lnPi entries for the labels it has received, so this needs only one gather
+        and one sum over the labels. Workers with IDs that were not seen in training use the expectation of lnPi under
+        alpha0. Call combine_classifications() first to train the model.
+
+        Parameters
+        ----------
+
+        new_labels : N_labels x 3 (or 4) numpy array or N_data_points x N_workers numpy array
+            Crowd labels for the new data points in the same formats accepted by combine_classifications(). Worker IDs
+            must be the same as in training. Data point IDs index the rows of the output; data points without any labels
+            receive the class proportions.
+        table_format : bool
+            Set this to true if new_labels is a matrix with rows corresponding to data points and columns corresponding
+            to workers.
+
+        Returns
+        -------
+
+        pT : N_data_points x nclasses numpy array
+            Posterior class probabilities for each new data point.
+        '''
+        table = self.lnpi_lookup_table()
+        workers, objects, scores, weights, N = label_arrays(new_labels, table_format)
+        return score_labels(table, self.lnkappa, workers, objects, scores, N, weights)
+
+
     def _convergence_measure(self, oldET):
+        if self.topk is not None:
+            diff = abs(oldET - self.E_t)
+            return np.max(diff.data) if diff.nnz else 0
+        if self.inplace_updates:
+            # oldET is a work buffer, so we can overwrite it with the differences
+            np.subtract(oldET, self.E_t, out=oldET)
+            np.abs(oldET, out=oldET)
+            return np.max(oldET)
         return np.max(np.abs(oldET - self.E_t))
 
 
@@ -476,6 +954,19 @@ class IBCC(object):
         return (self.nIts>=self.max_iterations or self.change<self.conv_threshold) and self.nIts>self.min_iterations        
 
 
+    def _early_stop(self, deadline):
+        '''
+        Returns the reason for stopping the run before convergence, or None if it should continue.
+        '''
+        if not self.keeprunning:
+            return 'keeprunning'
+        if self.cancel_token is not None and self.cancel_token.is_cancelled():
+            return 'cancelled'
+        if deadline is not None and time.monotonic() >= deadline:
+            return 'time_budget'
+        return None
+
+
     def _run_inference(self):   
         '''
         Variational approximate inference. Assumes that all data and hyper-parameters are ready for use. Overwrite
@@ -484,27 +975,55 @@ class IBCC(object):
         logging.info('IBCC: combining %i training points + %i noisy-labelled points' % (np.sum(self.trainidxs), 
                                                                                         len(self.observed_idxs)))
         oldL = -np.inf
+        L = None
+        self.change = np.inf
         converged = False
         self.nIts = 0 #object state so we can check it later
-        while not converged and self.keeprunning:
-            oldET = self.E_t.copy()
+        self.stop_reason = None
+        # keep the best target values seen so far in case we run out of time
+        deadline = None
+        if self.time_budget is not None:
+            run_start = self.run_start if self.run_start is not None else time.monotonic()
+            deadline = run_start + self.time_budget
+        best_L = -np.inf
+        best_ET = None
+        while not converged:
+            self.stop_reason = self._early_stop(deadline)
+            if self.stop_reason is not None:
+                break
+            if self.inplace_updates and self.topk is None:
+                oldET = self.workspace['oldET']
+                np.copyto(oldET, self.E_t)
+            else:
+                oldET = self.E_t.copy()
 
             #update params
-            self._expec_lnkappa(self.use_ml)
-            if np.any(self.E_t):
-                self._post_alpha()
-            self._expec_lnpi(self.use_ml)
+            with self._phase('expec_lnkappa', self.nIts):
+                if self.fixed_lnkappa is None:
+                    self._expec_lnkappa(self.use_ml)
+                else:
+                    self.lnkappa = self.fixed_lnkappa
+            if self.topk is not None or np.any(self.E_t):
+                with self._phase('post_alpha', self.nIts):
+                    self._post_alpha()
+            with self._phase('expec_lnpi', self.nIts):
+                self._expec_lnpi(self.use_ml)
 
-            self._expec_t()
+            with self._phase('expec_t', self.nIts):
+                self._expec_t()
 
             #check convergence every x iterations
             if np.mod(self.nIts, self.conv_check_freq) == self.conv_check_freq - 1:
                 if self.uselowerbound:
-                    L = self.lowerbound()
+                    with self._phase('lowerbound', self.nIts):
+                        L = self.lowerbound()
                     if self.verbose:
                         logging.debug('Lower bound: ' + str(L) + ', increased by ' + str(L - oldL))
                     self.change = (L - oldL) / np.abs(L)
                     oldL = L
+                    if deadline is not None and L > best_L:
+                        best_L = L
+                        best_ET = self.E_t.copy()
                     if self.change < - self.conv_threshold * np.abs(L) and self.verbose:                
                         logging.warning('IBCC iteration %i absolute change was %s. Possible bug or rounding error?' 
                                         % (self.nIts, self.change))                    
@@ -516,12 +1035,25 @@ class IBCC(object):
                     logging.debug('IBCC iteration %i absolute change was %s' % (self.nIts, self.change))
                     
             self.nIts+=1
-            
+
+            if self.iteration_callback is not None and self.iteration_callback(self.nIts, self.change, L):
+                self.stop_reason = 'callback'
+                break
+
+        if converged:
+            self.stop_reason = 'max_iterations' if self.nIts >= self.max_iterations else 'converged'
+        else:
+            logging.info('IBCC stopped before convergence: %s' % self.stop_reason)
+            if best_ET is not None and best_L > L:
+                self.E_t = best_ET
         logging.info('IBCC finished in %i iterations (max iterations allowed = %i).' % (self.nIts, self.max_iterations))
 
 
 # Posterior Updates to Hyperparameters --------------------------------------------------------------------------------
     def _post_alpha(self):  # Posterior Hyperparams
+        if self.topk is not None:
+            self._post_alpha_topk()
+            return
         # Save the counts from the training data so we only recalculate the test data on every iteration
         if self.alpha_tr is None:
             self.alpha_tr = np.zeros(self.alpha.shape)
@@ -531,6 +1063,9 @@ class IBCC(object):
                         Tj = self.E_t[self.trainidxs, j].reshape((self.Ntrain, 1))
                         self.alpha_tr[j,l,:] = self.C[l][self.trainidxs,:].T.dot(Tj).reshape(-1)
             self.alpha_tr += self.alpha0
+        if self.inplace_updates:
+            self._post_alpha_inplace()
+            return
         # Add the counts from the test data
         for j in range(self.nclasses):
             for l in range(self.nscores):
@@ -544,13 +1079,186 @@ class IBCC(object):
                 self.alpha[j, l, :] = self.alpha_tr[j, l, :] + counts
 
 
+    def _post_alpha_inplace(self):
+        # Add the counts from the test data for all classes at once, gathering the test rows of E_t into a work buffer
+        ws = self.workspace
+        if ws['test_rows'] is not None:
+            ET = ws['testbuf']
+            np.take(self.E_t, ws['test_rows'], axis=0, out=ET)
+        else:
+            ET = self.E_t
+        counts = ws['countbuf']
+        for l in range(self.nscores):
+            if self.table_format_flag:
+                np.dot(self.Ctest[l].T, ET, out=counts)
+            else:
+                counts.fill(0)
+                sparse_dot_add(self.Ctest[l], ET, counts, transpose=True)
+            np.add(self.alpha_tr[:, l, :], counts.T, out=self.alpha[:, l, :])
+
+
+# Top-k sparse posteriors ---------------------------------------------------------------------------------------------
+    def _init_topk_labels(self):
+        '''
+        Lists the entries of C sorted by data point, so that the labels of any data point can be gathered directly.
+        '''
+        objects = []
+        workers = []
+        scores = []
+        weights = []
+        for l in range(self.nscores):
+            Cl = self.C[l].tocoo()
+            objects.append(Cl.row)
+            workers.append(Cl.col)
+            scores.append(np.zeros(Cl.nnz, dtype=int) + l)
+            weights.append(Cl.data.astype(float))
+        objects = np.concatenate(objects)
+        order = np.argsort(objects, kind='stable')
+        self.topk_labels = {
+            'objects': objects[order],
+            'workers': np.concatenate(workers)[order],
+            'scores': np.concatenate(scores)[order],
+            'weights': np.concatenate(weights)[order],
+            'indptr': np.concatenate(([0], np.cumsum(np.bincount(objects, minlength=self.N)))),
+        }
+
+
+    def _gold_topk(self, E_t, residual):
+        '''
+        Replaces the rows of the training data points with their gold labels, which are split between two neighbouring
+        classes if they are fractional.
+        '''
+        if not self.Ntrain:
+            return E_t, residual
+        train = np.flatnonzero(self.trainidxs)
+        gold = self.goldlabels[train]
+        lower = np.floor(gold).astype(int)
+        frac = gold - lower
+        split = frac > 0
+        rows = np.concatenate((train, train[split]))
+        cols = np.concatenate((lower, lower[split] + 1))
+        values = np.concatenate((1 - frac, frac[split]))
+        gold_E_t = csr_matrix(coo_matrix((values, (rows, cols)), shape=(self.N, self.nclasses)))
+        test_rows = diags((~self.trainidxs).astype(float))
+        E_t = test_rows.dot(E_t) + gold_E_t
+        E_t.eliminate_zeros()
+        residual = residual.copy()
+        residual[train] = 0
+        return E_t, residual
+
+
+    def _init_t_topk(self):
+        '''
+        Initialises the top-k posteriors to the vote distributions plus nu0, as in _init_t. The candidates for each data
+        point are the classes it received votes for and the k classes with the largest nu0.
+        '''
+        if self.table_format_flag:
+            raise ValueError('IBCC.topk needs the crowd labels in the sparse list format.')
+        if self.uselowerbound:
+            logging.info('IBCC: the lower bound is not computed with topk; using the change in E_t to check for '
+                         'convergence.')
+            self.uselowerbound = False
+        self._init_topk_labels()
+        labels = self.topk_labels
+        k = min(self.topk, self.nclasses)
+        nu0 = self.nu0.reshape(-1)
+
+        votes = labels['scores'] < self.nclasses
+        vote_keys, vote_idxs = np.unique(labels['objects'][votes].astype(np.int64) * self.nclasses
+                                         + labels['scores'][votes], return_inverse=True)
+        vote_counts = np.bincount(vote_idxs, labels['weights'][votes])
+        prior_classes = np.argsort(-nu0, kind='stable')[:k]
+        objects, classes = ibcctopk.unique_pairs(
+            np.concatenate((vote_keys // self.nclasses, np.repeat(np.arange(self.N), k))),
+            np.concatenate((vote_keys % self.nclasses, np.tile(prior_classes, self.N))), self.nclasses)
+        counts = nu0[classes]
+        keys = objects * self.nclasses + classes
+        has_votes = np.isin(keys, vote_keys)
+        counts[has_votes] += vote_counts[np.searchsorted(vote_keys, keys[has_votes])]
+        rest = np.sum(nu0) - np.bincount(objects, nu0[classes], minlength=self.N)
+        with np.errstate(divide='ignore'):
+            lnrest = np.log(np.maximum(rest, 0))
+        E_t, residual = ibcctopk.select_topk(objects, classes, np.log(counts), lnrest, self.N, self.nclasses, k)
+        self.E_t, self.E_t_residual = self._gold_topk(E_t, residual)
+        if self.sparse:
+            self.E_t_sparse = self.E_t
+
+
+    def _expected_kappa(self):
+        kappa = np.exp(self.lnkappa).reshape(-1)
+        return kappa / np.sum(kappa)
+
+
+    def _class_totals_topk(self):
+        # sum of E_t over the data points, with the residual mass spread over the other classes in proportion to kappa
+        kappa = self._expected_kappa()
+        scale, correction = ibcctopk.spread_residual(self.E_t, self.E_t_residual, kappa)
+        return kappa * np.sum(scale) + np.asarray(correction.sum(axis=0)).reshape(-1)
+
+
+    def _post_alpha_topk(self):
+        kappa = self._expected_kappa()
+        scale, correction = ibcctopk.spread_residual(self.E_t, self.E_t_residual, kappa)
+        for l in range(self.nscores):
+            CT = self.C[l].T
+            counts = kappa[:, np.newaxis] * CT.dot(scale)[np.newaxis, :] + CT.dot(correction).T.toarray()
+            self.alpha[:, l, :] = self.alpha0[:, l, :] + counts
+
+
+    def _expec_t_topk(self):
+        labels = self.topk_labels
+        k = min(self.topk, self.nclasses)
+        # candidates: the current top k and the classes matching the scores received
+        E_t = self.E_t
+        votes = labels['scores'] < self.nclasses
+        objects, classes = ibcctopk.unique_pairs(
+            np.concatenate((np.repeat(np.arange(self.N), np.diff(E_t.indptr)), labels['objects'][votes])),
+            np.concatenate((E_t.indices, labels['scores'][votes])), self.nclasses)
+        lnkappa = self.lnkappa.reshape(-1)
+        lnp = lnkappa[classes] + ibcctopk.pair_lnjoint(objects, classes, labels, self.lnPi)
+
+        # the remaining classes share the likelihood of the labels averaged over classes
+        kappa = np.exp(lnkappa)
+        rest = np.sum(kappa) - np.bincount(objects, kappa[classes], minlength=self.N)
+        lnpi_rest = ibcctopk.background_lnpi(self.lnPi, kappa)
+        with np.errstate(divide='ignore'):
+            lnrest = np.log(np.maximum(rest, 0))
+        lnrest += np.bincount(labels['objects'], labels['weights'] * lnpi_rest[labels['scores'], labels['workers']],
+                              minlength=self.N)
+        E_t, residual = ibcctopk.select_topk(objects, classes, lnp, lnrest, self.N, self.nclasses, k)
+        self.E_t, self.E_t_residual = self._gold_topk(E_t, residual)
+
+
+    def _resparsify_t_topk(self):
+        # data points without crowd labels get the top k classes of kappa
+        kappa = self._expected_kappa()
+        k = min(self.topk, self.nclasses)
+        prior_classes = np.argsort(-kappa, kind='stable')[:k]
+        unobserved = np.ones(self.full_N, dtype=bool)
+        unobserved[self.observed_idxs] = False
+        unobserved = np.flatnonzero(unobserved)
+        E_t = self.E_t.tocoo()
+        rows = np.concatenate((self.observed_idxs[E_t.row], np.repeat(unobserved, k)))
+        cols = np.concatenate((E_t.col, np.tile(prior_classes, len(unobserved))))
+        values = np.concatenate((E_t.data, np.tile(kappa[prior_classes], len(unobserved))))
+        residual = np.zeros(self.full_N) + 1 - np.sum(kappa[prior_classes])
+        residual[self.observed_idxs] = self.E_t_residual
+        self.E_t_sparse = self.E_t
+        self.E_t = csr_matrix(coo_matrix((values, (rows, cols)), shape=(self.full_N, self.nclasses)))
+        self.E_t_residual = residual
+
+
 # Expectations: methods for calculating expectations with respect to parameters for the VB algorithm ------------------
     def _expec_lnkappa(self, use_ml=False):
+        if self.topk is not None:
+            ET_sum = self._class_totals_topk()
+        else:
+            ET_sum = np.sum(self.E_t, 0)
         if use_ml:
-            nu = np.reshape(np.sum(self.E_t, 0), self.nu0.shape)  # ignores nu0
+            nu = np.reshape(ET_sum, self.nu0.shape)  # ignores nu0
             lnkappa = np.log((nu - 1) / float(np.sum(nu, 0) - nu.shape[0]))
         else:
-            nu = self.nu0 + np.reshape(np.sum(self.E_t, 0), self.nu0.shape)
+            nu = self.nu0 + np.reshape(ET_sum, self.nu0.shape)
             lnkappa = (psi(nu) - psi(np.sum(nu, 0)))
         self.nu = nu
         self.lnkappa = lnkappa
@@ -568,7 +1276,13 @@ class IBCC(object):
 
 
     def _expec_t(self):
+        if self.topk is not None:
+            self._expec_t_topk()
+            return
         self._lnjoint()
+        if self.inplace_updates:
+            self._expec_t_inplace()
+            return
         joint = self.lnpCT
         if self.testidxs is not None:
             joint = joint[self.testidxs, :]
@@ -587,11 +1301,33 @@ class IBCC(object):
         else:
             self.E_t = pT
    
+    def _expec_t_inplace(self):
+        ws = self.workspace
+        if ws['test_rows'] is not None:
+            joint = ws['testbuf']
+            np.take(self.lnpCT, ws['test_rows'], axis=0, out=joint)
+        else:
+            joint = self.E_t
+            np.copyto(joint, self.lnpCT)
+        norma = ws['rowbuf']
+        # ensure that the values are not too small
+        np.max(joint, axis=1, out=norma)
+        joint -= norma[:, np.newaxis]
+        np.exp(joint, out=joint)
+        np.sum(joint, axis=1, out=norma)
+        joint /= norma[:, np.newaxis]
+        # update targets
+        if ws['test_rows'] is not None:
+            self.E_t[ws['test_rows'], :] = joint
+
 # Likelihoods of observations and current estimates of parameters --------------------------------------------------
     def _lnjoint(self, alldata=False):
         '''
         For use with crowdsourced data in table format (should be converted on input)
         '''
+        if self.inplace_updates:
+            self._lnjoint_inplace(alldata)
+            return
         if self.uselowerbound or alldata:
             for j in range(self.nclasses):
                 data = None
@@ -624,6 +1360,31 @@ class IBCC(object):
                 else:
                     self.lnpCT[:, j] = np.array(data).reshape(-1) + self.lnkappa[j]
         
+    def _lnjoint_inplace(self, alldata=False):
+        '''
+        Computes lnpCT with one product per score, C[l] . lnPi[:, l, :].T, accumulating into lnpCT or a work buffer. The
+        sparse products are added to the output directly; the dense products go through a work buffer.
+        '''
+        ws = self.workspace
+        if self.uselowerbound or alldata or ws['test_rows'] is None:
+            C = self.C
+            data = self.lnpCT
+        else:
+            C = self.Ctest
+            data = ws['testbuf']
+        np.copyto(data, np.reshape(self.lnkappa, (1, self.nclasses)))
+        for l in range(self.nscores):
+            if self.table_format_flag:
+                data_l = ws['dotbuf'][:data.shape[0]]
+                np.dot(C[l], self.lnPi[:, l, :].T, out=data_l)
+                data += data_l
+            else:
+                lnPi_l = ws['lnpibuf']
+                np.copyto(lnPi_l, self.lnPi[:, l, :].T)
+                sparse_dot_add(C[l], lnPi_l, data)
+        if data is not self.lnpCT:
+            self.lnpCT[ws['test_rows'], :] = data
+
     def _post_lnkappa(self):
         lnpKappa = gammaln(np.sum(self.nu0)) - np.sum(gammaln(self.nu0)) + sum((self.nu0 - 1) * self.lnkappa)
         return lnpKappa
@@ -791,22 +1552,74 @@ class IBCC(object):
 
     
 # Loader and Runner helper functions -------------------------------------------------------------------------------
-def load_combiner(config_file, ibcc_class=None):
+def load_combiner(config_file, ibcc_class=None, previous_run=None):
     dh = DataHandler()
-    dh.loadData(config_file)
+    dh.loadData(config_file, previous_run)
     if ibcc_class==None:
         combiner = IBCC(dh=dh)
     else:
         combiner = ibcc_class(dh=dh)
     return combiner, dh
 
-def load_and_run_ibcc(configFile, ibcc_class=None, optimise_hyperparams=False):
-    combiner, dh = load_combiner(configFile, ibcc_class)
+def _load_run_state(state_file):
+    try:
+        with np.load(state_file) as data:
+            return dict((name, data[name]) for name in data.files)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _save_run_state(state_file, dh, combiner, crowdlabels, pT):
+    '''
+    Saves the input fingerprint, the parsed crowd labels and the target posteriors so that the next run can parse
+    only the rows appended to the input file and start from the current posteriors.
+    '''
+    if dh.table_format or dh.workeridxs is None:
+        return
+    input_size, input_hash = dh.input_fingerprint()
+    with open(state_file, 'wb') as f:
+        np.savez(f, input_size=input_size, input_hash=input_hash, crowdlabels=crowdlabels,
+                 targetidxs=dh.targetidxs[:dh.ncrowdtargets], workeridxs=dh.workeridxs,
+                 combiner=type(combiner).__name__, E_t=pT[:dh.ncrowdtargets])
+
+def _warm_start(combiner, previous, dh):
+    '''
+    Initialises the target posteriors from the previous run. The rows of the previous E_t are matched to the current
+    targets through their original IDs, and targets without a previous estimate are initialised from the votes as
+    usual. The other model parameters are recomputed from E_t in the first VB iteration, so they do not need to be
+    restored.
+    '''
+    if str(previous['combiner']) != type(combiner).__name__ or previous['E_t'].shape[1] != combiner.nclasses:
+        return
+    idxs = dh.map_ids_to_local_idxs(previous['targetidxs'])
+    found = idxs > -1
+    E_t = np.zeros((dh.N, combiner.nclasses)) + np.nan
+    E_t[idxs[found], :] = previous['E_t'][found, :]
+    combiner.E_t = E_t
+    combiner.E_t_sparse = E_t
+
+def load_and_run_ibcc(configFile, ibcc_class=None, optimise_hyperparams=False, cache=None, state_file=None):
+    '''
+    Loads the data and settings from a configuration file, runs the combiner and saves the outputs. Pass an
+    ibcccache.ResultCache as cache to reuse the results of an earlier run with identical inputs.
+
+    If state_file is set, the input fingerprint, parsed labels and posteriors are saved there after the run. On the
+    next run, if rows have only been appended to the input file (sparse list format), only the new rows are parsed
+    and inference starts from the previous posteriors, so it usually converges in a few iterations. Otherwise the
+    whole file is reloaded and the model is trained from scratch.
+    '''
+    previous = _load_run_state(state_file) if state_file is not None else None
+    combiner, dh = load_combiner(configFile, ibcc_class, previous)
+    combiner.result_cache = cache
+    if dh.appended_rows is not None:
+        _warm_start(combiner, previous, dh)
+    crowdlabels = dh.crowdlabels.copy() if state_file is not None else None
     #combine labels
     combiner.verbose = True
     combiner.uselowerbound = True
     pT = combiner.combine_classifications(dh.crowdlabels, dh.goldlabels, optimise_hyperparams=optimise_hyperparams, 
                                           table_format=dh.table_format)
+    if state_file is not None:
+        _save_run_state(state_file, dh, combiner, crowdlabels, pT)
 
     if dh.output_file is not None:
         dh.save_targets(pT)
@@ -14,7 +14,7 @@ class BalancedIBCC(IBCC):
         proportion = np.log(1.0 / float(self.nclasses))
         self.lnkappa = np.ones(self.nclasses) * proportion
 # Expectations: methods for calculating expectations with respect to parameters for the VB algorithm ---------------
-    def _expec_lnkappa(self):
+    def _expec_lnkappa(self, use_ml=False):
         self.nu = np.ones(self.nclasses) * 1000000 
         proportion = np.log(1.0 / float(self.nclasses))
         self.lnkappa = np.ones(self.nclasses) * proportion
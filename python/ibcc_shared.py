@@ -0,0 +1,196 @@
+'''
+IBCC with confusion matrices that share their structure between workers, for problems with many classes, e.g.
+species identification with hundreds of classes and many thousands of workers, where IBCC's nclasses x nscores x K
+arrays do not fit in memory.
+
+Each label is either given by the worker knowing the answer, which happens with a probability a_k that is specific to
+the worker, or otherwise drawn from a confusion matrix B that is shared by all workers:
+
+    pi_k[j, l] = a_k * [l == j] + (1 - a_k) * B[j, l]
+
+with priors a_k ~ Beta(accuracy0) and B[j, :] ~ Dir(alpha0[j, :]). The variational posterior over whether each label
+came from the worker's knowledge or from B is marginalised out in closed form, so the updates have the same shape as
+IBCC's, but only hold K x 2 parameters for the workers and one nclasses x nscores matrix, and every update is linear in
+the number of labels. Score j is taken to be the correct response for class j, so nscores must be at least nclasses.
+
+@author: Edwin Simpson
+'''
+import numpy as np
+from scipy.special import psi, gammaln, expit
+from ibcc import IBCC, label_arrays, split_scores
+import ibccmemory
+
+
+class SharedConfusionIBCC(IBCC):
+    # prior pseudo-counts for each worker knowing the answer or not
+    accuracy0 = np.array([1.0, 1.0])
+
+    # posterior hyperparameters
+    beta = None # nclasses x nscores Dirichlet parameters of the shared confusion matrix
+    accuracy = None # K x 2 Beta parameters of each worker's accuracy
+    # expectations
+    lnB = None # expected log of the shared confusion matrix
+    lnacc = None # expected log of each worker's accuracy, K
+    lnnotacc = None # expected log of one minus each worker's accuracy, K
+    memory_report_attrs = ibccmemory.COMBINER_ATTRS + ('beta', 'accuracy', 'lnB', 'lnacc', 'lnnotacc')
+    supports_inplace_updates = False # the updates for the shared matrix do not use IBCC's work buffers
+    # alpha and lnPi are not used: the model is described by the shared matrix and the workers' accuracies
+    model_attrs = ('beta', 'accuracy', 'lnB', 'lnacc', 'lnnotacc', 'nu', 'lnkappa')
+    independent_workers = False # the shared matrix links all of the workers
+    cache_settings = IBCC.cache_settings + ('accuracy0',)
+
+    def _init_lnPi(self):
+        if self.nscores < self.nclasses:
+            raise ValueError('SharedConfusionIBCC needs a score for each class, but nscores=%i and nclasses=%i' %
+                             (self.nscores, self.nclasses))
+        if self.topk is not None:
+            raise ValueError('SharedConfusionIBCC does not support topk.')
+        self.alpha0 = np.asarray(self.alpha0, dtype=float)
+        if self.alpha0.ndim == 3:
+            self.alpha0 = self.alpha0[:, :, 0]
+        self.accuracy0 = np.asarray(self.accuracy0, dtype=float)
+        self.beta = self.alpha0.copy()
+        self.accuracy = np.zeros((self.K, 2)) + self.accuracy0[np.newaxis, :]
+        self._expec_lnpi(self.use_ml)
+
+    def _correct_responsibility(self, l, lnacc, lnnotacc):
+        # probability that a label of score l for a data point of class l came from the worker knowing the answer
+        return expit(lnacc - lnnotacc - self.lnB[l, l])
+
+    def _correct_bonus(self, l, lnacc, lnnotacc):
+        # log likelihood of score l under class l, minus the part shared with the other classes
+        return np.logaddexp(lnacc, lnnotacc + self.lnB[l, l]) - lnnotacc - self.lnB[l, l]
+
+# Posterior Updates to Hyperparameters --------------------------------------------------------------------------------
+    def _post_alpha(self):
+        counts = np.zeros((self.nclasses, self.nscores))
+        correct = np.zeros(self.K)
+        total = np.zeros(self.K)
+        for l in range(self.nscores):
+            Cl = self.C[l]
+            total += np.asarray(Cl.sum(axis=0)).reshape(-1)
+            counts[:, l] = self.E_t.T.dot(np.asarray(Cl.sum(axis=1)).reshape(-1))
+            if l < self.nclasses:
+                # labels that match the class are split between the worker's knowledge and B
+                matching = np.asarray(Cl.T.dot(self.E_t[:, l])).reshape(-1)
+                matching *= self._correct_responsibility(l, self.lnacc, self.lnnotacc)
+                correct += matching
+                counts[l, l] -= np.sum(matching)
+        self.beta = self.alpha0 + counts
+        self.accuracy = np.empty((self.K, 2))
+        self.accuracy[:, 0] = self.accuracy0[0] + correct
+        self.accuracy[:, 1] = self.accuracy0[1] + total - correct
+
+# Expectations: methods for calculating expectations with respect to parameters for the VB algorithm ------------------
+    def _expec_lnpi(self, use_ml=False):
+        if use_ml:
+            # modes of the Dirichlet and Beta distributions
+            self.lnB = np.log((self.beta - 1) / (np.sum(self.beta, axis=1) - self.nscores)[:, np.newaxis])
+            self.lnacc = np.log((self.accuracy[:, 0] - 1) / (np.sum(self.accuracy, axis=1) - 2))
+            self.lnnotacc = np.log((self.accuracy[:, 1] - 1) / (np.sum(self.accuracy, axis=1) - 2))
+        else:
+            self.lnB = psi(self.beta) - psi(np.sum(self.beta, axis=1))[:, np.newaxis]
+            self.lnacc = psi(self.accuracy[:, 0]) - psi(np.sum(self.accuracy, axis=1))
+            self.lnnotacc = psi(self.accuracy[:, 1]) - psi(np.sum(self.accuracy, axis=1))
+
+# Likelihoods of observations and current estimates of parameters --------------------------------------------------
+    def _shared_lnjoint(self, C):
+        '''
+        Computes the log joint probability of each class and the labels in C, a dictionary of N x K matrices with one
+        entry per score, as IBCC.C.
+        '''
+        N = C[0].shape[0]
+        lnjoint = np.zeros((N, self.nclasses)) + np.reshape(self.lnkappa, (1, self.nclasses))
+        for l in range(self.nscores):
+            Cl = C[l]
+            lnjoint += np.asarray(Cl.sum(axis=1)).reshape((N, 1)) * self.lnB[:, l][np.newaxis, :]
+            lnjoint += np.asarray(Cl.dot(self.lnnotacc)).reshape((N, 1))
+            if l < self.nclasses:
+                lnjoint[:, l] += np.asarray(Cl.dot(self._correct_bonus(l, self.lnacc, self.lnnotacc))).reshape(-1)
+        return lnjoint
+
+    def _lnjoint(self, alldata=False):
+        if self.uselowerbound or alldata or self.testidxs is None:
+            self.lnpCT[:] = self._shared_lnjoint(self.C)
+        else:
+            self.lnpCT[self.testidxs, :] = self._shared_lnjoint(self.Ctest)
+
+# Lower Bound ---------------------------------------------------------------------------------------------------------
+    def _post_lnpi(self):
+        lnpB = np.sum((self.alpha0 - 1) * self.lnB) + np.sum(gammaln(np.sum(self.alpha0, axis=1))) - \
+            np.sum(gammaln(self.alpha0))
+        lnpAcc = np.sum((self.accuracy0[0] - 1) * self.lnacc + (self.accuracy0[1] - 1) * self.lnnotacc) + \
+            self.K * (gammaln(np.sum(self.accuracy0)) - np.sum(gammaln(self.accuracy0)))
+        return lnpB + lnpAcc
+
+    def _q_lnPi(self):
+        lnqB = np.sum((self.beta - 1) * self.lnB) + np.sum(gammaln(np.sum(self.beta, axis=1))) - \
+            np.sum(gammaln(self.beta))
+        lnqAcc = np.sum((self.accuracy[:, 0] - 1) * self.lnacc + (self.accuracy[:, 1] - 1) * self.lnnotacc) + \
+            np.sum(gammaln(np.sum(self.accuracy, axis=1))) - np.sum(gammaln(self.accuracy))
+        return lnqB + lnqAcc
+
+# Prediction with a frozen model -----------------------------------------------------------------------------------
+    def _prior_lnpi(self):
+        '''
+        Expected log confusion matrix of a worker not seen in training: the trained shared matrix with the prior
+        accuracy.
+        '''
+        lnacc = psi(self.accuracy0[0]) - psi(np.sum(self.accuracy0))
+        lnnotacc = psi(self.accuracy0[1]) - psi(np.sum(self.accuracy0))
+        return self._worker_lnpi(np.array([lnacc]), np.array([lnnotacc]))[:, :, 0]
+
+    def _worker_lnpi(self, lnacc, lnnotacc):
+        lnPi = self.lnB[:, :, np.newaxis] + lnnotacc[np.newaxis, np.newaxis, :]
+        for l in range(self.nclasses):
+            lnPi[l, l, :] += self._correct_bonus(l, lnacc, lnnotacc)
+        return lnPi
+
+    def _frozen_lnpi(self):
+        '''
+        Builds the full nclasses x nscores x K array of expected log confusion matrices. This needs as much memory as
+        standard IBCC, so it is only used for lnpi_lookup_table(), e.g. by ibccserve.ScoringService; predict_proba()
+        works without it.
+        '''
+        return self._worker_lnpi(self.lnacc, self.lnnotacc)
+
+    def lnpi_lookup_table(self):
+        if self.lnB is None or not np.any(self.nu):
+            raise ValueError('The model must be trained with combine_classifications() before it can score new data.')
+        lnPi = self._frozen_lnpi()
+        table = np.empty((self.K + 1, self.nscores, self.nclasses))
+        table[:self.K] = lnPi.transpose((2, 1, 0))
+        table[self.K] = self._prior_lnpi().T
+        return table
+
+    def predict_proba(self, new_labels, table_format=False):
+        '''
+        Scores new data points using the trained model without updating it, as IBCC.predict_proba(), but without
+        building a confusion matrix for each worker.
+        '''
+        if self.lnB is None or not np.any(self.nu):
+            raise ValueError('The model must be trained with combine_classifications() before it can score new data.')
+        workers, objects, scores, weights, N = label_arrays(new_labels, table_format)
+        workers, objects, scores, weights = split_scores(workers, objects, scores, weights, self.nscores)
+
+        # workers that were not seen in training have the prior accuracy
+        seen = (workers >= 0) & (workers < self.K)
+        lnacc = np.zeros(len(workers)) + psi(self.accuracy0[0]) - psi(np.sum(self.accuracy0))
+        lnnotacc = np.zeros(len(workers)) + psi(self.accuracy0[1]) - psi(np.sum(self.accuracy0))
+        lnacc[seen] = self.lnacc[workers[seen]]
+        lnnotacc[seen] = self.lnnotacc[workers[seen]]
+
+        lnjoint = np.empty((N, self.nclasses))
+        shared = np.bincount(objects, weights * lnnotacc, minlength=N)
+        for j in range(self.nclasses):
+            lnjoint[:, j] = shared + np.bincount(objects, weights * self.lnB[j, scores], minlength=N)
+        matching = scores < self.nclasses
+        diag = scores[matching]
+        bonus = np.logaddexp(lnacc[matching], lnnotacc[matching] + self.lnB[diag, diag]) - lnnotacc[matching] - \
+            self.lnB[diag, diag]
+        np.add.at(lnjoint, (objects[matching], diag), weights[matching] * bonus)
+        lnjoint += np.reshape(self.lnkappa, (1, self.nclasses))
+        lnjoint -= np.max(lnjoint, axis=1)[:, np.newaxis]
+        pT = np.exp(lnjoint)
+        pT /= np.sum(pT, axis=1)[:, np.newaxis]
+        return pT
@@ -0,0 +1,128 @@
+'''
+On-disk cache of the results of combine_classifications, keyed by a hash of everything that determines the result:
+the crowd labels, gold labels, test indexes, the priors, the settings listed in the combiner's cache_settings and the
+class of the combiner. Attach a cache to skip preprocessing and inference when the same inputs are run again:
+
+    combiner.result_cache = ResultCache('./output/cache', max_bytes=1e9)
+    pT = combiner.combine_classifications(crowdlabels, goldlabels)
+
+or pass cache=ResultCache(...) to ibcc.load_and_run_ibcc(). When the total size of the cache exceeds max_bytes, the
+least recently used entries are removed.
+'''
+import hashlib, logging, os, tempfile
+import numpy as np
+
+class ResultCache(object):
+    '''
+    Stores the target posteriors E_t and the combiner's model_attrs, e.g. for IBCC the posterior hyperparameters alpha
+    and nu and the expectations lnPi and lnkappa derived from them, in one .npz file per key.
+
+    Parameters
+    ----------
+
+    cache_dir : string
+        Directory for the cache files. Created if it does not exist.
+    max_bytes : int
+        Size limit for the cache directory. None means no limit.
+    '''
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _update(self, h, name, value):
+        h.update(name.encode('utf-8'))
+        if value is None:
+            h.update(b'None')
+        elif isinstance(value, np.ndarray) or isinstance(value, list):
+            value = np.ascontiguousarray(value)
+            h.update(('%s%s' % (value.dtype.str, str(value.shape))).encode('utf-8'))
+            h.update(value.tobytes())
+        else:
+            h.update(repr(value).encode('utf-8'))
+
+    def key(self, combiner, crowdlabels, goldlabels=None, testidxs=None, table_format=False, optimise_hyperparams=0,
+            maxiter=None):
+        '''
+        Returns the hash of the inputs and configuration of a run as a hex string. Call this before
+        combine_classifications, since preprocessing modifies the crowd labels in place.
+        '''
+        h = hashlib.blake2b(digest_size=20)
+        cls = type(combiner)
+        self._update(h, 'class', cls.__module__ + '.' + cls.__name__)
+        self._update(h, 'crowdlabels', crowdlabels)
+        self._update(h, 'goldlabels', goldlabels)
+        self._update(h, 'testidxs', testidxs)
+        self._update(h, 'table_format', bool(table_format))
+        self._update(h, 'optimise_hyperparams', optimise_hyperparams)
+        if optimise_hyperparams:
+            self._update(h, 'maxiter', maxiter)
+        self._update(h, 'alpha0', np.asarray(combiner.alpha0, dtype=float))
+        self._update(h, 'nu0', np.asarray(combiner.nu0, dtype=float))
+        for name in combiner.cache_settings:
+            self._update(h, name, getattr(combiner, name, None))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        '''
+        Returns a dictionary of the cached arrays for a key, or None if the key is not in the cache.
+        '''
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                result = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        # record the access for the LRU eviction
+        os.utime(path, None)
+        self.hits += 1
+        return result
+
+    def store(self, key, combiner):
+        '''
+        Saves the results of a combiner's last run under the given key, then evicts old entries if the cache is full.
+        '''
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                arrays = dict((name, getattr(combiner, name)) for name in combiner.model_attrs)
+                np.savez(f, E_t=combiner.E_t, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache is within max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, path = entries.pop(0)
+            os.remove(path)
+            total -= size
+            logging.debug('Removed %s from the result cache' % path)
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -4,10 +4,32 @@ Created on 29 Sep 2014
 @author: edwin
 '''
 
-import pickle, logging
+import hashlib, io, os, pickle, logging
 import numpy as np
 from scipy.sparse import coo_matrix
 
+def _extend_id_map(ids, values):
+    '''
+    Maps the original ID values to indexes into ids, appending any values that are not in ids yet. Returns the
+    extended ids and the mapped values.
+    '''
+    ids = np.asarray(ids)
+    if len(values) == 0:
+        return ids, values
+    if len(ids):
+        sorter = np.argsort(ids)
+        pos = np.searchsorted(ids, values, sorter=sorter)
+        pos = np.minimum(pos, len(ids) - 1)
+        found = ids[sorter[pos]] == values
+    else:
+        sorter = pos = np.zeros(len(values), dtype=int)
+        found = np.zeros(len(values), dtype=bool)
+    newids, newidxs = np.unique(values[~found], return_inverse=True)
+    mapped = np.empty(len(values))
+    mapped[found] = sorter[pos[found]]
+    mapped[~found] = len(ids) + newidxs
+    return np.concatenate((ids, newids)), mapped
+
 class DataHandler(object):
     '''
     classdocs
@@ -34,6 +56,9 @@ class DataHandler(object):
     
     targetidxmap = None
     targetidxs = None
+    workeridxs = None # original worker IDs in the order of the local worker indexes
+    ncrowdtargets = 0 # number of targets with crowd labels; targets that only have gold labels come after these
+    appended_rows = None # number of rows parsed from the end of the input file by loadAppendedCrowdLabels
     max_targetid = 0
     trainids = None
 
@@ -52,13 +77,22 @@ class DataHandler(object):
         '''
         
     def create_target_idx_map(self):
-        self.max_targetid = np.max(self.targetidxs) # largest original ID value
+        self.max_targetid = int(np.max(self.targetidxs)) # largest original ID value
         blanks = np.zeros(len(self.targetidxs)) # only need 1D so set all to zero
         idxList = list(range(len(self.targetidxs))) # new local idxs
         tIdxMap = coo_matrix(( idxList, (self.targetidxs,blanks)), shape=(self.max_targetid+1,1) )       
         self.N = len(self.targetidxs)
         self.targetidxmap = tIdxMap.tocsr() # maps Original IDs to new local idxs
         
+    def map_ids_to_local_idxs(self, ids):
+        '''
+        Returns the local indexes of the targets with the given original IDs, or -1 for IDs that are not in the data.
+        '''
+        _, idxs = _extend_id_map(self.targetidxs, np.asarray(ids, dtype=float))
+        idxs = idxs.astype(int)
+        idxs[idxs >= len(self.targetidxs)] = -1
+        return idxs
+
     def loadCrowdLabels(self, scores):   
         '''
         Loads labels from crowd in sparse list format, i.e. 3 columns, classifier ID,
@@ -78,15 +112,15 @@ class DataHandler(object):
             self.targetidxs, crowdLabels[:,1] = np.unique(crowdLabels[:,1],return_inverse=True)
             kIdxs, crowdLabels[:,0] = np.unique(crowdLabels[:,0],return_inverse=True)
             K = len(kIdxs)
+            self.workeridxs = kIdxs
             
-        unmappedScores = np.round(crowdLabels[:,2])
-        for i,s in enumerate(scores):
-            print(np.sum(unmappedScores==s))
-            crowdLabels[(unmappedScores==s),2] = i
+        self._map_scores(crowdLabels, scores)
         
         self.create_target_idx_map()
+        self.ncrowdtargets = len(self.targetidxs)
         self.crowdlabels = crowdLabels
         self.K = K
+        self.appended_rows = None
         print(crowdLabels.shape)
 #         if not pyFileExists:
 #             try:
@@ -95,6 +129,67 @@ class DataHandler(object):
 #             except Exception:
 #                 logging.error('Could not save the input data as a Python object file.')
         
+    def _map_scores(self, crowdLabels, scores):
+        unmappedScores = np.round(crowdLabels[:,2])
+        for i,s in enumerate(scores):
+            logging.debug('%i crowd labels with score %s' % (np.sum(unmappedScores==s), str(s)))
+            crowdLabels[(unmappedScores==s),2] = i
+
+    def input_fingerprint(self, nbytes=None):
+        '''
+        Returns the size of the input file and a hash of its first nbytes bytes (all of it if nbytes is None).
+        '''
+        size = os.path.getsize(self.input_file)
+        if nbytes is None:
+            nbytes = size
+        h = hashlib.blake2b(digest_size=20)
+        with open(self.input_file, 'rb') as inFile:
+            remaining = nbytes
+            while remaining > 0:
+                chunk = inFile.read(min(remaining, 1 << 24))
+                if not chunk:
+                    break
+                h.update(chunk)
+                remaining -= len(chunk)
+        return size, h.hexdigest()
+
+    def loadAppendedCrowdLabels(self, scores, previous):
+        '''
+        Loads crowd labels in sparse list format when the input file only differs from the previous run by rows
+        appended at the end. Only the new rows are parsed; the earlier rows are taken from previous, a dictionary with
+        the mapped crowdlabels, targetidxs, workeridxs, input_size and input_hash of the previous run. New worker and
+        target IDs are given local indexes after the existing ones. Returns False without loading anything if the
+        earlier part of the file has changed.
+        '''
+        old_size = int(previous['input_size'])
+        size, prefix_hash = self.input_fingerprint(old_size)
+        if size < old_size or prefix_hash != str(previous['input_hash']):
+            logging.info('Input file has changed since the last run; reloading all rows.')
+            return False
+        with open(self.input_file, 'rb') as inFile:
+            if old_size > 0:
+                inFile.seek(old_size - 1)
+                if inFile.read(1) != b'\n':
+                    # the last row of the previous run may have been extended
+                    return False
+            tail = inFile.read()
+        if tail.strip():
+            newLabels = np.genfromtxt(io.BytesIO(tail), delimiter=',', usecols=[0,1,2], ndmin=2)
+        else:
+            newLabels = np.zeros((0, 3))
+
+        self.targetidxs, newLabels[:,1] = _extend_id_map(previous['targetidxs'], newLabels[:,1])
+        self.workeridxs, newLabels[:,0] = _extend_id_map(previous['workeridxs'], newLabels[:,0])
+        self._map_scores(newLabels, scores)
+
+        self.create_target_idx_map()
+        self.ncrowdtargets = len(self.targetidxs)
+        self.crowdlabels = np.concatenate((previous['crowdlabels'], newLabels), axis=0)
+        self.K = len(self.workeridxs)
+        self.appended_rows = newLabels.shape[0]
+        logging.info('Parsed %i rows appended to the input file since the last run.' % self.appended_rows)
+        return True
+
     def loadCrowdTable(self, scores):
         '''
         Loads crowd labels in a table format
@@ -188,8 +283,13 @@ class DataHandler(object):
             mapped_predictions = mapped_predictions.toarray()
         return mapped_predictions
                 
-    def loadData(self, configFile):
-        
+    def loadData(self, configFile, previous_run=None):
+        '''
+        Loads the settings from a configuration file, then the crowd labels and gold labels. previous_run is an
+        optional dictionary describing the input of a previous run (see loadAppendedCrowdLabels); if the input file has
+        only had rows appended since then, only the new rows are parsed.
+        '''
+
         testid="unknowntest"
         
         #Defaults that will usually be overwritten by project config
@@ -261,7 +361,7 @@ class DataHandler(object):
         #load labels from crowd
         if tableFormat:
             self.loadCrowdTable(scores)
-        else:
+        elif previous_run is None or not self.loadAppendedCrowdLabels(scores, previous_run):
             self.loadCrowdLabels(scores)
         
         #load gold labels if present
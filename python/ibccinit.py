@@ -0,0 +1,132 @@
+'''
+Spectral (method-of-moments) initialisation for IBCC, in the style of the moment estimators for the Dawid-Skene
+model. Under a "one-coin" model, in which worker k gives the correct score with probability p_k and otherwise picks
+one of the other scores at random, the rate at which two workers agree on the same data points, minus the rate 1/J
+expected by chance, is a rank-one matrix with entries proportional to (p_k - 1/J)(p_k' - 1/J). The leading factor of
+the worker agreement matrix therefore estimates every worker's accuracy, including workers who are adversarial, i.e.
+worse than random, whose votes the default initialisation counts as if they were correct. The factor is found by
+alternating least squares using products with the sparse crowd label matrices only, so the K x K agreement matrix is
+never built.
+
+The estimated accuracies give a weighted vote for each data point; the confusion matrices are then estimated from
+these targets, as in the M-step of Dawid and Skene, and one E-step gives the initial E_t:
+
+    combiner.init_method = 'spectral'
+    pT = combiner.combine_classifications(crowdlabels)
+
+The VB updates are unchanged, so the estimate only moves the starting point. For most data sets this is closer to the
+fixed point found from the default initialisation and fewer iterations are needed, but where the posterior has several
+modes VB may converge to a different one.
+'''
+import numpy as np
+from scipy.sparse import issparse
+
+
+def _column_sums_sq(A):
+    # Sum of the squared values in each column of a sparse or dense matrix
+    if issparse(A):
+        return np.asarray(A.multiply(A).sum(axis=0)).reshape(-1)
+    return np.sum(A * A, axis=0)
+
+
+def worker_agreement_factor(C, nscores, niterations=50):
+    '''
+    Finds the rank-one factor r of the chance-corrected worker agreement matrix, minimising
+    sum_{k != k'} n_kk' (a_kk' - r_k r_k')^2, where n_kk' is the number of data points that workers k and k' both
+    labelled and a_kk' is their rate of agreement minus 1/nscores.
+
+    Parameters
+    ----------
+
+    C : dictionary of N x K matrices
+        The crowd labels for each score, as IBCC.C.
+    nscores : int
+        Number of scores.
+    niterations : int
+        Number of alternating least squares updates.
+
+    Returns
+    -------
+
+    r : K numpy array
+        The factor for each worker, with the sign chosen so that most workers are better than random. Workers who do
+        not share any data points with others have r = 0.
+    '''
+    Call = C[0]
+    for l in range(1, nscores):
+        Call = Call + C[l]
+    nlabels = _column_sums_sq(Call)
+    nagree = np.zeros(len(nlabels))
+    for l in range(nscores):
+        nagree += _column_sums_sq(C[l])
+
+    r = np.zeros(len(nlabels)) + 0.5
+    for _ in range(niterations):
+        # products with the agreement and co-label count matrices, excluding each worker's agreement with itself
+        agree = -nagree * r
+        for l in range(nscores):
+            agree += C[l].T.dot(C[l].dot(r))
+        together = Call.T.dot(Call.dot(r)) - nlabels * r
+        numerator = agree - together / float(nscores)
+        denominator = Call.T.dot(Call.dot(r ** 2)) - nlabels * r ** 2
+        r = numerator / np.maximum(denominator, 1e-12)
+        r = np.clip(r, -1, 1)
+    if np.sum(r) < 0:
+        r = -r
+    return r
+
+
+def one_coin_accuracy(C, nscores, niterations=50, min_p=1e-3):
+    '''
+    Returns the estimated probability that each worker gives the correct score under the one-coin model.
+    '''
+    r = worker_agreement_factor(C, nscores, niterations)
+    # a_kk' = J / (J - 1) * (p_k - 1/J)(p_k' - 1/J)
+    p = 1.0 / nscores + r * np.sqrt((nscores - 1.0) / nscores)
+    return np.clip(p, min_p, 1 - min_p)
+
+
+def moment_targets(C, nclasses, p):
+    '''
+    Computes the one-coin posterior over the classes for each data point, using the log odds of each worker's accuracy
+    as the weight of their votes. Scores 0 to nclasses-1 are votes for the classes with the same index.
+    '''
+    weights = np.log(p * (nclasses - 1) / (1 - p))
+    lnjoint = np.zeros((C[0].shape[0], nclasses))
+    for j in range(nclasses):
+        lnjoint[:, j] = np.asarray(C[j].dot(weights)).reshape(-1)
+    lnjoint -= np.max(lnjoint, axis=1)[:, np.newaxis]
+    E_t = np.exp(lnjoint)
+    E_t /= np.sum(E_t, axis=1)[:, np.newaxis]
+    return E_t
+
+
+def spectral_targets(C, nscores, E_t, fixed, niterations=50):
+    '''
+    Estimates the targets from the workers' agreement, from which IBCC estimates the confusion matrices as in the
+    Dawid-Skene M-step.
+
+    Parameters
+    ----------
+
+    C : dictionary of N x K matrices
+        The crowd labels for each score, as IBCC.C.
+    nscores : int
+        Number of scores. Must be at least the number of classes.
+    E_t : N x nclasses numpy array
+        The current targets. Rows where fixed is True are kept.
+    fixed : N boolean numpy array
+        Data points whose targets are known, i.e. training data.
+    niterations : int
+        Number of alternating least squares iterations used to find the workers' accuracies.
+
+    Returns
+    -------
+
+    targets : N x nclasses numpy array
+        Estimated probability of each class for each data point.
+    '''
+    p = one_coin_accuracy(C, nscores, niterations)
+    targets = moment_targets(C, E_t.shape[1], p)
+    targets[fixed] = E_t[fixed]
+    return targets
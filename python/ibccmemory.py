@@ -0,0 +1,152 @@
+'''
+Memory accounting for IBCC and its variants. estimate_memory() predicts the bytes needed for a data set before it is
+loaded, so you can check whether a job will fit on a node; memory_report() lists the bytes actually held by a combiner
+and its DataHandler after a run:
+
+    print(estimate_memory(N=1000000, K=50000, nlabels=10000000, nclasses=3, nscores=3)['total'])
+    pT = combiner.combine_classifications(crowdlabels)
+    print(memory_report(combiner, dh)['total'])
+
+Set IBCC.memory_limit to make combine_classifications use these estimates to pick a lower-memory mode, or stop with a
+MemoryError before the large arrays are allocated.
+'''
+import numpy as np
+from scipy.sparse import issparse
+
+# Arrays of an IBCC combiner that depend on the size of the data set. Subclasses with further large arrays can extend
+# IBCC.memory_report_attrs.
+COMBINER_ATTRS = ('C', 'Ctest', 'alpha', 'alpha_tr', 'alpha0', 'lnPi', 'lnpCT', 'E_t', 'E_t_sparse', 'workspace',
+                  'E_t_residual', 'topk_labels')
+DATAHANDLER_ATTRS = ('crowdlabels', 'goldlabels', 'targetidxs', 'targetidxmap', 'workeridxs')
+
+
+def _buffers(obj):
+    # Yields the numpy arrays that hold the data of obj
+    if obj is None:
+        return
+    if isinstance(obj, np.ndarray):
+        yield obj
+    elif issparse(obj):
+        for name in ('data', 'indices', 'indptr', 'row', 'col'):
+            arr = getattr(obj, name, None)
+            if isinstance(arr, np.ndarray):
+                yield arr
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            for arr in _buffers(value):
+                yield arr
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            for arr in _buffers(value):
+                yield arr
+
+
+def _base(arr):
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
+
+def nbytes(obj, seen=None):
+    '''
+    Returns the number of bytes held by the numpy arrays and sparse matrices in obj, which may be a dictionary or list
+    of them. Memory shared with arrays whose ids are in the set seen is not counted again; the ids of the arrays in
+    obj are added to seen.
+    '''
+    if seen is None:
+        seen = set()
+    total = 0
+    for arr in _buffers(obj):
+        base = _base(arr)
+        if id(base) in seen:
+            continue
+        seen.add(id(base))
+        total += base.nbytes
+    return total
+
+
+def memory_report(combiner, dh=None):
+    '''
+    Returns a dictionary with the bytes held by each of the large arrays of a combiner and, optionally, of its
+    DataHandler, plus the 'total'. Arrays that share memory with an array listed before them, e.g. Ctest when all data
+    points are test points, are reported as 0 bytes.
+    '''
+    report = {}
+    seen = set()
+    for name in getattr(combiner, 'memory_report_attrs', COMBINER_ATTRS):
+        report[name] = nbytes(getattr(combiner, name, None), seen)
+    if dh is not None:
+        for name in DATAHANDLER_ATTRS:
+            report['dh.' + name] = nbytes(getattr(dh, name, None), seen)
+    report['total'] = sum(report.values())
+    return report
+
+
+def estimate_memory(N, K, nlabels, nclasses, nscores, Ntest=None, table_format=False, label_itemsize=8,
+                    inplace_updates=False, index_itemsize=4):
+    '''
+    Estimates the bytes IBCC holds for a data set once the crowd labels have been preprocessed. The estimate covers
+    the same arrays as memory_report(), excluding the DataHandler. The crowd label array passed to
+    combine_classifications is counted separately as 'crowdlabels', since the caller owns it.
+
+    Parameters
+    ----------
+
+    N : int
+        Number of data points with crowd labels.
+    K : int
+        Number of workers.
+    nlabels : int
+        Number of crowd labels, i.e. rows in the sparse list, or non-missing entries in the table.
+    Ntest : int
+        Number of test data points. Defaults to N, in which case Ctest shares memory with C.
+    label_itemsize : int
+        Bytes per stored crowd label value: 8 for float64, 4 for float32.
+    inplace_updates : bool
+        Include the work buffers of IBCC.inplace_updates.
+
+    Returns
+    -------
+
+    estimate : dictionary
+        Bytes for each array, the 'total' and the 'peak', which adds the temporary arrays used while preprocessing.
+    '''
+    if Ntest is None:
+        Ntest = N
+    f = 8
+    est = {}
+    if table_format:
+        est['C'] = nscores * N * K * label_itemsize
+        est['Ctest'] = 0 if Ntest == N else nscores * Ntest * K * label_itemsize
+        est['crowdlabels'] = N * K * f
+    else:
+        # CSR matrices: one value and one column index per label, plus the row pointers for each score
+        est['C'] = nlabels * (label_itemsize + index_itemsize) + nscores * (N + 1) * index_itemsize
+        if Ntest == N:
+            est['Ctest'] = 0
+        else:
+            est['Ctest'] = int(est['C'] * float(Ntest) / N)
+        est['crowdlabels'] = nlabels * 3 * f
+    conf_mats = nclasses * nscores * K * f
+    est['alpha'] = conf_mats
+    est['alpha_tr'] = conf_mats
+    est['alpha0'] = conf_mats
+    est['lnPi'] = conf_mats
+    est['lnpCT'] = N * nclasses * f
+    est['E_t'] = N * nclasses * f
+    est['E_t_sparse'] = 0
+    if inplace_updates:
+        est['workspace'] = (N + Ntest) * nclasses * f + Ntest * f + 2 * K * nclasses * f
+        if table_format:
+            est['workspace'] += N * nclasses * f
+    else:
+        # temporary copies of E_t and lnpCT in each iteration
+        est['workspace'] = 2 * N * nclasses * f
+    est['total'] = sum(est.values())
+    # temporary arrays while C is built: masks and COO triples for one score, or comparisons with the whole table
+    if table_format:
+        transient = N * K * (f + 1)
+    else:
+        transient = nlabels * (3 * f + label_itemsize + 2 * index_itemsize)
+    est['peak'] = est['total'] + transient
+    return est
@@ -0,0 +1,224 @@
+'''
+Solves IBCC separately for each connected component of the bipartite graph of workers and data points. Workers and
+data points in different components never share a label, so given the class proportions, kappa, the components are
+independent. Each outer iteration solves all of the components with kappa held fixed, in parallel processes, then
+updates kappa from the targets of all components. This is coordinate ascent on the same variational bound, so it
+converges to a fixed point of the standard VB algorithm:
+
+    combiner = IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=nu0, K=K)
+    pT = combine_by_components(combiner, crowdlabels, goldlabels, nprocesses=8)
+
+This is only valid for models in which workers are independent given kappa, such as IBCC and BalancedIBCC, but not
+CBCC, where the clusters link workers in different components, or SharedConfusionIBCC, where the shared confusion
+matrix does; see IBCC.independent_workers. Only the sparse list format is supported.
+'''
+import logging, multiprocessing
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components as _graph_components
+from scipy.special import psi
+
+# settings copied from the combiner to the combiners that solve each component
+SETTINGS = ('min_iterations', 'max_iterations', 'conv_threshold', 'conv_check_freq', 'discretedecisions',
+            'inplace_updates', 'compact_duplicates', 'use_ml')
+
+
+def connected_components(crowdlabels):
+    '''
+    Finds the connected components of the graph in which each label links a worker to a data point.
+
+    Parameters
+    ----------
+
+    crowdlabels : N_labels x 3 numpy array
+        Sparse list of crowd labels with columns worker ID, data point ID and score.
+
+    Returns
+    -------
+
+    ncomponents : int
+        Number of components that contain at least one label.
+    label_components : N_labels numpy array
+        The component of each label, numbered from 0 to ncomponents-1.
+    '''
+    workers = crowdlabels[:, 0].astype(int)
+    objects = crowdlabels[:, 1].astype(int)
+    K = int(np.max(workers)) + 1
+    N = int(np.max(objects)) + 1
+    graph = coo_matrix((np.ones(len(workers), dtype=np.int8), (workers, K + objects)), shape=(K + N, K + N))
+    _, node_components = _graph_components(graph, directed=False)
+    # renumber so that components without any labels, i.e. unused IDs, are skipped
+    used, label_components = np.unique(node_components[workers], return_inverse=True)
+    return len(used), label_components
+
+
+def _make_tasks(label_components, ncomponents, min_batch_labels):
+    # Groups the labels into tasks: large components on their own, small ones together
+    sizes = np.bincount(label_components, minlength=ncomponents)
+    order = np.argsort(-sizes, kind='stable')
+    task_of_component = np.zeros(ncomponents, dtype=int)
+    ntasks = 0
+    batch_size = 0
+    for c in order:
+        if batch_size == 0 or batch_size >= min_batch_labels:
+            if batch_size > 0:
+                ntasks += 1
+            batch_size = 0
+        task_of_component[c] = ntasks
+        batch_size += sizes[c]
+    ntasks += 1
+    label_tasks = task_of_component[label_components]
+    label_order = np.argsort(label_tasks, kind='stable')
+    bounds = np.searchsorted(label_tasks[label_order], np.arange(ntasks + 1))
+    return [label_order[bounds[i]:bounds[i + 1]] for i in range(ntasks)]
+
+
+def _solve_task(task):
+    cls, params, settings, crowdlabels, goldlabels, lnkappa, E_t = task
+    combiner = cls(**params)
+    for name, value in settings.items():
+        setattr(combiner, name, value)
+    combiner.uselowerbound = False
+    combiner.fixed_lnkappa = lnkappa
+    if E_t is not None:
+        # warm start from the previous outer iteration
+        combiner.E_t = E_t
+        combiner.E_t_sparse = E_t
+    pT = combiner.combine_classifications(crowdlabels, goldlabels)
+    return pT, combiner.alpha, combiner.lnPi, combiner.nIts
+
+
+def combine_by_components(combiner, crowdlabels, goldlabels=None, nprocesses=None, min_batch_labels=10000,
+                          max_outer_iterations=50, tol=1e-6):
+    '''
+    Runs the combiner on each connected component of the crowd labels and returns the combined posteriors. The
+    results are also stored in the combiner: E_t, alpha, lnPi, nu, lnkappa and ncomponents.
+
+    Parameters
+    ----------
+
+    combiner : ibcc.IBCC
+        Combiner whose class, priors and settings are used for each component.
+    crowdlabels : N_labels x 3 numpy array
+        Sparse list of crowd labels.
+    goldlabels : N_data_points numpy array
+        Optional training labels, -1 where unknown.
+    nprocesses : int
+        Number of worker processes. None uses one per CPU; 1 solves the components in this process.
+    min_batch_labels : int
+        Components with fewer labels than this are solved together in batches of at least this many labels, so that
+        thousands of tiny components do not each need their own task.
+    max_outer_iterations : int
+        Maximum number of updates to kappa.
+    tol : float
+        The outer loop stops when the largest change in lnkappa is below this value.
+
+    Returns
+    -------
+
+    E_t : N_data_points x nclasses numpy array
+        Posterior class probabilities for each data point.
+    '''
+    if not combiner.independent_workers:
+        raise ValueError('%s links workers in different components, so they cannot be solved separately.' %
+                         type(combiner).__name__)
+    crowdlabels = np.asarray(crowdlabels, dtype=float)
+    nclasses = combiner.nclasses
+    workers = crowdlabels[:, 0].astype(int)
+    objects = crowdlabels[:, 1].astype(int)
+    K = max(int(np.max(workers)) + 1, combiner.K)
+    N = int(np.max(objects)) + 1
+    if goldlabels is not None:
+        goldlabels = np.asarray(goldlabels, dtype=float).copy()
+        goldlabels[np.isnan(goldlabels)] = -1
+        N = max(N, len(goldlabels))
+        gold = np.zeros(N) - 1
+        gold[:len(goldlabels)] = goldlabels
+    else:
+        gold = np.zeros(N) - 1
+
+    ncomponents, label_components = connected_components(crowdlabels)
+    task_labels = _make_tasks(label_components, ncomponents, min_batch_labels)
+    logging.info('IBCC: %i connected components solved as %i tasks' % (ncomponents, len(task_labels)))
+
+    alpha0 = np.asarray(combiner.alpha0, dtype=float)
+    nu0 = np.asarray(combiner.nu0, dtype=float).reshape(-1)
+    cls = type(combiner)
+    settings = dict((name, getattr(combiner, name)) for name in SETTINGS if hasattr(combiner, name))
+
+    # map each task to local worker and data point indexes
+    tasks = []
+    for idxs in task_labels:
+        task_workers, local_workers = np.unique(workers[idxs], return_inverse=True)
+        task_objects, local_objects = np.unique(objects[idxs], return_inverse=True)
+        labels = crowdlabels[idxs].copy()
+        labels[:, 0] = local_workers
+        labels[:, 1] = local_objects
+        if alpha0.ndim == 3 and alpha0.shape[2] > 1:
+            task_alpha0 = alpha0[:, :, np.minimum(task_workers, alpha0.shape[2] - 1)]
+        else:
+            task_alpha0 = alpha0
+        params = {'nclasses': nclasses, 'nscores': combiner.nscores, 'alpha0': task_alpha0, 'nu0': nu0,
+                  'K': len(task_workers)}
+        tasks.append((params, labels, gold[task_objects], task_workers, task_objects))
+
+    # data points with gold labels but no crowd labels still count towards kappa
+    labelled = np.zeros(N, dtype=bool)
+    labelled[objects] = True
+    gold_only = (~labelled) & (gold > -1)
+    gold_counts = np.zeros(nclasses)
+    for j in range(nclasses):
+        gold_counts[j] = np.sum(gold[gold_only] == j)
+
+    lnkappa = psi(nu0) - psi(np.sum(nu0))
+    task_E_t = [None] * len(tasks)
+    results = None
+    pool = None
+    if nprocesses != 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(nprocesses)
+    try:
+        for outer in range(max_outer_iterations):
+            fixed_lnkappa = lnkappa.reshape((nclasses, 1))
+            jobs = [(cls, params, settings, labels.copy(), task_gold, fixed_lnkappa, task_E_t[i])
+                    for i, (params, labels, task_gold, _, _) in enumerate(tasks)]
+            if pool is not None:
+                results = pool.map(_solve_task, jobs)
+            else:
+                results = [_solve_task(job) for job in jobs]
+            task_E_t = [result[0] for result in results]
+
+            nu = nu0 + gold_counts + np.sum([np.sum(E_t, axis=0) for E_t in task_E_t], axis=0)
+            new_lnkappa = psi(nu) - psi(np.sum(nu))
+            change = np.max(np.abs(new_lnkappa - lnkappa))
+            lnkappa = new_lnkappa
+            logging.debug('IBCC components: outer iteration %i, change in lnkappa %f, max inner iterations %i' %
+                          (outer, change, max(result[3] for result in results)))
+            if change < tol:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # assemble the results for the whole data set
+    E_t = np.zeros((N, nclasses)) + (np.exp(lnkappa) / np.sum(np.exp(lnkappa)))[np.newaxis, :]
+    for j in range(nclasses):
+        E_t[gold_only & (gold == j), :] = 0
+        E_t[gold_only & (gold == j), j] = 1
+    alpha = np.zeros((nclasses, combiner.nscores, K)) + (alpha0[:, :, :1] if alpha0.ndim == 3 else alpha0[:, :, None])
+    lnPi = np.zeros((nclasses, combiner.nscores, K))
+    lnPi[:] = psi(alpha) - psi(np.sum(alpha, axis=1))[:, np.newaxis, :]
+    for (_, _, _, task_workers, task_objects), result in zip(tasks, results):
+        E_t[task_objects, :] = result[0]
+        alpha[:, :, task_workers] = result[1]
+        lnPi[:, :, task_workers] = result[2]
+
+    combiner.E_t = E_t
+    combiner.alpha = alpha
+    combiner.lnPi = lnPi
+    combiner.nu = nu.reshape((nclasses, 1))
+    combiner.lnkappa = lnkappa.reshape((nclasses, 1))
+    combiner.K = K
+    combiner.nIts = outer + 1
+    combiner.ncomponents = ncomponents
+    return E_t
@@ -0,0 +1,119 @@
+'''
+Timers, counters and peak memory tracking for the phases of a combiner run. Attach a PhaseProfiler to an IBCC object
+(or any of its subclasses) to see where the time goes inside combine_classifications:
+
+    combiner.profiler = PhaseProfiler(jsonl_file='./output/profile.jsonl')
+    combiner.combine_classifications(crowdlabels)
+    report = combiner.profile_report()
+
+'''
+import json, time, tracemalloc
+from contextlib import contextmanager
+
+class PhaseProfiler(object):
+    '''
+    Records the wall-clock time, number of calls and peak memory of each named phase. Peak memory is the largest
+    increase in memory allocated through Python (including numpy arrays) while the phase was running, measured with
+    tracemalloc. Phases may be nested; the peak of an inner phase also counts towards the phase that contains it.
+
+    Parameters
+    ----------
+
+    trace_memory : bool
+        Record peak memory for each phase. Starts tracemalloc if it is not already running, which slows down code that
+        makes many small allocations, so set this to False if you only need timings.
+    jsonl_file : string or file-like object
+        Optional path or open stream. If set, a JSON object is written on a new line each time a phase finishes.
+    '''
+    def __init__(self, trace_memory=True, jsonl_file=None):
+        self.trace_memory = trace_memory
+        self.jsonl_file = jsonl_file
+        self.combiner_name = None
+        self.nruns = 0
+        self.phases = {}
+        self.iterations = []
+        self._stack = []
+        self._stream = None
+        self._started_tracing = False
+
+    def start_run(self, combiner_name):
+        '''
+        Resets the records at the start of a call to combine_classifications.
+        '''
+        self.combiner_name = combiner_name
+        self.nruns += 1
+        self.phases = {}
+        self.iterations = []
+        self._stack = []
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.jsonl_file is not None and self._stream is None:
+            if hasattr(self.jsonl_file, 'write'):
+                self._stream = self.jsonl_file
+            else:
+                self._stream = open(self.jsonl_file, 'a')
+
+    def end_run(self):
+        if self._stream is not None and self._stream is not self.jsonl_file:
+            self._stream.close()
+        self._stream = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def phase(self, name, iteration=None):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # save the peak of the enclosing phase before we reset it
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+        else:
+            frame = [0, 0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            peak_bytes = 0
+            if tracing:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                peak_bytes = peak - frame[0]
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+            self._record(name, iteration, elapsed, peak_bytes)
+
+    def _record(self, name, iteration, elapsed, peak_bytes):
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0, 'peak_bytes': 0}
+            self.phases[name] = stats
+        stats['calls'] += 1
+        stats['total_time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        stats['peak_bytes'] = max(stats['peak_bytes'], peak_bytes)
+        if iteration is not None:
+            while len(self.iterations) <= iteration:
+                self.iterations.append({})
+            self.iterations[iteration][name] = self.iterations[iteration].get(name, 0.0) + elapsed
+        if self._stream is not None:
+            record = {'combiner': self.combiner_name, 'run': self.nruns, 'phase': name, 'iteration': iteration,
+                      'time': elapsed, 'peak_bytes': peak_bytes}
+            self._stream.write(json.dumps(record) + '\n')
+
+    def report(self):
+        '''
+        Returns a dictionary with the totals for each phase and the time spent in each phase for every iteration.
+        '''
+        phases = {}
+        for name, stats in self.phases.items():
+            phases[name] = dict(stats)
+            phases[name]['mean_time'] = stats['total_time'] / stats['calls']
+        return {'combiner': self.combiner_name, 'run': self.nruns, 'phases': phases,
+                'iterations': [dict(it) for it in self.iterations]}
@@ -0,0 +1,260 @@
+'''
+Long-lived asyncio service that answers queries for the current posterior of a subject given the labels received so
+far, using a trained IBCC model (or any of its variants). Concurrent queries are grouped into micro-batches that are
+scored with one vectorised computation, and the model can be replaced after a retrain without stopping the service:
+
+    service = ScoringService(combiner)
+    await service.start()
+    service.consume(source)             # apply label events from an asynchronous source
+    pT = await service.query(subject)   # posterior class probabilities for one subject
+    service.swap_model(new_combiner)    # later queries use the retrained model
+    await service.stop()
+
+'''
+import asyncio, logging
+import numpy as np
+from ibcc import score_labels
+
+
+class ModelSnapshot(object):
+    '''
+    The parts of a trained model that are needed for scoring, copied into compact arrays so that the combiner can be
+    retrained while the snapshot is in use.
+
+    Parameters
+    ----------
+
+    combiner : ibcc.IBCC
+        A model that has been trained with combine_classifications().
+    version : int or string
+        Label for this version of the model.
+    worker_ids : dictionary
+        Optional map from the worker IDs used in label events to the worker indexes used in training. Workers that are
+        not in the map are scored using the prior. If None, worker IDs are the training indexes.
+    dtype : numpy dtype
+        Type used to store the log confusion matrices. float32 halves the memory needed for large crowds.
+    '''
+    def __init__(self, combiner, version=None, worker_ids=None, dtype=np.float32):
+        self.table = combiner.lnpi_lookup_table().astype(dtype)
+        self.lnkappa = np.reshape(combiner.lnkappa, -1).astype(dtype)
+        self.K = self.table.shape[0] - 1
+        self.nscores = self.table.shape[1]
+        self.nclasses = self.table.shape[2]
+        self.version = version
+        self.worker_ids = worker_ids
+
+    def worker_indexes(self, workers):
+        if self.worker_ids is None:
+            return np.asarray(workers, dtype=int)
+        return np.array([self.worker_ids.get(w, self.K) for w in workers], dtype=int)
+
+
+class InMemoryEventSource(object):
+    '''
+    Stand-in for a stream of label events, e.g. for testing. Events are (worker, subject, score) tuples, published
+    with publish() and read by iterating over the source with "async for". Iteration ends after close() is called.
+    '''
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    def publish(self, worker, subject, score):
+        self._queue.put_nowait((worker, subject, score))
+
+    def close(self):
+        self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class ScoringService(object):
+    '''
+    Keeps the labels received so far for each subject and answers posterior queries for subjects with a frozen model.
+
+    Parameters
+    ----------
+
+    combiner : ibcc.IBCC or ModelSnapshot
+        The trained model to start with.
+    max_batch_size : int
+        Largest number of queries that are scored together.
+    max_delay : float
+        Time in seconds to wait after the first query in a batch for more queries to arrive. Longer delays give larger
+        batches at the cost of latency.
+    worker_ids : dictionary
+        Optional map from the worker IDs in label events to training indexes; see ModelSnapshot.
+    '''
+    def __init__(self, combiner, max_batch_size=1024, max_delay=0.001, worker_ids=None):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.model = None
+        self.swap_model(combiner, version=0, worker_ids=worker_ids)
+        self._labels = {} # subject -> ([workers], [scores])
+        self._queue = None
+        self._batcher = None
+        self._stopping = False # set while stop() runs, so that no new queries are accepted
+        self._consumers = []
+        # counters for monitoring
+        self.nbatches = 0
+        self.nqueries = 0
+        self.nevents = 0
+
+    def swap_model(self, combiner, version=None, worker_ids=None):
+        '''
+        Replaces the model used for scoring. Batches that are already being scored finish with the old model. Returns
+        the version of the new model, which defaults to one more than the current version.
+        '''
+        if isinstance(combiner, ModelSnapshot):
+            snapshot = combiner
+        else:
+            if version is None:
+                version = self.model.version + 1 if self.model is not None else 0
+            if worker_ids is None and self.model is not None:
+                worker_ids = self.model.worker_ids
+            snapshot = ModelSnapshot(combiner, version, worker_ids)
+        self.model = snapshot
+        logging.info('Scoring service now using model version %s' % str(snapshot.version))
+        return snapshot.version
+
+    def add_label(self, worker, subject, score):
+        '''
+        Records a label from a worker for a subject. Queries made after this call include the label.
+        '''
+        entry = self._labels.get(subject)
+        if entry is None:
+            entry = ([], [])
+            self._labels[subject] = entry
+        entry[0].append(worker)
+        entry[1].append(score)
+        self.nevents += 1
+
+    def consume(self, source):
+        '''
+        Starts a task that applies the (worker, subject, score) events from an asynchronous iterable, such as an
+        InMemoryEventSource, until the source ends. Returns the task.
+        '''
+        async def _consume():
+            async for worker, subject, score in source:
+                self.add_label(worker, subject, score)
+        task = asyncio.ensure_future(_consume())
+        self._consumers.append(task)
+        return task
+
+    def score_subjects(self, subjects, model=None):
+        '''
+        Scores a list of subjects in one vectorised computation and returns an nsubjects x nclasses array of posterior
+        class probabilities. Subjects without labels receive the class proportions.
+        '''
+        if model is None:
+            model = self.model
+        workers = []
+        scores = []
+        counts = np.zeros(len(subjects), dtype=int)
+        for i, subject in enumerate(subjects):
+            entry = self._labels.get(subject)
+            if entry is not None:
+                workers.extend(entry[0])
+                scores.extend(entry[1])
+                counts[i] = len(entry[0])
+        objects = np.repeat(np.arange(len(subjects)), counts)
+        return score_labels(model.table, model.lnkappa, model.worker_indexes(workers), objects,
+                            np.asarray(scores, dtype=float), len(subjects))
+
+    async def start(self):
+        if self._batcher is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._stopping = False
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self):
+        '''
+        Answers any queries that are waiting, then stops the batching task and any event consumers. Queries made after
+        stop() is called raise a RuntimeError.
+        '''
+        if self._batcher is None or self._stopping:
+            return
+        self._stopping = True
+        self._queue.put_nowait((None, None))
+        try:
+            await self._batcher
+        finally:
+            self._batcher = None
+            self._stopping = False
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def query(self, subject):
+        '''
+        Returns the posterior class probabilities for a subject given the labels received so far.
+        '''
+        if self._batcher is None:
+            raise RuntimeError('The scoring service has not been started.')
+        if self._stopping:
+            raise RuntimeError('The scoring service is stopping.')
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((subject, future))
+        return await future
+
+    async def _batch_loop(self):
+        stopping = False
+        try:
+            while not stopping:
+                batch = [await self._queue.get()]
+                if batch[0][1] is None:
+                    break
+                # give concurrent queries a chance to join the batch
+                await asyncio.sleep(self.max_delay)
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                stopping = any(future is None for _, future in batch)
+                self._answer(batch)
+            # answer the queries still queued behind the stop signal in batches
+            remaining = []
+            while not self._queue.empty():
+                remaining.append(self._queue.get_nowait())
+            for start in range(0, len(remaining), self.max_batch_size):
+                self._answer(remaining[start:start + self.max_batch_size])
+        except BaseException:
+            # e.g. the task was cancelled: do not leave any caller waiting
+            while not self._queue.empty():
+                _, future = self._queue.get_nowait()
+                if future is not None and not future.done():
+                    future.cancel()
+            raise
+
+    def _answer(self, batch):
+        '''
+        Scores the subjects of a batch of (subject, future) queries together and sets the result of each future. Skips
+        the stop signal and queries that were cancelled.
+        '''
+        batch = [item for item in batch if item[1] is not None and not item[1].done()]
+        if not batch:
+            return
+        subjects = list(dict.fromkeys(subject for subject, _ in batch))
+        try:
+            pT = self.score_subjects(subjects)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        rows = dict((subject, i) for i, subject in enumerate(subjects))
+        for subject, future in batch:
+            future.set_result(pT[rows[subject]].copy())
+        self.nbatches += 1
+        self.nqueries += len(batch)
@@ -0,0 +1,224 @@
+'''
+Vectorised generator for large synthetic crowds, e.g. for load-testing IBCC and its variants. All sampling is seeded
+and done in chunks of labels, so crowds with tens of millions of labels can be generated in seconds without building
+an N x K table.
+
+Example:
+
+    crowdlabels, truth = generate_crowd(N=1000000, K=50000, nclasses=3, density=10, confusion='clustered', seed=1)
+    combiner = IBCC(nclasses=3, nscores=3, K=50000)
+    pT = combiner.combine_classifications(crowdlabels)
+
+'''
+import numpy as np
+
+CONFUSION_MODELS = ('ibcc', 'clustered', 'drifting')
+
+
+def sample_classes(rng, N, nu0):
+    '''
+    Draws class proportions kappa ~ Dir(nu0) and a class for each of N objects.
+    '''
+    kappa = rng.dirichlet(nu0)
+    t = rng.choice(len(nu0), size=N, p=kappa)
+    return t, kappa
+
+
+def _dirichlet_rows(rng, params):
+    # Draws one sample from Dir(params[..., :]) for every row of params, using normalised gamma variables
+    g = rng.standard_gamma(params)
+    g /= np.sum(g, axis=-1)[..., np.newaxis]
+    return g
+
+
+def sample_confusion_matrices(rng, K, alpha0, confusion='ibcc', nclusters=10, cluster_precision=20.0):
+    '''
+    Draws a confusion matrix for each worker.
+
+    Parameters
+    ----------
+
+    alpha0 : nclasses x nscores numpy array
+        Dirichlet parameters for each row of the confusion matrices.
+    confusion : string
+        'ibcc' draws independent matrices for each worker from alpha0. 'clustered' first draws nclusters mean matrices
+        from alpha0 and cluster proportions from a symmetric Dirichlet, then draws each worker's matrix around the mean
+        of its cluster, with the concentration set by cluster_precision. 'drifting' draws matrices as for 'ibcc'; these
+        are the matrices at each worker's first label and the drift is added when sampling the scores.
+
+    Returns
+    -------
+
+    pi : K x nclasses x nscores numpy array
+        The confusion matrices.
+    clusters : K numpy array or None
+        The cluster of each worker when confusion='clustered'.
+    '''
+    nclasses, nscores = alpha0.shape
+    if confusion == 'clustered':
+        eta = _dirichlet_rows(rng, np.tile(alpha0[np.newaxis, :, :], (nclusters, 1, 1)))
+        weights = rng.dirichlet(np.ones(nclusters))
+        clusters = rng.choice(nclusters, size=K, p=weights)
+        pi = _dirichlet_rows(rng, eta[clusters] * cluster_precision + 1e-3)
+    elif confusion in ('ibcc', 'drifting'):
+        clusters = None
+        pi = _dirichlet_rows(rng, np.tile(alpha0[np.newaxis, :, :], (K, 1, 1)))
+    else:
+        raise ValueError('Unknown confusion model %s; expected one of %s' % (confusion, str(CONFUSION_MODELS)))
+    return pi, clusters
+
+
+def sample_worker_activity(rng, K, activity_exponent=1.5):
+    '''
+    Returns the probability that each label comes from each worker. Activity follows a Pareto distribution, so a few
+    workers provide most of the labels and most workers provide only a few. Set activity_exponent=None for uniform
+    activity; smaller exponents give longer tails.
+    '''
+    if activity_exponent is None:
+        return np.ones(K) / K
+    activity = rng.pareto(activity_exponent, K) + 1
+    return activity / np.sum(activity)
+
+
+def sample_assignments(rng, N, K, density, activity, min_labels=1, shuffle=True):
+    '''
+    Chooses which worker labels which object. Each object receives a Poisson-distributed number of labels with mean
+    density (at least min_labels), from workers drawn according to activity. If shuffle is True, the labels are put in
+    a random order to simulate the order in which they arrived; otherwise they are sorted by object.
+    '''
+    nlabels_per_obj = rng.poisson(density, N)
+    if min_labels:
+        nlabels_per_obj = np.maximum(nlabels_per_obj, min_labels)
+    index_type = np.int32 if N < 2**31 else np.int64
+    objects = np.repeat(np.arange(N, dtype=index_type), nlabels_per_obj)
+    workers = rng.choice(K, size=len(objects), p=activity).astype(np.int32 if K < 2**31 else np.int64)
+    if shuffle:
+        order = rng.permutation(len(objects))
+        objects = objects[order]
+        workers = workers[order]
+    return workers, objects
+
+
+def step_within_worker(workers, K):
+    '''
+    Returns the position of each label in the sequence of labels from the same worker, counting from 0.
+    '''
+    order = np.argsort(workers, kind='stable')
+    counts = np.bincount(workers, minlength=K)
+    starts = np.cumsum(counts) - counts
+    steps = np.empty(len(workers), dtype=np.int64)
+    steps[order] = np.arange(len(workers)) - np.repeat(starts, counts)
+    return steps
+
+
+def sample_scores(rng, pi, t, workers, objects, drift=None, progress=None, chunk_size=1000000):
+    '''
+    Draws a score for each label from the row of the worker's confusion matrix for the object's true class. If drift
+    is given (K x nclasses x nscores), the log probabilities of each worker's confusion matrix change linearly from
+    log(pi) at the worker's first label to log(pi) + drift at their last. progress gives the fraction of the worker's
+    sequence of labels that comes before each label.
+    '''
+    nlabels = len(workers)
+    nscores = pi.shape[2]
+    score_type = np.int8 if nscores < 128 else np.int32
+    scores = np.empty(nlabels, dtype=score_type)
+    if drift is not None:
+        lnpi = np.log(pi)
+    for start in range(0, nlabels, chunk_size):
+        end = min(start + chunk_size, nlabels)
+        w = workers[start:end]
+        j = t[objects[start:end]]
+        if drift is None:
+            rows = pi[w, j, :]
+        else:
+            rows = lnpi[w, j, :] + progress[start:end, np.newaxis] * drift[w, j, :]
+            rows -= np.max(rows, axis=1)[:, np.newaxis]
+            np.exp(rows, out=rows)
+        cum_rows = np.cumsum(rows, axis=1)
+        u = rng.random(end - start) * cum_rows[:, -1]
+        scores[start:end] = np.sum(u[:, np.newaxis] > cum_rows[:, :-1], axis=1)
+    return scores
+
+
+def generate_crowd(N, K, nclasses=2, nscores=None, density=5, confusion='ibcc', alpha0=None, nu0=None,
+                   nclusters=10, cluster_precision=20.0, drift_scale=1.0, activity_exponent=1.5, min_labels=1,
+                   shuffle=True, output='sparselist', seed=None):
+    '''
+    Generates a synthetic crowd with ground truth.
+
+    Parameters
+    ----------
+
+    N : int
+        Number of objects.
+    K : int
+        Number of workers.
+    nclasses : int
+        Number of target classes.
+    nscores : int
+        Number of scores the workers can assign. Defaults to nclasses.
+    density : float
+        Mean number of labels per object.
+    confusion : string
+        Model for the workers' confusion matrices: 'ibcc', 'clustered' or 'drifting'. See
+        sample_confusion_matrices().
+    alpha0 : nclasses x nscores numpy array
+        Dirichlet parameters for the rows of the confusion matrices. Defaults to ones with 2 added where the score
+        matches the class, i.e. workers are better than random.
+    nu0 : nclasses numpy array
+        Dirichlet parameters for the class proportions. Defaults to 10 for each class.
+    drift_scale : float
+        For the 'drifting' model, the standard deviation of the total change in each log probability in a worker's
+        confusion matrix between their first and last label.
+    activity_exponent : float
+        Pareto exponent for the worker activity. None gives uniform activity.
+    output : string
+        'sparselist' returns an nlabels x 3 float array with columns worker ID, object ID and score, which can be
+        passed straight to IBCC.combine_classifications(). 'compact' returns a dictionary of typed columns
+        ('workers', 'objects' and 'scores'), which takes less than half the memory.
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+
+    crowdlabels : nlabels x 3 numpy array or dictionary of numpy arrays
+        The labels in the format given by output.
+    truth : dictionary
+        The ground truth: 't' (N classes), 'kappa' (class proportions), 'pi' (K x nclasses x nscores confusion
+        matrices), 'clusters' (cluster of each worker or None) and 'drift' (K x nclasses x nscores or None).
+    '''
+    if nscores is None:
+        nscores = nclasses
+    if alpha0 is None:
+        alpha0 = np.ones((nclasses, nscores))
+        alpha0[np.arange(nclasses), np.arange(nclasses) % nscores] += 2
+    if nu0 is None:
+        nu0 = np.ones(nclasses) * 10
+    alpha0 = np.asarray(alpha0, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    t, kappa = sample_classes(rng, N, np.asarray(nu0, dtype=float).reshape(-1))
+    pi, clusters = sample_confusion_matrices(rng, K, alpha0, confusion, nclusters, cluster_precision)
+    activity = sample_worker_activity(rng, K, activity_exponent)
+    workers, objects = sample_assignments(rng, N, K, density, activity, min_labels, shuffle)
+    if confusion == 'drifting':
+        drift = rng.normal(0, drift_scale, size=pi.shape)
+        counts = np.bincount(workers, minlength=K)
+        progress = step_within_worker(workers, K) / np.maximum(counts[workers] - 1, 1).astype(float)
+    else:
+        drift = None
+        progress = None
+    scores = sample_scores(rng, pi, t, workers, objects, drift, progress)
+
+    truth = {'t': t, 'kappa': kappa, 'pi': pi, 'clusters': clusters, 'drift': drift}
+    if output == 'compact':
+        crowdlabels = {'workers': workers, 'objects': objects, 'scores': scores}
+    elif output == 'sparselist':
+        crowdlabels = np.empty((len(workers), 3))
+        crowdlabels[:, 0] = workers
+        crowdlabels[:, 1] = objects
+        crowdlabels[:, 2] = scores
+    else:
+        raise ValueError('Unknown output format %s' % output)
+    return crowdlabels, truth
@@ -0,0 +1,129 @@
+'''
+Helpers for the top-k sparse posteriors of IBCC. With many classes, e.g. species identification, most entries of E_t
+are negligible, so when IBCC.topk is set the posterior of each data point is stored as its k most probable classes
+plus the residual mass of all the others:
+
+    combiner.topk = 5
+    pT = combiner.combine_classifications(crowdlabels)  # N x nclasses scipy.sparse.csr_matrix
+    residual = combiner.E_t_residual                   # mass of the classes not in pT
+
+In each iteration the log joint probability is computed only for a set of candidate classes for each data point: its
+current top k and the classes matching the scores it received. The other classes are not evaluated one by one; their
+total mass is approximated by giving each of them the likelihood of the labels averaged over the classes that differ
+from the score, weighted by the class proportions. This is what lets the work per iteration scale with k and the
+number of labels rather than with the number of classes. In the updates of alpha and nu, the residual mass of a data
+point is spread over its other classes in proportion to kappa.
+'''
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+
+def unique_pairs(objects, classes, nclasses):
+    '''
+    Returns the unique (data point, class) pairs, sorted by data point then class.
+    '''
+    keys = np.unique(objects.astype(np.int64) * nclasses + classes)
+    return keys // nclasses, keys % nclasses
+
+
+def pair_lnjoint(pair_objects, pair_classes, labels, lnPi):
+    '''
+    Sums weight * lnPi[class, score, worker] over the labels of each pair's data point.
+
+    Parameters
+    ----------
+
+    pair_objects, pair_classes : numpy arrays
+        The data point and class of each pair.
+    labels : dictionary
+        The crowd labels sorted by data point, as built by IBCC._init_topk_labels(): 'indptr' (N+1 offsets into the
+        other arrays for each data point), 'workers', 'scores' and 'weights'.
+    lnPi : nclasses x nscores x K numpy array
+        Expected log confusion matrices.
+    '''
+    nlabels = np.diff(labels['indptr'])[pair_objects]
+    pair_of_entry = np.repeat(np.arange(len(pair_objects)), nlabels)
+    offsets = np.arange(len(pair_of_entry)) - np.repeat(np.cumsum(nlabels) - nlabels, nlabels)
+    label_of_entry = labels['indptr'][pair_objects][pair_of_entry] + offsets
+    values = labels['weights'][label_of_entry] * lnPi[pair_classes[pair_of_entry], labels['scores'][label_of_entry],
+                                                      labels['workers'][label_of_entry]]
+    return np.bincount(pair_of_entry, values, minlength=len(pair_objects))
+
+
+def background_lnpi(lnPi, kappa):
+    '''
+    Returns the log of the probability of each score from each worker averaged over the classes, weighted by kappa,
+    leaving out the class with the same index as the score: a data point whose candidates do not include class j did
+    not receive score j. The result is nscores x K.
+    '''
+    nclasses, nscores, _ = lnPi.shape
+    Pi = np.exp(lnPi)
+    kappa = kappa / np.sum(kappa)
+    average = np.tensordot(kappa, Pi, axes=(0, 0))
+    for l in range(min(nclasses, nscores)):
+        average[l] = (average[l] - kappa[l] * Pi[l, l]) / max(1 - kappa[l], 1e-12)
+    return np.log(np.maximum(average, 1e-300))
+
+
+def select_topk(objects, classes, lnp, lnrest, N, nclasses, k):
+    '''
+    Normalises the candidate log probabilities of each data point, together with the log mass of its remaining
+    classes, and keeps the k most probable candidates.
+
+    Parameters
+    ----------
+
+    objects, classes, lnp : numpy arrays
+        The data point, class and unnormalised log probability of each candidate.
+    lnrest : N numpy array
+        Unnormalised log mass of each data point's classes that are not candidates; -inf if there are none.
+
+    Returns
+    -------
+
+    E_t : N x nclasses csr_matrix
+        The probabilities of the top k classes of each data point.
+    residual : N numpy array
+        The mass of the other classes.
+    '''
+    order = np.lexsort((-lnp, objects))
+    objects = objects[order]
+    classes = classes[order]
+    lnp = lnp[order]
+    counts = np.bincount(objects, minlength=N)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(objects)) - np.repeat(starts, counts)
+
+    # the candidates of each data point are in descending order, so the first is the largest
+    rowmax = np.zeros(N) - np.inf
+    rowmax[counts > 0] = lnp[starts[counts > 0]]
+    rowmax = np.maximum(rowmax, lnrest)
+    p = np.exp(lnp - rowmax[objects])
+    norma = np.bincount(objects, p, minlength=N) + np.exp(lnrest - rowmax)
+    p /= norma[objects]
+
+    keep = rank < k
+    E_t = csr_matrix(coo_matrix((p[keep], (objects[keep], classes[keep])), shape=(N, nclasses)))
+    residual = np.maximum(1 - np.asarray(E_t.sum(axis=1)).reshape(-1), 0)
+    return E_t, residual
+
+
+def spread_residual(E_t, residual, kappa):
+    '''
+    Expresses the posteriors as E_t[i, j] = scale[i] * kappa[j] + correction[i, j], where the residual mass of each
+    data point is spread over its classes outside the top k in proportion to kappa, and correction is nonzero only
+    for the top k.
+
+    Returns
+    -------
+
+    scale : N numpy array
+    correction : N x nclasses csr_matrix
+    '''
+    kappa = kappa / np.sum(kappa)
+    rows = np.repeat(np.arange(E_t.shape[0]), np.diff(E_t.indptr))
+    topk_kappa = np.bincount(rows, kappa[E_t.indices], minlength=E_t.shape[0])
+    scale = residual / np.maximum(1 - topk_kappa, 1e-12)
+    correction = E_t.copy()
+    correction.data = E_t.data - scale[rows] * kappa[E_t.indices]
+    return scale, correction
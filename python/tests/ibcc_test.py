@@ -4,12 +4,49 @@ Created on 8 Apr 2015
 @author: edwin
 '''
 import unittest
-import ibcc
+import ibcc, ibccdata
+import asyncio, io, json, os, shutil, tempfile, tracemalloc
 import logging
 import numpy as np
-from dynibcc import DynIBCC
-from cbcc import CBCC
+from scipy.special import psi
+from ibccprofile import PhaseProfiler
+from ibccsynth import generate_crowd
+from ibcccache import ResultCache
+from ibccserve import ScoringService, InMemoryEventSource
+from ibccparallel import combine_by_components, connected_components
+from dynibcc import DynIBCC, lockstep_order, label_buckets
+from dynibccstream import DynIBCCStream
+from cbcc import CBCC, HCBCC
 from ibcc_balanced import BalancedIBCC
+from ibcc_shared import SharedConfusionIBCC
+
+class InplaceIBCC(ibcc.IBCC):
+    inplace_updates = True
+
+class LoopCBCC(CBCC):
+    # computes the responsibilities with the loop over clusters, classes and scores that CBCC used before it was
+    # vectorised
+    def expec_responsibilities(self):
+        self._count_labels()
+        loglikelihoods = np.zeros((self.K, self.nclusters))
+        self.cluster_lnPi = np.zeros((self.nclasses, self.nscores, self.nclusters))
+        psiSumAlpha = psi(np.sum(self.alpha, 1))
+        for s in range(self.nscores):
+            self.cluster_lnPi[:, s, :] = psi(self.alpha[:, s, :]) - psiSumAlpha
+        for cl in range(self.nclusters):
+            for j in range(self.nclasses):
+                data = []
+                for l in range(self.nscores):
+                    if self.table_format_flag:
+                        data_l = self.C[l] * self.cluster_lnPi[j, l, cl]
+                    else:
+                        data_l = self.C[l].multiply(self.cluster_lnPi[j, l, cl])
+                    data = data_l if data == [] else data + data_l
+                loglikelihoods[:, cl:cl+1] += data.T.dot(self.E_t[:, j][:, np.newaxis])
+        weighted_log_prob = loglikelihoods + self.logw[np.newaxis, :]
+        log_prob_norm = np.log(np.sum(np.exp(weighted_log_prob), axis=1))
+        self.lnr = weighted_log_prob - log_prob_norm[:, np.newaxis]
+        self.r = np.exp(self.lnr)
 
 def check_accuracy(pT, target_acc, goldfile='./data/gold_verify.csv'):
     # check values are in tolerance range
@@ -35,6 +72,12 @@ def check_accuracy_multi(pT, target_acc, goldfile='./data/gold5_verify.csv'):
     logging.info( "accuracy is %f, nerrors=%i" % (acc, nerrors))
     assert acc==target_acc
     
+def crowd_table(crowdlabels, N, K):
+    # converts a synthetic sparse list to the table format, with NaN where a worker did not label a data point
+    table = np.zeros((N, K)) + np.nan
+    table[crowdlabels[:, 1].astype(int), crowdlabels[:, 0].astype(int)] = crowdlabels[:, 2]
+    return table
+
 def check_outputsize(pT, combiner, shape=(2,2,5), ptlength=100):
     # check output has right number of data points
     assert pT.shape[0]==ptlength
@@ -167,8 +210,249 @@ class Test(unittest.TestCase):
         configFile = './config/table_gold5_lowerbound.py'
         pT, combiner = ibcc.load_and_run_ibcc(configFile, ibcc_class=DynIBCC)
         check_outputsize(pT, combiner, (5,5,500))
-        check_accuracy_multi(pT, 1) 
- 
+        check_accuracy_multi(pT, 1)
+
+    def testSynthetic_lockstep_dyn(self):
+        crowdlabels, truth = generate_crowd(300, 20, nclasses=3, density=4, confusion='drifting', seed=3)
+        agents = crowdlabels[:, 0].astype(int)
+        order, nactive, ranked = lockstep_order(agents, 20)
+        assert np.array_equal(np.sort(order), np.arange(len(agents))) and np.all(np.diff(nactive) <= 0)
+        offsets = np.cumsum(nactive) - nactive
+        for s in range(len(nactive)):
+            # the workers with a label at each step are the first ones in the ranking
+            assert np.array_equal(agents[order[offsets[s]:offsets[s] + nactive[s]]], ranked[:nactive[s]])
+        for k in range(20):
+            # each worker's labels are visited in time order
+            taus = order[agents[order] == k]
+            assert np.array_equal(taus, np.flatnonzero(agents == k))
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+        pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels=goldlabels)
+        assert combiner.alpha.shape == (3, 3, len(agents))
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.7
+
+    def testSynthetic_table_dyn(self):
+        # when every worker labels every data point, row by row, the table and the sparse list give the same chains
+        rng = np.random.default_rng(5)
+        N, K = 60, 50
+        truth = rng.integers(0, 3, N)
+        correct = rng.random((N, K)) < 0.7
+        table = np.where(correct, truth[:, np.newaxis], rng.integers(0, 3, (N, K))).astype(float)
+        objects, workers = np.meshgrid(np.arange(N), np.arange(K), indexing='ij')
+        crowdlabels = np.stack((workers.ravel(), objects.ravel(), table.ravel()), axis=1)
+        goldlabels = np.zeros(N) - 1
+        goldlabels[:5] = truth[:5]
+        alpha0 = np.ones((3, 3)) + np.eye(3)
+        combiner_table = DynIBCC(nclasses=3, nscores=3, alpha0=alpha0, nu0=np.ones(3) * 10)
+        pT_table = combiner_table.combine_classifications(table, goldlabels=goldlabels.copy(), table_format=True)
+        combiner_list = DynIBCC(nclasses=3, nscores=3, alpha0=alpha0, nu0=np.ones(3) * 10)
+        pT_list = combiner_list.combine_classifications(crowdlabels, goldlabels=goldlabels.copy())
+        assert combiner_table.alpha.shape == (3, 3, N * K)
+        assert np.allclose(combiner_table.alpha, combiner_list.alpha)
+        assert np.allclose(pT_table, pT_list)
+
+    def testSynthetic_checkpointed_dyn(self):
+        crowdlabels, truth = generate_crowd(300, 10, nclasses=3, density=4, confusion='drifting', seed=6)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        results = []
+        for checkpointed, tau_dtype in [(False, np.float64), (True, np.float64), (True, np.float32)]:
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.checkpointed_smoothing = checkpointed
+            combiner.tau_dtype = tau_dtype
+            combiner.max_iterations = 10
+            pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels=goldlabels.copy())
+            assert combiner.alpha.dtype == tau_dtype and combiner.lnPi.dtype == tau_dtype
+            results.append((pT, combiner.alpha))
+        # recomputing the filter from the checkpoints gives the same result as keeping every time-step
+        assert np.array_equal(results[0][0], results[1][0]) and np.array_equal(results[0][1], results[1][1])
+        assert np.allclose(results[0][0], results[2][0], atol=1e-4)
+        assert np.allclose(results[0][1], results[2][1], rtol=1e-4)
+
+    def testSynthetic_parallel_dyn(self):
+        crowdlabels, truth = generate_crowd(200, 12, nclasses=3, density=4, confusion='drifting', seed=8)
+        table = np.zeros((200, 12)) - 1
+        table[crowdlabels[:, 1].astype(int), crowdlabels[:, 0].astype(int)] = crowdlabels[:, 2]
+        goldlabels = np.zeros(200) - 1
+        goldlabels[:20] = truth['t'][:20]
+        for labels, table_format in [(crowdlabels, False), (table, True)]:
+            results = []
+            for nprocesses in [1, 2]:
+                combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+                combiner.nprocesses = nprocesses
+                combiner.max_iterations = 5
+                pT = combiner.combine_classifications(labels.copy(), goldlabels=goldlabels.copy(),
+                                                      table_format=table_format)
+                assert combiner._filter_pool is None
+                results.append((pT, combiner.alpha))
+            # each process runs the same filter on its own workers' chains
+            assert np.allclose(results[0][0], results[1][0]) and np.allclose(results[0][1], results[1][1])
+
+    def testSynthetic_buckets_dyn(self):
+        agents = np.array([0, 1, 0, 0, 1, 0, 1, 0])
+        buckets, bucket_agents = label_buckets(agents, 2, size=2)
+        assert np.array_equal(buckets, [0, 1, 0, 2, 1, 2, 3, 4]) and np.array_equal(bucket_agents, [0, 1, 0, 1, 0])
+        times = np.array([0.5, 0.2, 0.9, 1.1, 3.5, 1.7, 3.6, 2.0])
+        buckets, bucket_agents = label_buckets(agents, 2, times=times, interval=1.0)
+        assert np.array_equal(buckets, [0, 1, 0, 2, 3, 2, 3, 4]) and np.array_equal(bucket_agents, [0, 1, 0, 1, 0])
+
+        crowdlabels, truth = generate_crowd(300, 10, nclasses=3, density=5, confusion='drifting', seed=9)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        # times, after a column of weights, that put every five labels of each worker in the same window
+        position = np.zeros(len(crowdlabels))
+        counts = np.zeros(10, dtype=int)
+        for i, k in enumerate(crowdlabels[:, 0].astype(int)):
+            position[i] = counts[k]
+            counts[k] += 1
+        results = []
+        for size, timestamp_column in [(5, None), (None, 4)]:
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.bucket_size = size
+            combiner.timestamp_column = timestamp_column
+            combiner.bucket_interval = 5
+            combiner.max_iterations = 10
+            pT = combiner.combine_classifications(np.column_stack((crowdlabels, np.ones(len(position)), position)), goldlabels=goldlabels)
+            assert combiner.Tau == np.sum(np.ceil(counts / 5.0)) and combiner.alpha.shape == (3, 3, combiner.Tau)
+            assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.7
+            results.append((pT, combiner.alpha))
+        assert np.array_equal(results[0][0], results[1][0]) and np.array_equal(results[0][1], results[1][1])
+
+    def testSynthetic_bucket_fractionalTimes_dyn(self):
+        crowdlabels, truth = generate_crowd(300, 10, nclasses=3, density=5, confusion='drifting', seed=9)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        # fractional times that put every five labels of each worker in the same window, which rounding would merge
+        position = np.zeros(len(crowdlabels))
+        counts = np.zeros(10, dtype=int)
+        for i, k in enumerate(crowdlabels[:, 0].astype(int)):
+            position[i] = counts[k]
+            counts[k] += 1
+        results = []
+        for size, timestamp_column in [(5, None), (None, 3)]:
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.discretedecisions = True
+            combiner.bucket_size = size
+            combiner.timestamp_column = timestamp_column
+            combiner.bucket_interval = 0.625
+            combiner.max_iterations = 10
+            labels = crowdlabels if timestamp_column is None else np.column_stack((crowdlabels, position / 8))
+            pT = combiner.combine_classifications(labels.copy(), goldlabels=goldlabels)
+            assert combiner.Tau == np.sum(np.ceil(counts / 5.0))
+            results.append(pT)
+        assert np.array_equal(results[0], results[1])
+        # every label needs a time
+        times = position / 8
+        times[7] = np.nan
+        combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+        combiner.timestamp_column = 3
+        combiner.bucket_interval = 0.625
+        self.assertRaises(ValueError, combiner.combine_classifications, np.column_stack((crowdlabels, times)),
+                          goldlabels=goldlabels)
+
+    def testSynthetic_bucket_weights_dyn(self):
+        crowdlabels, truth = generate_crowd(300, 10, nclasses=3, density=5, confusion='drifting', seed=9)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        weights = np.ones(len(crowdlabels))
+        weights[::4] = 2.5
+        weights[1::4] = np.nan
+        missing = crowdlabels.copy()
+        missing[1::4, 2] = -1
+        for size in (None, 5):
+            # labels with a missing weight count for nothing, like labels with a missing score
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.bucket_size = size
+            combiner.max_iterations = 10
+            pT_missing = combiner.combine_classifications(np.column_stack((missing, np.ones(len(weights)))),
+                                                          goldlabels=goldlabels.copy())
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.bucket_size = size
+            combiner.max_iterations = 10
+            unweighted = np.column_stack((crowdlabels, np.ones(len(weights))))
+            unweighted[1::4, 3] = 0
+            pT_zero = combiner.combine_classifications(unweighted, goldlabels=goldlabels.copy())
+            assert np.allclose(pT_zero, pT_missing)
+            combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+            combiner.bucket_size = size
+            combiner.max_iterations = 10
+            pT = combiner.combine_classifications(np.column_stack((crowdlabels, weights)), goldlabels=goldlabels.copy())
+            assert not np.allclose(pT, pT_zero)
+            assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.7
+            # each label's log likelihood is scaled by its weight
+            combiner._lnjoint(alldata=True)
+            scores = crowdlabels[:, 2].astype(int)
+            lnp_labels = combiner.lnPi[0, scores, combiner.Ctaus] * np.nan_to_num(weights)
+            expected = np.bincount(combiner.Cobjects, lnp_labels, minlength=combiner.N) + combiner.lnkappa[0]
+            assert np.allclose(combiner.lnpCT[:, 0], expected)
+
+    def testSynthetic_lnjoint_dyn(self):
+        crowdlabels, truth = generate_crowd(2000, 50, nclasses=3, density=3, confusion='drifting', seed=10)
+        # spread the worker IDs out so that an N x K array would need gigabytes
+        crowdlabels[:, 0] *= 20000
+        # a worker who labels the same data point twice
+        crowdlabels = np.concatenate((crowdlabels, crowdlabels[:1]))
+        combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+        combiner.max_iterations = 3
+        goldlabels = np.zeros(2000) - 1
+        goldlabels[:100] = truth['t'][:100]
+        combiner.combine_classifications(crowdlabels, goldlabels=goldlabels)
+        combiner._lnjoint(alldata=True)
+        scores = crowdlabels[:, 2].astype(int)
+        for j in range(3):
+            expected = np.bincount(combiner.Cobjects, combiner.lnPi[j, scores, combiner.Ctaus], minlength=combiner.N)
+            assert np.allclose(combiner.lnpCT[:, j], expected + combiner.lnkappa[j])
+
+    def testSynthetic_fractional_dyn(self):
+        crowdlabels, truth = generate_crowd(300, 10, nclasses=3, density=4, confusion='drifting', seed=11)
+        crowdlabels[::2, 2] = np.minimum(crowdlabels[::2, 2] + 0.25, 2)
+        crowdlabels[1, 2] = -1
+        # without gold labels, every data point is a test point
+        combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+        combiner.max_iterations = 5
+        pT = combiner.combine_classifications(crowdlabels.copy())
+        assert pT.shape == (300, 3) and np.all(np.isfinite(pT))
+        assert combiner.C[1].dtype == np.float64 and combiner.Cagents.dtype == np.int32
+        # fractional scores are split between the two nearest scores
+        scores = crowdlabels[:, 2]
+        for l in range(3):
+            expected = np.maximum(0, 1 - np.abs(scores - l))
+            expected[1] = 0
+            assert np.allclose(combiner.C[l], expected)
+        assert np.allclose(combiner.Cknown, scores >= 0)
+
+    def testSynthetic_stream_dyn(self):
+        rng = np.random.RandomState(1)
+        t = rng.randint(0, 3, 200)
+        for lag in [0, 5]:
+            stream = DynIBCCStream(nclasses=3, nscores=3, nu0=np.ones(3) * 10, lag=lag)
+            for i in range(200):
+                for k in range(6):
+                    stream.add_label(k, i, t[i] if rng.rand() < 0.8 else rng.randint(0, 3))
+                # worker 'x' turns adversarial half way through
+                stream.add_label('x', i, t[i] if i < 100 else (t[i] + 1) % 3)
+                if i == 99:
+                    assert np.all(np.diag(stream.confusion_matrix('x')) > 0.7)
+            assert np.all(np.diag(stream.confusion_matrix('x')) < 0.3)
+            pT = stream.posterior(range(200))
+            assert np.allclose(np.sum(pT, axis=1), 1)
+            assert np.mean(np.argmax(pT, axis=1) == t) > 0.95
+            assert stream.nlabels == 1400 and len(stream.workers) == 7
+
+    def testSynthetic_stream_from_combiner_dyn(self):
+        crowdlabels, truth = generate_crowd(200, 10, nclasses=3, density=4, confusion='drifting', seed=7)
+        goldlabels = np.zeros(200) - 1
+        goldlabels[:20] = truth['t'][:20]
+        combiner = DynIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3) * 10)
+        combiner.max_iterations = 10
+        combiner.combine_classifications(crowdlabels, goldlabels=goldlabels)
+        stream = DynIBCCStream.from_combiner(combiner)
+        seen, last_tau = combiner._last_taus()
+        for k in np.flatnonzero(seen):
+            assert np.allclose(stream.alpha(k), combiner.alpha[:, :, last_tau[k]])
+        assert np.allclose(stream.posterior(['new']), np.exp(combiner.lnkappa).T / np.sum(np.exp(combiner.lnkappa)))
+
 # Clustering BCC---------------------------------------------------------------------------------------------------------
      
     def test_SparseList_withGold_cbcc(self):
@@ -212,8 +496,118 @@ class Test(unittest.TestCase):
         pT, combiner = ibcc.load_and_run_ibcc(configFile, ibcc_class=CBCC)
         check_outputsize(pT, combiner, (5,5, combiner.nclusters
                                         ))
-        check_accuracy_multi(pT, 0.99)  
+        check_accuracy_multi(pT, 0.99)
+
+    def testSynthetic_responsibilities_cbcc(self):
+        crowdlabels, truth = generate_crowd(500, 20, nclasses=3, density=4, seed=11)
+        combiner = CBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nclusters=5, K=20)
+        combiner.N = 500
+        combiner.table_format_flag = False
+        combiner.discretedecisions = False
+        combiner._preprocess_crowdlabels(crowdlabels)
+        rng = np.random.RandomState(11)
+        combiner.E_t = rng.dirichlet(np.ones(3), 500)
+        combiner.alpha = rng.rand(3, 3, 5) * 5 + 1
+        combiner.logw = np.log(np.ones(5) / 5)
+        combiner.expec_responsibilities()
+        # log likelihood of each worker's labels under each cluster's confusion matrix, summed label by label
+        loglikelihoods = np.zeros((20, 5))
+        for k, i, l in crowdlabels[:, :3].astype(int):
+            loglikelihoods[k] += combiner.E_t[i].dot(combiner.cluster_lnPi[:, l, :])
+        expected = np.exp(loglikelihoods - np.max(loglikelihoods, axis=1)[:, np.newaxis])
+        expected /= np.sum(expected, axis=1)[:, np.newaxis]
+        assert np.allclose(combiner.r, expected)
+
+    def testSynthetic_alpha_cbcc(self):
+        crowdlabels, truth = generate_crowd(500, 20, nclasses=3, density=4, seed=12)
+        combiner = CBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nclusters=5, K=20)
+        combiner.N = 500
+        combiner.table_format_flag = False
+        combiner.discretedecisions = False
+        # the first 100 objects are training data
+        combiner.trainidxs = np.arange(500) < 100
+        combiner.Ntrain = 100
+        combiner.testidxs = np.invert(combiner.trainidxs)
+        combiner.Ntest = 400
+        combiner._preprocess_crowdlabels(crowdlabels)
+        combiner.alpha0 = np.repeat(combiner.alpha0[:, :, np.newaxis], 5, axis=2)
+        rng = np.random.RandomState(12)
+        combiner.E_t = rng.dirichlet(np.ones(3), 500)
+        combiner.alpha = rng.rand(3, 3, 5) * 5 + 1
+        combiner.logw = np.log(np.ones(5) / 5)
+        combiner._post_alpha()
+        # each label adds the expected class of its object times the worker's responsibility for each cluster
+        expected = combiner.alpha0.copy()
+        for k, i, l in crowdlabels[:, :3].astype(int):
+            expected[:, l, :] += np.outer(combiner.E_t[i], combiner.r[k])
+        assert np.allclose(combiner.alpha, expected)  
  
+    def testSynthetic_cbcc(self):
+        crowdlabels, truth = generate_crowd(500, 40, nclasses=2, density=5, confusion='clustered', nclusters=3, seed=20)
+        goldlabels = np.zeros(500) - 1
+        goldlabels[:50] = truth['t'][:50]
+        for table_format in (False, True):
+            data = crowd_table(crowdlabels, 500, 40) if table_format else crowdlabels.copy()
+            combiner = CBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), nclusters=10,
+                            K=40)
+            combiner.uselowerbound = True
+            combiner.conv_check_freq = 1
+            bounds = []
+            pT = combiner.combine_classifications(data, goldlabels.copy(), table_format=table_format,
+                                                  callback=lambda n, change, L: bounds.append(L))
+            assert combiner.stop_reason == 'converged'
+            assert np.all(np.diff(np.array(bounds).reshape(-1)) > -1e-6)
+            assert pT.shape == (500, 2) and np.allclose(np.sum(pT, axis=1), 1)
+            assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.85
+            assert combiner.alpha.shape == (2, 2, 10) and combiner.lnPi.shape == (2, 2, 40)
+            assert np.allclose(np.sum(combiner.r, axis=1), 1)
+            # the gold labels are kept
+            assert np.all(np.argmax(pT[:50], axis=1) == truth['t'][:50])
+
+    def testSynthetic_activeWorkers_cbcc(self):
+        # a few workers with thousands of labels each, whose log likelihoods are far too small for np.exp
+        crowdlabels, truth = generate_crowd(2000, 10, nclasses=2, density=8, activity_exponent=None, seed=22)
+        combiner = CBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), nclusters=5, K=10)
+        pT = combiner.combine_classifications(crowdlabels.copy())
+        assert np.all(np.isfinite(combiner.r)) and np.allclose(np.sum(combiner.r, axis=1), 1)
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.9
+
+    def testSynthetic_loop_cbcc(self):
+        crowdlabels, truth = generate_crowd(300, 30, nclasses=3, density=4, confusion='clustered', nclusters=3, seed=21)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        for table_format in (False, True):
+            results = []
+            for combiner_class in (CBCC, LoopCBCC):
+                data = crowd_table(crowdlabels, 300, 30) if table_format else crowdlabels.copy()
+                combiner = combiner_class(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3),
+                                          nclusters=10, K=30)
+                pT = combiner.combine_classifications(data, goldlabels.copy(), table_format=table_format)
+                assert combiner.stop_reason == 'converged'
+                results.append((pT, combiner.r, combiner.alpha, combiner.nIts))
+            # the vectorised responsibilities follow the same path as the loop over clusters
+            assert np.allclose(results[0][0], results[1][0]) and np.allclose(results[0][1], results[1][1])
+            assert np.allclose(results[0][2], results[1][2]) and results[0][3] == results[1][3]
+            assert np.mean(np.argmax(results[0][0], axis=1) == truth['t']) > 0.8
+
+    def testSynthetic_hcbcc(self):
+        crowdlabels, truth = generate_crowd(500, 40, nclasses=2, density=5, confusion='clustered', nclusters=3, seed=20)
+        goldlabels = np.zeros(500) - 1
+        goldlabels[:50] = truth['t'][:50]
+        for table_format in (False, True):
+            data = crowd_table(crowdlabels, 500, 40) if table_format else crowdlabels.copy()
+            combiner = HCBCC(nclasses=2, nscores=2, phi0=np.ones(2) * 10, gamma0=np.array([[3.0, 1], [1, 3]]),
+                             nu0=np.ones(2), cluster_prec_shape=np.ones(2) * 2, cluster_prec_scale=np.ones(2),
+                             nclusters=10, nworkers=40)
+            pT = combiner.combine_classifications(data, goldlabels.copy(), table_format=table_format)
+            assert combiner.stop_reason == 'converged'
+            assert pT.shape == (500, 2) and np.allclose(np.sum(pT, axis=1), 1)
+            assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.85
+            # each worker has their own posterior confusion matrix drawn from the cluster priors
+            assert combiner.alpha.shape == (2, 2, 40) and combiner.eta.shape == (2, 2, 10)
+            assert np.allclose(np.sum(combiner.r, axis=1), 1)
+            assert np.all(np.argmax(pT[:50], axis=1) == truth['t'][:50])
+
 # BALANCED IBCC -------------------------------------------------------------------------------------------------------
  
     def testSparseList_balanced(self):
@@ -244,6 +638,584 @@ class Test(unittest.TestCase):
         check_outputsize(pT, combiner, (5,5,5))
         check_accuracy_multi(pT, 1)      
           
+# IN-PLACE UPDATES ----------------------------------------------------------------------------------------------------
+
+    def testSynthetic_inplace(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=5)
+        goldlabels = np.zeros(1000) - 1
+        goldlabels[:100] = truth['t'][:100]
+        combiner = InplaceIBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.8
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        pT_default = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        assert np.allclose(pT, pT_default)
+
+    def testSynthetic_inplace_sparseAllocations(self):
+        N = 20000
+        crowdlabels, truth = generate_crowd(N, 50, nclasses=3, density=3, alpha0=np.ones((3, 3)) + 4 * np.eye(3),
+                                            seed=5)
+        combiner = InplaceIBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + np.eye(3), nu0=np.ones(3), K=50)
+        combiner.combine_classifications(crowdlabels.copy())
+        lnpCT = combiner.lnpCT.copy()
+        tracemalloc.start()
+        try:
+            combiner._lnjoint(alldata=True)
+            combiner._post_alpha()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # no N x nclasses temporary is created for any score
+        assert peak < N * 3 * 8 / 4
+        assert np.allclose(combiner.lnpCT, lnpCT)
+
+    def testSynthetic_table_5classes_inplace(self):
+        alpha0 = np.ones((5, 5)) + 4 * np.eye(5)
+        crowdlabels, truth = generate_crowd(500, 20, nclasses=5, density=6, alpha0=alpha0, seed=6)
+        table = crowd_table(crowdlabels, 500, 20)
+        goldlabels = np.zeros(500) - 1
+        goldlabels[:50] = truth['t'][:50]
+        combiner = InplaceIBCC(nclasses=5, nscores=5, alpha0=alpha0, nu0=np.ones(5), K=20)
+        pT = combiner.combine_classifications(table.copy(), goldlabels.copy(), table_format=True)
+        assert combiner.alpha.shape == (5, 5, 20)
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.8
+        combiner = ibcc.IBCC(nclasses=5, nscores=5, alpha0=alpha0, nu0=np.ones(5), K=20)
+        pT_default = combiner.combine_classifications(table.copy(), goldlabels.copy(), table_format=True)
+        assert np.allclose(pT, pT_default)
+
+# PROFILING -----------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_profiler(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=7)
+        goldlabels = np.zeros(1000) - 1
+        goldlabels[:100] = truth['t'][:100]
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        stream = io.StringIO()
+        combiner.profiler = PhaseProfiler(jsonl_file=stream)
+        combiner.combine_classifications(crowdlabels, goldlabels)
+        report = combiner.profile_report()
+        for phase in ['desparsify', 'gold_preprocessing', 'crowd_preprocessing', 'init', 'expec_lnkappa',
+                      'post_alpha', 'expec_lnpi', 'expec_t']:
+            assert phase in report['phases']
+        assert report['phases']['expec_t']['calls'] == combiner.nIts
+        assert len(report['iterations']) == combiner.nIts
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert len(records) == np.sum([p['calls'] for p in report['phases'].values()])
+
+# EARLY STOPPING ------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_callback(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=8)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        calls = []
+        def stop_after_three(nIts, change, L):
+            calls.append(nIts)
+            return nIts >= 3
+        pT = combiner.combine_classifications(crowdlabels, callback=stop_after_three)
+        assert calls == [1, 2, 3]
+        assert combiner.nIts == 3
+        assert combiner.stop_reason == 'callback'
+        assert pT.shape == (1000, 2)
+
+    def testSynthetic_cancelled(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=8)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        token = ibcc.CancellationToken()
+        token.cancel()
+        pT = combiner.combine_classifications(crowdlabels, cancel_token=token)
+        assert combiner.nIts == 0
+        assert combiner.stop_reason == 'cancelled'
+        assert np.allclose(np.sum(pT, axis=1), 1)
+
+    def testSynthetic_table_timeBudget(self):
+        alpha0 = np.ones((5, 5)) + 4 * np.eye(5)
+        crowdlabels, truth = generate_crowd(500, 20, nclasses=5, density=6, alpha0=alpha0, seed=9)
+        table = crowd_table(crowdlabels, 500, 20)
+        combiner = ibcc.IBCC(nclasses=5, nscores=5, alpha0=alpha0, nu0=np.ones(5), K=20, uselowerbound=True)
+        pT = combiner.combine_classifications(table.copy(), table_format=True, time_budget=0)
+        assert combiner.stop_reason == 'time_budget'
+        assert combiner.nIts == 0
+        pT = combiner.combine_classifications(table.copy(), table_format=True, time_budget=60)
+        assert combiner.stop_reason == 'converged'
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.8
+
+# SHARED CONFUSION MATRICES -------------------------------------------------------------------------------------------
+
+    def testSynthetic_sharedConfusion(self):
+        nclasses = 10
+        alpha0 = np.ones((nclasses, nclasses)) * 0.2 + 4 * np.eye(nclasses)
+        crowdlabels, truth = generate_crowd(2000, 100, nclasses=nclasses, density=4, alpha0=alpha0, seed=4)
+        combiner = ibcc.IBCC(nclasses=nclasses, nscores=nclasses, alpha0=np.ones((nclasses, nclasses)) + np.eye(nclasses),
+                             nu0=np.ones(nclasses), K=100)
+        pT = combiner.combine_classifications(crowdlabels.copy())
+        bounds = []
+        combiner = SharedConfusionIBCC(nclasses=nclasses, nscores=nclasses, alpha0=np.ones((nclasses, nclasses)),
+                                       nu0=np.ones(nclasses), K=100, uselowerbound=True)
+        combiner.conv_check_freq = 1
+        pT_shared = combiner.combine_classifications(crowdlabels.copy(), callback=lambda n, change, L: bounds.append(L))
+        assert np.all(np.diff(np.array(bounds).reshape(-1)) > -1e-6)
+        acc = np.mean(np.argmax(pT, axis=1) == truth['t'])
+        acc_shared = np.mean(np.argmax(pT_shared, axis=1) == truth['t'])
+        assert acc_shared > acc - 0.05
+        # only the shared matrix and two parameters per worker are stored
+        assert combiner.beta.shape == (nclasses, nclasses) and combiner.accuracy.shape == (100, 2)
+        assert combiner.memory_report()['alpha'] == 0
+        assert np.allclose(combiner.predict_proba(crowdlabels), pT_shared)
+
+    def testSynthetic_sharedConfusion_cache(self):
+        alpha0 = np.ones((3, 3)) + 2 * np.eye(3)
+        crowdlabels, truth = generate_crowd(500, 30, nclasses=3, density=5, alpha0=np.ones((3, 3)) + 5 * np.eye(3),
+                                            seed=19)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            combiner = SharedConfusionIBCC(nclasses=3, nscores=3, alpha0=alpha0, nu0=np.ones(3), K=30)
+            combiner.result_cache = ResultCache(cache_dir)
+            pT = combiner.combine_classifications(crowdlabels.copy())
+            assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.8
+            # a new combiner restores the shared matrix and accuracies from the cache, so it can score new labels
+            cached = SharedConfusionIBCC(nclasses=3, nscores=3, alpha0=alpha0, nu0=np.ones(3), K=30)
+            cached.result_cache = ResultCache(cache_dir)
+            pT_cached = cached.combine_classifications(crowdlabels.copy())
+            assert cached.stop_reason == 'cached' and np.allclose(pT_cached, pT)
+            new_labels = crowdlabels.copy()
+            new_labels[::3, 2] = new_labels[::3, 2] * 0.5 + 0.25
+            assert np.allclose(cached.predict_proba(new_labels), combiner.predict_proba(new_labels))
+        finally:
+            shutil.rmtree(cache_dir)
+        # the shared matrix links all of the workers, so the connected components cannot be solved separately
+        combiner = SharedConfusionIBCC(nclasses=3, nscores=3, alpha0=alpha0, nu0=np.ones(3), K=30)
+        self.assertRaises(ValueError, combine_by_components, combiner, crowdlabels, nprocesses=1)
+
+# TOP-K POSTERIORS ----------------------------------------------------------------------------------------------------
+
+    def testSynthetic_topk(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=3, density=5, seed=2)
+        goldlabels = np.zeros(1000) - 1
+        goldlabels[:100] = truth['t'][:100]
+        combiner = ibcc.IBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + 2 * np.eye(3), nu0=np.ones(3), K=50)
+        combiner.uselowerbound = False
+        pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        # keeping all of the classes gives the same result as the dense posteriors
+        combiner = ibcc.IBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + 2 * np.eye(3), nu0=np.ones(3), K=50)
+        combiner.topk = 3
+        pT_topk = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        assert np.allclose(pT, pT_topk.toarray())
+
+        nclasses = 20
+        alpha0 = np.ones((nclasses, nclasses)) * 0.1 + 5 * np.eye(nclasses)
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=nclasses, density=4, alpha0=alpha0, seed=2)
+        combiner = ibcc.IBCC(nclasses=nclasses, nscores=nclasses, alpha0=alpha0, nu0=np.ones(nclasses), K=50)
+        combiner.uselowerbound = False
+        pT = combiner.combine_classifications(crowdlabels.copy())
+        combiner = ibcc.IBCC(nclasses=nclasses, nscores=nclasses, alpha0=alpha0, nu0=np.ones(nclasses), K=50)
+        combiner.topk = 3
+        pT_topk = combiner.combine_classifications(crowdlabels.copy())
+        assert pT_topk.shape == (1000, nclasses) and np.max(np.diff(pT_topk.indptr)) <= 3
+        assert np.allclose(np.asarray(pT_topk.sum(axis=1)).reshape(-1) + combiner.E_t_residual, 1)
+        acc = np.mean(np.argmax(pT, axis=1) == truth['t'])
+        acc_topk = np.mean(np.asarray(pT_topk.argmax(axis=1)).reshape(-1) == truth['t'])
+        assert np.abs(acc - acc_topk) < 0.02
+
+    def testSynthetic_topk_inplace(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=3, density=5, seed=2)
+        results = []
+        for inplace_updates in (False, True):
+            combiner = ibcc.IBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + 2 * np.eye(3), nu0=np.ones(3), K=50)
+            combiner.topk = 2
+            combiner.inplace_updates = inplace_updates
+            results.append(combiner.combine_classifications(crowdlabels.copy()).toarray())
+        # the top-k updates ignore the in-place work buffers
+        assert combiner.workspace is None
+        assert np.allclose(results[0], results[1])
+        assert np.mean(np.argmax(results[1], axis=1) == truth['t']) > 0.8
+
+# INITIALISATION ------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_spectralInit(self):
+        crowdlabels, truth = generate_crowd(3000, 200, nclasses=2, density=5, alpha0=np.array([[2, 1], [1, 2]]), seed=1)
+        # a third of the workers are adversarial
+        adversarial = crowdlabels[:, 0] % 3 == 0
+        crowdlabels[adversarial, 2] = 1 - crowdlabels[adversarial, 2]
+        results = {}
+        for init_method in ('votes', 'spectral'):
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=200)
+            combiner.init_method = init_method
+            pT = combiner.combine_classifications(crowdlabels.copy())
+            results[init_method] = (pT, combiner.nIts)
+        assert np.allclose(results['votes'][0], results['spectral'][0], atol=1e-3)
+        assert results['spectral'][1] < results['votes'][1]
+        assert np.mean(np.argmax(results['spectral'][0], axis=1) == truth['t']) > 0.75
+
+    def testSynthetic_spectralInit_subclasses(self):
+        crowdlabels, truth = generate_crowd(300, 20, nclasses=2, density=5, alpha0=np.array([[3, 1], [1, 3]]), seed=1)
+        goldlabels = np.zeros(300) - 1
+        goldlabels[:30] = truth['t'][:30]
+        for combiner_class in (ibcc.IBCC, DynIBCC, SharedConfusionIBCC):
+            for table_format in (False, True):
+                with self.subTest(combiner_class=combiner_class.__name__, table_format=table_format):
+                    accuracy = {}
+                    for init_method in ('votes', 'spectral'):
+                        combiner = combiner_class(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2),
+                                                  nu0=np.ones(2), K=20)
+                        combiner.init_method = init_method
+                        if table_format:
+                            data = crowd_table(crowdlabels, 300, 20)
+                        else:
+                            data = crowdlabels.copy()
+                        pT = combiner.combine_classifications(data, goldlabels.copy(), table_format=table_format)
+                        assert pT.shape == (300, 2) and np.allclose(np.sum(pT, axis=1), 1)
+                        accuracy[init_method] = np.mean(np.argmax(pT, axis=1) == truth['t'])
+                    assert np.abs(accuracy['spectral'] - accuracy['votes']) < 0.02
+
+# CONNECTED COMPONENTS ------------------------------------------------------------------------------------------------
+
+    def testSynthetic_components(self):
+        # three crowds that never label the same data points
+        crowds = []
+        truths = []
+        for c in range(3):
+            crowdlabels, truth = generate_crowd(300, 20, nclasses=2, density=4, seed=c)
+            crowdlabels[:, 0] += 20 * c
+            crowdlabels[:, 1] += 300 * c
+            crowds.append(crowdlabels)
+            truths.append(truth['t'])
+        crowdlabels = np.concatenate(crowds, axis=0)
+        goldlabels = np.zeros(900) - 1
+        goldlabels[::10] = np.concatenate(truths)[::10]
+        ncomponents, label_components = connected_components(crowdlabels)
+        assert ncomponents == 3 and np.all(label_components[:len(crowds[0])] == label_components[0])
+
+        alpha0 = np.ones((2, 2)) + np.eye(2)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=60)
+        combiner.conv_threshold = 1e-8
+        combiner.max_iterations = 500
+        pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=60)
+        combiner.conv_threshold = 1e-8
+        combiner.max_iterations = 500
+        pT_components = combine_by_components(combiner, crowdlabels, goldlabels, nprocesses=2, min_batch_labels=1000,
+                                              tol=1e-8)
+        assert combiner.ncomponents == 3
+        assert np.allclose(pT, pT_components, atol=1e-3)
+        assert combiner.alpha.shape == (2, 2, 60)
+
+# DUPLICATE LABELS ----------------------------------------------------------------------------------------------------
+
+    def testSynthetic_duplicates(self):
+        crowdlabels, truth = generate_crowd(500, 30, nclasses=2, density=4, seed=17)
+        goldlabels = np.zeros(500) - 1
+        goldlabels[:50] = truth['t'][:50]
+        alpha0 = np.ones((2, 2)) + np.eye(2)
+        # every label given three times by the same worker
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+        pT_repeated = combiner.combine_classifications(np.tile(crowdlabels, (3, 1)), goldlabels.copy())
+        assert np.mean(np.argmax(pT_repeated, axis=1) == truth['t']) > 0.8
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+        combiner.compact_duplicates = False
+        pT_uncompacted = combiner.combine_classifications(np.tile(crowdlabels, (3, 1)), goldlabels.copy())
+        assert np.allclose(pT_repeated, pT_uncompacted)
+        # the same labels sent once with a weight column
+        weighted = np.concatenate((crowdlabels, np.zeros((crowdlabels.shape[0], 1)) + 3), axis=1)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+        pT_weighted = combiner.combine_classifications(weighted.copy(), goldlabels.copy())
+        assert np.allclose(pT_repeated, pT_weighted)
+        assert np.allclose(combiner.predict_proba(weighted), combiner.predict_proba(np.tile(crowdlabels, (3, 1))))
+
+    def testSynthetic_fractionalWeights(self):
+        crowdlabels, truth = generate_crowd(500, 30, nclasses=2, density=4, seed=18)
+        goldlabels = np.zeros(500) - 1
+        goldlabels[:50] = truth['t'][:50]
+        alpha0 = np.ones((2, 2)) + np.eye(2)
+        # labels with a missing weight count for nothing, rather than as a negative vote
+        nlabels = crowdlabels.shape[0]
+        weighted = np.concatenate((crowdlabels, np.ones((nlabels, 1))), axis=1)
+        weighted[::5, 3] = np.nan
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+        pT_nan = combiner.combine_classifications(weighted.copy(), goldlabels.copy())
+        assert np.all(combiner.C[0].data > 0) and np.all(combiner.C[1].data > 0)
+        assert np.allclose(combiner.predict_proba(weighted), combiner.predict_proba(np.delete(crowdlabels,
+                                                                                              np.s_[::5], axis=0)))
+        weighted[::5, 3] = 0
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+        pT_zero = combiner.combine_classifications(weighted.copy(), goldlabels.copy())
+        assert np.allclose(pT_nan, pT_zero)
+        # fractional weights are not rounded with the scores when decisions are discrete
+        for discretedecisions in (False, True):
+            weighted = np.concatenate((crowdlabels, np.zeros((nlabels, 1)) + 2.5), axis=1)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+            combiner.discretedecisions = discretedecisions
+            pT_weighted = combiner.combine_classifications(weighted, goldlabels.copy())
+            assert np.sum(combiner.C[0]) + np.sum(combiner.C[1]) == 2.5 * nlabels
+            repeated = np.concatenate((np.tile(crowdlabels, (5, 1)), np.zeros((5 * nlabels, 1)) + 0.5), axis=1)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=30)
+            combiner.discretedecisions = discretedecisions
+            combiner.compact_duplicates = False
+            pT_repeated = combiner.combine_classifications(repeated, goldlabels.copy())
+            assert np.allclose(pT_weighted, pT_repeated)
+
+# MEMORY ACCOUNTING ---------------------------------------------------------------------------------------------------
+
+    def testSynthetic_memory(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=16)
+        goldlabels = np.zeros(1000) - 1
+        goldlabels[:200] = truth['t'][:200]
+        alpha0 = np.ones((2, 2)) + np.eye(2)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=50)
+        nlabels = crowdlabels.shape[0]
+        estimate = combiner.estimate_memory(1000, 50, nlabels, Ntest=800, table_format=False)
+        pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        report = combiner.memory_report()
+        for name in ('C', 'alpha', 'lnPi', 'lnpCT'):
+            assert 0 < report[name] <= estimate[name]
+        assert report['total'] < estimate['peak']
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.85
+        # the work buffers make the in-place updates larger here, so the limit only switches to float32 crowd labels,
+        # and only for this run
+        for inplace_updates in (False, True):
+            assert combiner.estimate_memory(1000, 50, nlabels, 800, False, np.float32, inplace_updates)['peak'] < \
+                estimate['peak']
+        assert combiner.estimate_memory(1000, 50, nlabels, 800, False, np.float32, True)['peak'] > \
+            combiner.estimate_memory(1000, 50, nlabels, 800, False, np.float32, False)['peak']
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=50)
+        combiner.memory_limit = estimate['peak'] - 1
+        pT_limited = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+        assert combiner.C[0].dtype == np.float32 and combiner.workspace is None
+        assert combiner.label_dtype == np.float64 and not combiner.inplace_updates
+        assert np.allclose(pT_limited, pT)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=50)
+        combiner.memory_limit = 1000
+        self.assertRaises(MemoryError, combiner.combine_classifications, crowdlabels.copy(), goldlabels.copy())
+        # subclasses without the work buffers fall back to float32 crowd labels, and reject the in-place updates
+        for combiner_class in (DynIBCC, SharedConfusionIBCC):
+            combiner = combiner_class(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=50)
+            pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+            combiner = combiner_class(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=50)
+            combiner.memory_limit = estimate['peak'] - 1
+            pT_limited = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+            assert combiner.C[0].dtype == np.float32 and np.allclose(pT_limited, pT, atol=1e-4)
+            combiner.inplace_updates = True
+            self.assertRaises(ValueError, combiner.combine_classifications, crowdlabels.copy(), goldlabels.copy())
+
+# RESULT CACHE --------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_cache(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=15)
+        goldlabels = np.zeros(1000) - 1
+        goldlabels[:100] = truth['t'][:100]
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(cache_dir)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+            combiner.result_cache = cache
+            pT = combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+            assert combiner.stop_reason != 'cached' and cache.misses == 1
+            combiner_cached = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2),
+                                        K=50)
+            combiner_cached.result_cache = cache
+            pT_cached = combiner_cached.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+            assert combiner_cached.stop_reason == 'cached' and cache.hits == 1
+            assert np.array_equal(pT, pT_cached)
+            assert np.array_equal(combiner.alpha, combiner_cached.alpha)
+            # a different prior is a different key
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + 2 * np.eye(2), nu0=np.ones(2), K=50)
+            combiner.result_cache = cache
+            combiner.combine_classifications(crowdlabels.copy(), goldlabels.copy())
+            assert combiner.stop_reason != 'cached' and len(os.listdir(cache_dir)) == 2
+            # the least recently used entry is evicted first
+            cache.max_bytes = os.path.getsize(os.path.join(cache_dir, os.listdir(cache_dir)[0])) + 1
+            cache.evict()
+            assert len(os.listdir(cache_dir)) == 1
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testSynthetic_cache_subclassSettings(self):
+        crowdlabels, truth = generate_crowd(300, 20, nclasses=2, density=5, seed=15)
+        alpha0 = np.ones((2, 2)) + 2 * np.eye(2)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(cache_dir)
+            pT = {}
+            for bucket_size in (None, 5, None):
+                combiner = DynIBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=20)
+                combiner.bucket_size = bucket_size
+                combiner.result_cache = cache
+                pT_run = combiner.combine_classifications(crowdlabels.copy())
+                pT.setdefault(bucket_size, pT_run)
+                assert np.array_equal(pT_run, pT[bucket_size])
+            # changing the bucket size is a different key, and only the repeated run is a hit
+            assert cache.misses == 2 and cache.hits == 1
+            assert not np.allclose(pT[None], pT[5])
+            for accuracy0 in ([1.0, 1.0], [5.0, 1.0]):
+                combiner = SharedConfusionIBCC(nclasses=2, nscores=2, alpha0=alpha0, nu0=np.ones(2), K=20)
+                combiner.accuracy0 = np.array(accuracy0)
+                combiner.result_cache = cache
+                combiner.combine_classifications(crowdlabels.copy())
+                assert combiner.stop_reason != 'cached'
+            assert cache.misses == 4
+        finally:
+            shutil.rmtree(cache_dir)
+
+# APPENDED INPUT ------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_appendedRows(self):
+        crowdlabels, truth = generate_crowd(600, 30, nclasses=2, density=5, seed=16)
+        # the data points first labelled in the appended rows have IDs that sort before the existing ones
+        ids = np.where(crowdlabels[:, 1] < 500, crowdlabels[:, 1] + 1000, crowdlabels[:, 1] - 500)
+        rows = ['%i,%i,%i\n' % (k, i, score) for k, i, score in zip(crowdlabels[:, 0], ids, crowdlabels[:, 2])]
+        first = crowdlabels[:, 1] < 500
+        first[np.flatnonzero(first)[::10]] = False # some of the old data points also get new labels
+        lines = [rows[r] for r in np.flatnonzero(first)]
+        appended = [rows[r] for r in np.flatnonzero(~first)]
+        scores = np.array([0, 1])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            inputFile = os.path.join(tmp_dir, 'input.csv')
+            stateFile = os.path.join(tmp_dir, 'state.npz')
+            with open(inputFile, 'w') as f:
+                f.writelines(['worker,object,score\n'] + lines)
+            dh = ibccdata.DataHandler()
+            dh.input_file = inputFile
+            dh.table_format = False
+            dh.loadCrowdLabels(scores)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=dh.K)
+            labels = dh.crowdlabels.copy()
+            pT_first = combiner.combine_classifications(dh.crowdlabels)
+            ibcc._save_run_state(stateFile, dh, combiner, labels, pT_first)
+
+            with open(inputFile, 'a') as f:
+                f.writelines(appended)
+            previous = ibcc._load_run_state(stateFile)
+            dh = ibccdata.DataHandler()
+            dh.input_file = inputFile
+            dh.nclasses = 2
+            assert dh.loadAppendedCrowdLabels(scores, previous)
+            assert dh.appended_rows == len(appended)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=dh.K)
+            ibcc._warm_start(combiner, previous, dh)
+            # the previous posteriors stay with the same original IDs and the new data points have none
+            old_idxs = dh.map_ids_to_local_idxs(previous['targetidxs'])
+            assert np.array_equal(combiner.E_t[old_idxs], previous['E_t'])
+            assert np.sum(np.isnan(combiner.E_t[:, 0])) == dh.N - len(previous['targetidxs'])
+            pT = combiner.combine_classifications(dh.crowdlabels)
+            pT = dh.map_predictions_to_original_IDs(pT)
+
+            dh_full = ibccdata.DataHandler()
+            dh_full.input_file = inputFile
+            dh_full.nclasses = 2
+            dh_full.loadCrowdLabels(scores)
+            combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2),
+                                 K=dh_full.K)
+            pT_full = dh_full.map_predictions_to_original_IDs(combiner.combine_classifications(dh_full.crowdlabels))
+            assert np.allclose(pT, pT_full, atol=0.05)
+            assert np.array_equal(np.argmax(pT, axis=1), np.argmax(pT_full, axis=1))
+            # changing an earlier row means the whole file is reloaded
+            with open(inputFile, 'w') as f:
+                f.writelines(['worker,object,score\n', '0,1000,1\n'] + lines[1:] + appended)
+            dh = ibccdata.DataHandler()
+            dh.input_file = inputFile
+            assert not dh.loadAppendedCrowdLabels(scores, previous)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+# FROZEN MODEL PREDICTIONS --------------------------------------------------------------------------------------------
+
+    def testSynthetic_predict(self):
+        crowdlabels, truth = generate_crowd(1000, 50, nclasses=2, density=4, seed=13)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=50)
+        pT = combiner.combine_classifications(crowdlabels.copy())
+        pT_frozen = combiner.predict_proba(crowdlabels)
+        assert np.allclose(pT_frozen, pT)
+        # a worker that was not seen in training falls back to the prior
+        newlabels = np.array([[combiner.K + 10, 0, 1], [0, 2, 0]])
+        pT_new = combiner.predict_proba(newlabels)
+        assert pT_new.shape == (3, 2)
+        assert pT_new[0, 1] > pT_new[1, 1]
+        assert np.allclose(pT_new[1], np.exp(combiner.lnkappa.T) / np.sum(np.exp(combiner.lnkappa)))
+
+    def testSynthetic_table_predict(self):
+        crowdlabels, truth = generate_crowd(500, 20, nclasses=2, density=3, seed=13)
+        table = crowd_table(crowdlabels, 500, 20)
+        # some missing labels are given as -1 instead of NaN
+        table[np.isnan(table) & (np.arange(20) % 2 == 0)[np.newaxis, :]] = -1
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=20)
+        pT = combiner.combine_classifications(table.copy(), table_format=True)
+        pT_frozen = combiner.predict_proba(table, table_format=True)
+        observed = np.any(np.isfinite(table) & (table >= 0), axis=1)
+        assert np.allclose(pT_frozen[observed], pT[observed])
+        assert np.mean(np.argmax(pT_frozen, axis=1) == truth['t']) > 0.8
+
+    def testSynthetic_scoringService(self):
+        crowdlabels, truth = generate_crowd(300, 20, nclasses=2, density=4, seed=14)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=20)
+        combiner.combine_classifications(crowdlabels.copy())
+        pT_frozen = combiner.predict_proba(crowdlabels)
+        subjects = np.unique(crowdlabels[:, 1]).astype(int)
+
+        async def run_service():
+            async with ScoringService(combiner) as service:
+                source = InMemoryEventSource()
+                consumer = service.consume(source)
+                for worker, subject, score in crowdlabels:
+                    source.publish(int(worker), int(subject), score)
+                source.close()
+                await consumer
+                results = await asyncio.gather(*[service.query(subject) for subject in subjects])
+                nbatches = service.nbatches
+                assert service.swap_model(combiner) == 1
+                unlabelled = await service.query(-1)
+            return np.array(results), nbatches, unlabelled
+
+        pT_served, nbatches, unlabelled = asyncio.run(run_service())
+        assert np.allclose(pT_served, pT_frozen[subjects], atol=1e-5)
+        assert nbatches < len(subjects)
+        assert np.allclose(unlabelled, np.exp(combiner.lnkappa.T) / np.sum(np.exp(combiner.lnkappa)), atol=1e-5)
+
+    def testSynthetic_scoringService_stop(self):
+        crowdlabels, truth = generate_crowd(300, 20, nclasses=2, density=4, seed=14)
+        combiner = ibcc.IBCC(nclasses=2, nscores=2, alpha0=np.ones((2, 2)) + np.eye(2), nu0=np.ones(2), K=20)
+        combiner.combine_classifications(crowdlabels.copy())
+        pT_frozen = combiner.predict_proba(crowdlabels)
+        subjects = np.unique(crowdlabels[:, 1]).astype(int)[:10]
+
+        async def run_service():
+            service = ScoringService(combiner, max_batch_size=4, max_delay=0.01)
+            for worker, subject, score in crowdlabels:
+                service.add_label(int(worker), int(subject), score)
+            await service.start()
+            # three queries and the stop signal fill the first batch
+            queries = [asyncio.ensure_future(service.query(subject)) for subject in subjects[:3]]
+            await asyncio.sleep(0)
+            stopper = asyncio.ensure_future(service.stop())
+            await asyncio.sleep(0)
+            with self.assertRaises(RuntimeError):
+                await service.query(subjects[0])
+            # queries already queued behind the stop signal are still answered
+            for subject in subjects[3:]:
+                future = asyncio.get_running_loop().create_future()
+                service._queue.put_nowait((subject, future))
+                queries.append(future)
+            await stopper
+            assert all(query.done() for query in queries)
+            return np.array([query.result() for query in queries]), service.nbatches
+
+        pT_served, nbatches = asyncio.run(asyncio.wait_for(run_service(), 10))
+        assert np.allclose(pT_served, pT_frozen[subjects], atol=1e-5)
+        assert nbatches == 3
+
+# SYNTHETIC DATA ------------------------------------------------------------------------------------------------------
+
+    def testSynthetic_clustered(self):
+        crowdlabels, truth = generate_crowd(2000, 100, nclasses=3, density=5, confusion='clustered', seed=3)
+        crowdlabels2, _ = generate_crowd(2000, 100, nclasses=3, density=5, confusion='clustered', seed=3)
+        assert np.array_equal(crowdlabels, crowdlabels2)
+        assert crowdlabels.shape[1] == 3 and len(truth['t']) == 2000 and truth['pi'].shape == (100, 3, 3)
+        compact, _ = generate_crowd(2000, 100, nclasses=3, density=5, confusion='clustered', output='compact', seed=3)
+        assert np.array_equal(compact['scores'], crowdlabels[:, 2])
+        combiner = ibcc.IBCC(nclasses=3, nscores=3, alpha0=np.ones((3, 3)) + 2 * np.eye(3), nu0=np.ones(3), K=100)
+        pT = combiner.combine_classifications(crowdlabels)
+        assert np.mean(np.argmax(pT, axis=1) == truth['t']) > 0.8
+
 # SCORES NOT FROM 0 ---------------------------------------------------------------------------------------------------
  
     def testSparseList_scores(self):